@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""Micro-benchmark for request line, header and environ handling.
+
+Compares WiseguyRequestHandler.parse_request/get_environ with the
+mimetools.Message based path it replaced, without any sockets involved.
+
+  bench_request_parsing.py [iterations]
+"""
+
+import StringIO
+import sys
+import time
+import urllib
+
+from wsgiref import simple_server
+
+from wiseguy import http_server
+
+REQUEST = (
+  'GET /api/v1/items/1234?fields=name%2Cprice&format=json HTTP/1.1\r\n'
+  'Host: api.example.com\r\n'
+  'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+  '(KHTML, like Gecko) Chrome/90.0 Safari/537.36\r\n'
+  'Accept: application/json, text/plain, */*\r\n'
+  'Accept-Language: en-US,en;q=0.9\r\n'
+  'Accept-Encoding: gzip, deflate, br\r\n'
+  'Referer: https://www.example.com/items/1234\r\n'
+  'Cookie: session=abcdef0123456789; tz=America%2FLos_Angeles\r\n'
+  'X-Requested-With: XMLHttpRequest\r\n'
+  'X-Forwarded-For: 10.1.2.3\r\n'
+  'Connection: keep-alive\r\n'
+  '\r\n')
+
+
+class FakeServer(object):
+  def __init__(self):
+    self.base_environ = {
+      'SERVER_NAME': 'localhost',
+      'GATEWAY_INTERFACE': 'CGI/1.1',
+      'SERVER_PORT': '8000',
+      'REMOTE_HOST': '',
+      'CONTENT_LENGTH': '',
+      'SCRIPT_NAME': '',
+      }
+
+
+class BenchMixIn:
+  # skip the normal __init__, it wants a socket and runs the whole request
+  def __init__(self, server):
+    self.server = server
+    self.client_address = ('10.0.0.1', 54321)
+
+
+class RequestHandler(BenchMixIn, http_server.WiseguyRequestHandler):
+  pass
+
+
+class LegacyRequestHandler(BenchMixIn, http_server.WiseguyRequestHandler):
+  """The header handling as it was before the single pass parser."""
+  def parse_request(self):
+    try:
+      return simple_server.WSGIRequestHandler.parse_request(self)
+    finally:
+      self.header_size = self.rfile.socket_tell()
+
+  def get_environ(self):
+    env = self.server.base_environ.copy()
+    env['SERVER_PROTOCOL'] = self.request_version
+    env['REQUEST_METHOD'] = self.command
+    if '?' in self.path:
+      path, query = self.path.split('?', 1)
+    else:
+      path, query = self.path, ''
+
+    env['PATH_INFO'] = urllib.unquote(path)
+    env['QUERY_STRING'] = query
+
+    host = self.address_string()
+    if host != self.client_address[0]:
+      env['REMOTE_HOST'] = host
+    env['REMOTE_ADDR'] = self.client_address[0]
+
+    if self.headers.typeheader is None:
+      env['CONTENT_TYPE'] = self.headers.type
+    else:
+      env['CONTENT_TYPE'] = self.headers.typeheader
+
+    length = self.headers.getheader('content-length')
+    if length:
+      env['CONTENT_LENGTH'] = length
+
+    for h in self.headers.headers:
+      k, v = h.split(':', 1)
+      k = k.translate(http_server.translate_header_table)
+      v = v.strip()
+      if k in env:
+        continue
+      http_key = 'HTTP_' + k
+      if http_key in env:
+        env[http_key] += ',' + v
+      else:
+        env[http_key] = v
+    return env
+
+
+def run(handler_class, iterations):
+  server = FakeServer()
+  start = time.time()
+  for i in xrange(iterations):
+    handler = handler_class(server)
+    handler.rfile = http_server.SocketFileWrapper(
+      StringIO.StringIO(REQUEST), handler)
+    handler.raw_requestline = handler.rfile.readline()
+    handler.parse_request()
+    environ = handler.get_environ()
+  return iterations / (time.time() - start), environ
+
+def main():
+  if len(sys.argv) > 1:
+    iterations = int(sys.argv[1])
+  else:
+    iterations = 50000
+  legacy_rate, legacy_environ = run(LegacyRequestHandler, iterations)
+  rate, environ = run(RequestHandler, iterations)
+  print 'before: %9.0f requests/sec' % legacy_rate
+  print 'after:  %9.0f requests/sec (%.2fx)' % (rate, rate / legacy_rate)
+  for key in sorted(set(legacy_environ) | set(environ)):
+    if legacy_environ.get(key) != environ.get(key):
+      print 'environ mismatch %s: %r != %r' % (
+        key, legacy_environ.get(key), environ.get(key))
+
+if __name__ == '__main__':
+  main()
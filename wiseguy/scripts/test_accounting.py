@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+
+from wiseguy import accounting
+
+
+class AccountingTest(unittest.TestCase):
+  def setUp(self):
+    self.accounting = accounting.RequestAccounting(2, ['/api', 'other'])
+
+  def test_record_and_totals(self):
+    self.accounting.record(0, 0, 0.5, 0)
+    self.accounting.record(0, 0, 0.25, 100)
+    self.accounting.record(1, 1, 1.0, 50)
+    self.accounting.record(None, 0, 10.0, 10)
+    rows = self.accounting.get_class_rows([0, 1])
+    self.assertEqual(rows['/api'], (2, 0.75, 0.5, 100, 100, 1))
+    self.assertEqual(rows['other'], (1, 1.0, 1.0, 50, 50, 1))
+
+  def test_retire_slot(self):
+    self.accounting.record(0, 0, 0.5, 10)
+    self.accounting.record_gc(0, 0.01, 5)
+    self.accounting.retire_slot(0)
+    self.accounting.retire_slot(None)
+    # the slot is clear for the next child
+    self.assertEqual(self.accounting.read_slot(0),
+                     [accounting.EMPTY_ROW] * 2)
+    self.assertEqual(self.accounting.read_gc_slot(0),
+                     accounting.EMPTY_GC_ROW)
+    # and what it did isn't lost
+    self.accounting.record(0, 0, 0.25, 30)
+    self.accounting.record_gc(0, 0.02, 1)
+    self.accounting.retire_slot(0)
+    self.accounting.record(0, 0, 1.0, 0)
+    rows = self.accounting.get_class_rows([0])
+    self.assertEqual(rows['/api'], (3, 1.75, 1.0, 40, 30, 2))
+    self.assertEqual(rows['other'], accounting.EMPTY_ROW)
+    self.assertEqual(self.accounting.get_gc_row([0]), (2, 0.03, 0.02, 6))
+    # nothing is counted twice
+    self.assertEqual(self.accounting.get_class_rows([0])['/api'][0], 3)
+
+  def test_child_writes(self):
+    pid = os.fork()
+    if not pid:
+      try:
+        self.accounting.record(1, 1, 0.5, 8)
+      finally:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    self.assertEqual(self.accounting.read_slot(1)[1], (1, 0.5, 0.5, 8, 8, 1))
+
+  def test_format(self):
+    self.assertEqual(accounting.format_usage_line('x', accounting.EMPTY_ROW),
+                     'x: count=0')
+    self.assertEqual(accounting.format_gc_line(accounting.EMPTY_GC_ROW),
+                     'gc: count=0')
+    line = accounting.format_usage_line('x', (2, 1.0, 0.75, 10, 10, 1))
+    self.assertTrue(line.startswith('x: count=2 cpu=1.000 cpu_avg=0.5000 '),
+                    line)
+
+  def test_get_usage(self):
+    cpu_time, maxrss = accounting.get_usage()
+    self.assertTrue(cpu_time >= 0)
+    self.assertTrue(maxrss > 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import unittest
+
+from wiseguy.http_server import parse_byte_range
+
+
+class ParseByteRangeTest(unittest.TestCase):
+  def test_closed_range(self):
+    self.assertEqual(parse_byte_range('bytes=0-0', 100), (0, 1))
+    self.assertEqual(parse_byte_range('bytes=10-19', 100), (10, 20))
+    self.assertEqual(parse_byte_range(' bytes=10-19 ', 100), (10, 20))
+
+  def test_range_past_the_end_is_clipped(self):
+    self.assertEqual(parse_byte_range('bytes=90-200', 100), (90, 100))
+
+  def test_open_ended(self):
+    self.assertEqual(parse_byte_range('bytes=10-', 100), (10, 100))
+    self.assertEqual(parse_byte_range('bytes=99-', 100), (99, 100))
+
+  def test_suffix(self):
+    self.assertEqual(parse_byte_range('bytes=-10', 100), (90, 100))
+    # more than the whole file is the whole file
+    self.assertEqual(parse_byte_range('bytes=-500', 100), (0, 100))
+
+  def test_unsatisfiable(self):
+    start, stop = parse_byte_range('bytes=100-', 100)
+    self.assertTrue(start >= 100)
+    start, stop = parse_byte_range('bytes=200-300', 100)
+    self.assertTrue(start >= 100)
+    start, stop = parse_byte_range('bytes=-0', 100)
+    self.assertTrue(start >= 100)
+    start, stop = parse_byte_range('bytes=0-', 0)
+    self.assertTrue(start >= 0)
+
+  def test_ignored(self):
+    for value in ('bytes=5-2', 'bytes=0-1,5-6', 'items=0-1', 'bytes=-',
+                  'bytes=a-b', 'bytes=1-b', 'bytes=--1', 'bytes=-1-2',
+                  'bytes=5', 'bytes=+5-6', 'bytes=5- 6', ''):
+      self.assertEqual(parse_byte_range(value, 100), None, value)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import socket
+import struct
+import unittest
+
+from wiseguy import fcgi_protocol
+from wiseguy.fcgi_protocol import (
+  decode_name_value_pairs, encode_name_value_pairs, encode_record,
+  encode_stream, ProtocolError)
+
+
+def decode_records(data):
+  """Return a list of (record_type, request_id, content)."""
+  records = []
+  offset = 0
+  while offset < len(data):
+    version, record_type, request_id, length, padding = struct.unpack_from(
+      fcgi_protocol.HEADER_FORMAT, data, offset)
+    offset += fcgi_protocol.HEADER_SIZE
+    records.append((record_type, request_id, data[offset:offset + length]))
+    offset += length + padding
+  return records
+
+
+class RecordTest(unittest.TestCase):
+  def test_record_round_trip(self):
+    for content in ('', 'a', 'x' * 8, 'y' * 13, 'z' * 65535):
+      data = encode_record(fcgi_protocol.FCGI_STDOUT, 3, content)
+      # always padded to a multiple of 8
+      self.assertEqual(len(data) % 8, 0)
+      self.assertEqual(decode_records(data),
+                       [(fcgi_protocol.FCGI_STDOUT, 3, content)])
+
+  def test_stream_is_split(self):
+    data = 'x' * (fcgi_protocol.MAX_CONTENT_SIZE * 2 + 5)
+    records = decode_records(encode_stream(fcgi_protocol.FCGI_STDOUT, 1,
+                                           data))
+    self.assertEqual([len(content) for t, i, content in records],
+                     [fcgi_protocol.MAX_CONTENT_SIZE,
+                      fcgi_protocol.MAX_CONTENT_SIZE, 5])
+    self.assertEqual(''.join(content for t, i, content in records), data)
+    self.assertEqual(encode_stream(fcgi_protocol.FCGI_STDOUT, 1, ''), '')
+
+
+class NameValuePairTest(unittest.TestCase):
+  def test_round_trip(self):
+    pairs = [('SCRIPT_NAME', '/x'), ('EMPTY', ''), ('', 'no name'),
+             ('N' * 127, 'v' * 127), ('N' * 128, 'v' * 128),
+             ('LONG', 'v' * 70000)]
+    self.assertEqual(decode_name_value_pairs(encode_name_value_pairs(pairs)),
+                     pairs)
+
+  def test_length_encoding(self):
+    self.assertEqual(encode_name_value_pairs([('a', 'b')]), '\x01\x01ab')
+    data = encode_name_value_pairs([('a', 'b' * 128)])
+    self.assertEqual(data[:5], '\x01\x80\x00\x00\x80')
+
+  def test_truncated(self):
+    data = encode_name_value_pairs([('NAME', 'v' * 200)])
+    for end in range(1, len(data)):
+      self.assertRaises(ProtocolError, decode_name_value_pairs, data[:end])
+    self.assertEqual(decode_name_value_pairs(''), [])
+
+
+class ConnectionTest(unittest.TestCase):
+  def setUp(self):
+    self.server_socket, self.client_socket = socket.socketpair()
+    self.connection = fcgi_protocol.Connection(
+      self.server_socket, {'FCGI_MPXS_CONNS': '1'}, max_requests=2,
+      stdin_spool_size=1024)
+
+  def tearDown(self):
+    self.connection.close()
+    self.client_socket.close()
+
+  def begin(self, request_id, role=fcgi_protocol.FCGI_RESPONDER):
+    return encode_record(
+      fcgi_protocol.FCGI_BEGIN_REQUEST, request_id,
+      struct.pack(fcgi_protocol.BEGIN_REQUEST_FORMAT, role,
+                  fcgi_protocol.FCGI_KEEP_CONN))
+
+  def params(self, request_id, pairs):
+    return (encode_stream(fcgi_protocol.FCGI_PARAMS, request_id,
+                          encode_name_value_pairs(pairs)) +
+            encode_record(fcgi_protocol.FCGI_PARAMS, request_id))
+
+  def stdin(self, request_id, data):
+    return (encode_stream(fcgi_protocol.FCGI_STDIN, request_id, data) +
+            encode_record(fcgi_protocol.FCGI_STDIN, request_id))
+
+  def feed(self, data):
+    self.client_socket.sendall(data)
+    return self.connection.read()
+
+  def test_interleaved_requests(self):
+    data = (self.begin(1) + self.begin(2) +
+            self.params(2, [('PATH_INFO', '/two')]) +
+            self.params(1, [('PATH_INFO', '/one')]) +
+            self.stdin(1, 'body one') + self.stdin(2, ''))
+    # one byte short of the last record, and then the rest
+    ready = self.feed(data[:-1])
+    self.assertEqual([request.request_id for request in ready], [1])
+    self.assertEqual(ready[0].environ, {'PATH_INFO': '/one'})
+    self.assertEqual(ready[0].stdin.read(), 'body one')
+    ready = self.feed(data[-1:])
+    self.assertEqual([request.request_id for request in ready], [2])
+
+  def test_overloaded(self):
+    ready = self.feed(self.begin(1) + self.begin(2) + self.begin(3))
+    self.assertEqual(ready, [])
+    (record_type, request_id, content), = decode_records(
+      self.client_socket.recv(1024))
+    self.assertEqual((record_type, request_id),
+                     (fcgi_protocol.FCGI_END_REQUEST, 3))
+    self.assertEqual(
+      struct.unpack(fcgi_protocol.END_REQUEST_FORMAT, content)[1],
+      fcgi_protocol.FCGI_OVERLOADED)
+
+  def test_get_values(self):
+    self.feed(encode_record(
+      fcgi_protocol.FCGI_GET_VALUES, fcgi_protocol.FCGI_NULL_REQUEST_ID,
+      encode_name_value_pairs([('FCGI_MPXS_CONNS', ''),
+                               ('FCGI_UNKNOWN', '')])))
+    (record_type, request_id, content), = decode_records(
+      self.client_socket.recv(1024))
+    self.assertEqual(record_type, fcgi_protocol.FCGI_GET_VALUES_RESULT)
+    self.assertEqual(decode_name_value_pairs(content),
+                     [('FCGI_MPXS_CONNS', '1')])
+
+  def test_truncated_params_close_connection(self):
+    self.feed(self.begin(1) +
+              encode_record(fcgi_protocol.FCGI_PARAMS, 1, '\x05\x05abc') +
+              encode_record(fcgi_protocol.FCGI_PARAMS, 1))
+    self.assertTrue(self.connection.closed)
+
+  def test_finish(self):
+    ready = self.feed(self.begin(1) + self.params(1, []) + self.stdin(1, ''))
+    request, = ready
+    request.stdout.write('Status: 200 OK\r\n\r\nhello')
+    request.finish()
+    records = decode_records(self.client_socket.recv(1024))
+    self.assertEqual([(t, i) for t, i, content in records], [
+      (fcgi_protocol.FCGI_STDOUT, 1), (fcgi_protocol.FCGI_STDOUT, 1),
+      (fcgi_protocol.FCGI_END_REQUEST, 1)])
+    self.assertEqual(records[0][2], 'Status: 200 OK\r\n\r\nhello')
+    self.assertEqual(records[1][2], '')
+    self.assertEqual(self.connection.requests, {})
+    self.assertFalse(self.connection.closed)
+
+
+if __name__ == '__main__':
+  unittest.main()
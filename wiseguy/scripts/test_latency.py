@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import unittest
+
+from wiseguy import latency
+
+
+class BucketTest(unittest.TestCase):
+  def test_bucket_bounds(self):
+    seconds = latency.MIN_LATENCY
+    while seconds < latency.MIN_LATENCY * 2 ** latency.OCTAVES:
+      index = latency.bucket_index(seconds)
+      upper = latency.bucket_upper_bound(index)
+      lower = latency.bucket_upper_bound(index - 1)
+      self.assertTrue(lower <= seconds < upper, (seconds, lower, upper))
+      # the relative error stays under 1/SUB_BUCKETS
+      self.assertTrue((upper - seconds) / seconds <=
+                      1.0 / latency.SUB_BUCKETS, seconds)
+      seconds *= 1.07
+
+  def test_bucket_index_is_monotonic(self):
+    last = 0
+    seconds = 0.00001
+    while seconds < 1000:
+      index = latency.bucket_index(seconds)
+      self.assertTrue(index >= last)
+      last = index
+      seconds *= 1.01
+
+  def test_out_of_range(self):
+    self.assertEqual(latency.bucket_index(0), 0)
+    self.assertEqual(latency.bucket_index(latency.MIN_LATENCY / 2), 0)
+    self.assertEqual(latency.bucket_upper_bound(0), latency.MIN_LATENCY)
+    top = latency.BUCKET_COUNT - 1
+    self.assertEqual(latency.bucket_index(10 ** 6), top)
+    self.assertEqual(latency.bucket_upper_bound(top), float('inf'))
+
+
+class PercentileTest(unittest.TestCase):
+  def counts_for(self, samples):
+    counts = [0] * latency.BUCKET_COUNT
+    for seconds in samples:
+      counts[latency.bucket_index(seconds)] += 1
+    return counts
+
+  def test_empty(self):
+    self.assertEqual(latency.get_percentiles([0] * latency.BUCKET_COUNT),
+                     [None, None, None])
+    self.assertEqual(
+      latency.format_latency_line('x', [0] * latency.BUCKET_COUNT),
+      'x: count=0')
+
+  def test_single_bucket(self):
+    counts = self.counts_for([0.01] * 10)
+    bound = latency.bucket_upper_bound(latency.bucket_index(0.01))
+    self.assertEqual(latency.get_percentiles(counts), [bound] * 3)
+
+  def test_distribution(self):
+    # 89 fast, 10 slower, 1 very slow request
+    counts = self.counts_for([0.001] * 89 + [0.1] * 10 + [2.0])
+    p50, p90, p99 = latency.get_percentiles(counts)
+    self.assertEqual(p50, latency.bucket_upper_bound(
+      latency.bucket_index(0.001)))
+    self.assertEqual(p90, latency.bucket_upper_bound(
+      latency.bucket_index(0.1)))
+    self.assertEqual(p99, latency.bucket_upper_bound(
+      latency.bucket_index(0.1)))
+    self.assertEqual(latency.get_percentiles(counts, (1.0,)),
+                     [latency.bucket_upper_bound(latency.bucket_index(2.0))])
+
+  def test_percentile_on_boundary(self):
+    # exactly half the requests in the first bucket
+    counts = self.counts_for([0.001] * 5 + [1.0] * 5)
+    self.assertEqual(latency.get_percentiles(counts, (0.5, 0.51)), [
+      latency.bucket_upper_bound(latency.bucket_index(0.001)),
+      latency.bucket_upper_bound(latency.bucket_index(1.0))])
+
+
+class HistogramTest(unittest.TestCase):
+  def test_classes_and_retire(self):
+    histograms = latency.LatencyHistograms(2, ['/api', '/api/v2'])
+    self.assertEqual(histograms.class_names,
+                     ['/api/v2', '/api', latency.OTHER_CLASS])
+    histograms.record(0, '/api/v2/x', 0.01)
+    histograms.record(0, '/api/x', 0.01)
+    histograms.record(1, '/other', 0.01)
+    histograms.record(None, '/api', 0.01)
+    histograms.retire_slot(0)
+    self.assertEqual(sum(histograms.get_slot_counts(0)), 0)
+    histograms.record(0, '/api', 0.02)
+    class_counts = histograms.get_class_counts([0, 1])
+    self.assertEqual(sum(class_counts['/api/v2']), 1)
+    self.assertEqual(sum(class_counts['/api']), 2)
+    self.assertEqual(sum(class_counts[latency.OTHER_CLASS]), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import StringIO
+import unittest
+
+from wiseguy import http_server
+
+
+class FakeRequestHandler(object):
+  def __init__(self, headers):
+    self.headers = http_server.RequestHeaders(
+      (name.lower(), value) for name, value in headers.items())
+    self.close_connection = False
+
+
+class SocketFileWrapperTest(unittest.TestCase):
+  def wrap(self, data, headers, max_body_size=None):
+    self.handler = FakeRequestHandler(headers)
+    wrapper = http_server.SocketFileWrapper(StringIO.StringIO(data),
+                                            self.handler)
+    wrapper.begin_body(max_body_size)
+    return wrapper
+
+  def chunked(self, data, **kargs):
+    return self.wrap(data, {'Transfer-Encoding': 'chunked'}, **kargs)
+
+  def test_content_length(self):
+    wrapper = self.wrap('hello worldGET / HTTP/1.1\r\n',
+                        {'Content-Length': '11'})
+    self.assertEqual(wrapper.read(5), 'hello')
+    self.assertEqual(wrapper.read(), ' world')
+    self.assertEqual(wrapper.read(), '')
+    self.assertTrue(wrapper.body_finished())
+    wrapper.end_body()
+    self.assertEqual(wrapper.readline(), 'GET / HTTP/1.1\r\n')
+
+  def test_no_body(self):
+    wrapper = self.wrap('GET / HTTP/1.1\r\n', {})
+    self.assertEqual(wrapper.read(), '')
+    self.assertTrue(wrapper.body_finished())
+
+  def test_chunked_with_trailers(self):
+    wrapper = self.chunked(
+      '5;name=value\r\nhello\r\n'
+      '6\r\n world\r\n'
+      '0\r\nX-Trailer: 1\r\nX-Other: 2\r\n\r\n'
+      'GET /next HTTP/1.1\r\n')
+    self.assertEqual(wrapper.read(), 'hello world')
+    self.assertTrue(wrapper.body_finished())
+    wrapper.end_body()
+    # the trailers were consumed, the next request is intact
+    self.assertEqual(wrapper.readline(), 'GET /next HTTP/1.1\r\n')
+
+  def test_chunked_small_reads(self):
+    wrapper = self.chunked('5\r\nhello\r\nA\r\n0123456789\r\n0\r\n\r\n')
+    blocks = []
+    while True:
+      data = wrapper.read(3)
+      if not data:
+        break
+      blocks.append(data)
+    self.assertEqual(''.join(blocks), 'hello0123456789')
+    self.assertFalse(self.handler.close_connection)
+
+  def test_chunked_readline_across_chunks(self):
+    wrapper = self.chunked('4\r\nab\nc\r\n3\r\nd\ne\r\n0\r\n\r\n')
+    self.assertEqual(wrapper.readline(), 'ab\n')
+    self.assertEqual(wrapper.readline(), 'cd\n')
+    self.assertEqual(wrapper.readline(), 'e')
+    self.assertEqual(wrapper.readline(), '')
+
+  def test_chunked_readinto_and_iter_blocks(self):
+    wrapper = self.chunked('5\r\nhello\r\n0\r\n\r\n')
+    buffer = bytearray(3)
+    self.assertEqual(wrapper.readinto(buffer), 3)
+    self.assertEqual(str(buffer), 'hel')
+    self.assertEqual(list(wrapper.iter_blocks(1)), ['l', 'o'])
+
+  def test_bad_chunk_size(self):
+    wrapper = self.chunked('zz\r\nhello\r\n0\r\n\r\n')
+    self.assertRaises(IOError, wrapper.read)
+    self.assertTrue(self.handler.close_connection)
+
+  def test_chunked_body_too_large(self):
+    wrapper = self.chunked('5\r\nhello\r\n5\r\nworld\r\n0\r\n\r\n',
+                           max_body_size=8)
+    self.assertRaises(http_server.RequestEntityTooLarge, wrapper.read)
+    self.assertTrue(self.handler.close_connection)
+
+  def test_declared_body_too_large(self):
+    self.assertRaises(http_server.RequestEntityTooLarge, self.wrap,
+                      'hello', {'Content-Length': '5'}, max_body_size=4)
+
+  def test_truncated_body(self):
+    wrapper = self.wrap('hel', {'Content-Length': '5'})
+    self.assertEqual(wrapper.read(), 'hel')
+    self.assertTrue(wrapper.body_finished())
+    self.assertTrue(self.handler.close_connection)
+
+  def test_bytes_read(self):
+    data = '5\r\nhello\r\n0\r\nX-T: 1\r\n\r\n'
+    wrapper = self.chunked(data)
+    wrapper.read()
+    self.assertEqual(wrapper.socket_tell(), len(data))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import StringIO
+import unittest
+
+from wiseguy import event_server
+from wiseguy import http_server
+
+
+class ParsingRequestHandler(http_server.WiseguyRequestHandler):
+  """Just the parsing, without a connection behind it."""
+  def __init__(self, data):
+    self.rfile = StringIO.StringIO(data)
+    self.raw_requestline = self.rfile.readline()
+    self.errors = []
+
+  def send_error(self, code, message=None):
+    self.errors.append(code)
+
+
+class HeaderParsingTest(unittest.TestCase):
+  def parse(self, data):
+    handler = ParsingRequestHandler(data)
+    self.assertTrue(handler._parse_request())
+    return handler
+
+  def test_simple(self):
+    handler = self.parse('GET /x?y=1 HTTP/1.1\r\nHost: example.com\r\n'
+                         'Content-Type: text/plain\r\n'
+                         'Content-Length: 3\r\n\r\nabc')
+    self.assertEqual(handler.command, 'GET')
+    self.assertEqual(handler.path, '/x?y=1')
+    self.assertEqual(handler.request_version, 'HTTP/1.1')
+    self.assertFalse(handler.close_connection)
+    self.assertEqual(handler.headers.getheader('Host'), 'example.com')
+    self.assertEqual(handler.header_environ, {
+      'HTTP_HOST': 'example.com',
+      'CONTENT_TYPE': 'text/plain',
+      'CONTENT_LENGTH': '3',
+      })
+    # the body is left alone
+    self.assertEqual(handler.rfile.read(), 'abc')
+
+  def test_folded_header(self):
+    handler = self.parse('GET / HTTP/1.1\r\nX-Long: one\r\n'
+                         '  two\r\n\tthree\r\nHost: h\r\n\r\n')
+    self.assertEqual(handler.header_environ['HTTP_X_LONG'], 'one two three')
+    self.assertEqual(handler.headers['x-long'], 'one two three')
+    self.assertEqual(handler.header_environ['HTTP_HOST'], 'h')
+
+  def test_folded_first_line_is_ignored(self):
+    handler = self.parse('GET / HTTP/1.1\r\n  stray\r\nHost: h\r\n\r\n')
+    self.assertEqual(handler.header_environ, {'HTTP_HOST': 'h'})
+
+  def test_duplicate_headers(self):
+    handler = self.parse('GET / HTTP/1.1\r\nAccept: a\r\n'
+                         'accept: b\r\nACCEPT:c\r\n\r\n')
+    self.assertEqual(handler.header_environ['HTTP_ACCEPT'], 'a,b,c')
+    self.assertEqual(handler.headers.getheader('Accept'), 'a,b,c')
+
+  def test_bare_newlines(self):
+    handler = self.parse('GET / HTTP/1.0\nHost: h\n\n')
+    self.assertEqual(handler.header_environ, {'HTTP_HOST': 'h'})
+    self.assertTrue(handler.close_connection)
+
+  def test_connection_header(self):
+    handler = self.parse('GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n')
+    self.assertFalse(handler.close_connection)
+    handler = self.parse('GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+    self.assertTrue(handler.close_connection)
+
+  def test_line_without_colon_ends_headers(self):
+    handler = self.parse('GET / HTTP/1.1\r\nHost: h\r\nbogus\r\n'
+                         'X-After: 1\r\n\r\n')
+    self.assertEqual(handler.header_environ, {'HTTP_HOST': 'h'})
+
+  def test_too_many_headers(self):
+    handler = ParsingRequestHandler(
+      'GET / HTTP/1.1\r\n' +
+      'X-H: 1\r\n' * (http_server.max_header_count + 1) + '\r\n')
+    self.assertFalse(handler._parse_request())
+    self.assertEqual(handler.errors, [400])
+
+  def test_header_line_too_long(self):
+    handler = ParsingRequestHandler(
+      'GET / HTTP/1.1\r\nX-H: %s\r\n\r\n' %
+      ('x' * http_server.max_header_line))
+    self.assertFalse(handler._parse_request())
+    self.assertEqual(handler.errors, [400])
+
+  def test_bad_request_line(self):
+    for line, code in (('GET / HTTP/2.0\r\n\r\n', 505),
+                       ('GET / FTP/1.0\r\n\r\n', 400),
+                       ('POST /\r\n\r\n', 400),
+                       ('GET / HTTP/1.1 extra\r\n\r\n', 400)):
+      handler = ParsingRequestHandler(line)
+      self.assertFalse(handler._parse_request())
+      self.assertEqual(handler.errors, [code], line)
+
+
+class FakeConnection(object):
+  client_address = ('127.0.0.1', 1234)
+
+
+class EventHeadTest(unittest.TestCase):
+  def parse(self, data):
+    """Split data the way EventHTTPServer.process_input does, return the
+    request and what is left over."""
+    end, length = event_server.find_head_end(data)
+    self.assertTrue(end >= 0, data)
+    return (event_server.EventRequest(None, FakeConnection(), data[:end]),
+            data[end + length:])
+
+  def test_incomplete(self):
+    for data in ('GET / HTTP/1.1\r\nHost: h\r\n', 'GET / HTTP/1.1\nHost: h\n',
+                 'GET / HTTP/1.1\r\nHost: h\r\n\r'):
+      self.assertEqual(event_server.find_head_end(data), (-1, 0))
+
+  def test_crlf(self):
+    request, rest = self.parse('GET / HTTP/1.1\r\nHost: h\r\n\r\nbody')
+    self.assertEqual(request.header_environ, {'HTTP_HOST': 'h'})
+    self.assertEqual(rest, 'body')
+
+  def test_bare_newlines(self):
+    request, rest = self.parse(
+      'GET / HTTP/1.1\nHost: x\nConnection: close\n\nGET /next')
+    self.assertEqual(request.path, '/')
+    self.assertEqual(request.header_environ,
+                     {'HTTP_HOST': 'x', 'HTTP_CONNECTION': 'close'})
+    self.assertTrue(request.close_connection)
+    self.assertEqual(rest, 'GET /next')
+
+  def test_mixed_newlines(self):
+    request, rest = self.parse('GET / HTTP/1.1\nHost: h\n\r\nbody')
+    self.assertEqual(request.header_environ, {'HTTP_HOST': 'h'})
+    self.assertEqual(rest, 'body')
+    request, rest = self.parse('GET / HTTP/1.1\r\nHost: h\r\n\nbody')
+    self.assertEqual(request.header_environ, {'HTTP_HOST': 'h'})
+    self.assertEqual(rest, 'body')
+
+  def test_request_line_only(self):
+    for data in ('GET / HTTP/1.0\r\n\r\n', 'GET / HTTP/1.0\n\n'):
+      request, rest = self.parse(data)
+      self.assertEqual(request.request_version, 'HTTP/1.0')
+      self.assertEqual(request.header_environ, {})
+      self.assertEqual(rest, '')
+
+  def test_same_as_request_handler(self):
+    for data in ('GET / HTTP/1.1\nX-Long: one\n  two\nAccept: a\n'
+                 'accept: b\n\n',
+                 'GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n'):
+      request, rest = self.parse(data)
+      handler = ParsingRequestHandler(data)
+      self.assertTrue(handler._parse_request())
+      self.assertEqual(request.header_environ, handler.header_environ)
+      self.assertEqual(request.close_connection,
+                       bool(handler.close_connection))
+
+
+if __name__ == '__main__':
+  unittest.main()
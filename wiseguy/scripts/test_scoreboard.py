@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import os
+import struct
+import unittest
+
+from wiseguy import scoreboard
+
+
+class ScoreboardTest(unittest.TestCase):
+  def setUp(self):
+    self.scoreboard = scoreboard.Scoreboard(4)
+
+  def fork_child(self, function):
+    """Run function(slot) in a child that owns a slot, return its pid."""
+    slot = self.scoreboard.allocate_slot()
+    pid = os.fork()
+    if not pid:
+      try:
+        self.scoreboard.child_init(slot, os.getpid())
+        function()
+      finally:
+        os._exit(0)
+    self.scoreboard.assign_slot(slot, pid)
+    os.waitpid(pid, 0)
+    return pid
+
+  def test_child_writes_are_seen_by_parent(self):
+    def child():
+      self.scoreboard.set_busy('/one')
+      self.scoreboard.set_idle()
+      self.scoreboard.set_busy('/two')
+    pid = self.fork_child(child)
+    status = self.scoreboard.get_status(pid)
+    self.assertEqual(status['pid'], pid)
+    self.assertEqual(status['state'], scoreboard.STATE_BUSY)
+    self.assertEqual(status['request_count'], 2)
+    self.assertEqual(status['path'], '/two')
+    self.assertEqual([s['pid'] for s in self.scoreboard.snapshot()], [pid])
+
+  def test_long_path_is_truncated(self):
+    pid = self.fork_child(lambda: self.scoreboard.set_busy('/x' * 100))
+    status = self.scoreboard.get_status(pid)
+    self.assertEqual(len(status['path']), scoreboard.PATH_SIZE)
+
+  def test_reader_retries_dirty_slot(self):
+    pid = self.fork_child(self.scoreboard.set_idle)
+    slot = self.scoreboard.get_status(pid)['slot']
+    offset = slot * scoreboard.SLOT_SIZE
+    seq = struct.unpack_from(scoreboard.SEQ_FORMAT,
+                             self.scoreboard._mmap, offset)[0]
+    self.assertEqual(seq & 1, 0)
+    # a writer that never finishes leaves the sequence odd
+    struct.pack_into(scoreboard.SEQ_FORMAT, self.scoreboard._mmap, offset,
+                     seq + 1)
+    self.assertRaises(scoreboard.ScoreboardError,
+                      self.scoreboard.read_slot, slot)
+    self.assertEqual(self.scoreboard.snapshot(), [])
+    struct.pack_into(scoreboard.SEQ_FORMAT, self.scoreboard._mmap, offset,
+                     seq + 2)
+    self.assertEqual(self.scoreboard.read_slot(slot)['pid'], pid)
+
+  def test_release_frees_slot(self):
+    pid = self.fork_child(self.scoreboard.set_idle)
+    slot = self.scoreboard.release_pid(pid)
+    self.assertEqual(self.scoreboard.read_slot(slot)['state'],
+                     scoreboard.STATE_FREE)
+    self.assertEqual(self.scoreboard.get_status(pid), None)
+    self.assertEqual(self.scoreboard.allocate_slot(), slot)
+
+  def test_full_scoreboard(self):
+    slots = [self.scoreboard.allocate_slot() for i in xrange(4)]
+    self.assertEqual(sorted(slots), [0, 1, 2, 3])
+    self.assertEqual(self.scoreboard.allocate_slot(), None)
+    self.scoreboard.cancel_slot(slots[0])
+    self.assertEqual(self.scoreboard.allocate_slot(), slots[0])
+
+  def test_recycle_flag(self):
+    def child():
+      self.scoreboard.set_idle()
+      # nothing asked for yet
+      if self.scoreboard.recycle_requested():
+        self.scoreboard.set_busy('/early')
+    pid = self.fork_child(child)
+    self.assertEqual(self.scoreboard.get_status(pid)['state'],
+                     scoreboard.STATE_IDLE)
+    self.assertTrue(self.scoreboard.request_recycle(pid))
+    self.assertFalse(self.scoreboard.request_recycle(pid + 1000000))
+    slot = self.scoreboard.get_status(pid)['slot']
+    self.assertEqual(
+      self.scoreboard._mmap[self.scoreboard._control_offset + slot],
+      scoreboard.CONTROL_RECYCLE)
+    # a new child in the same slot doesn't inherit the request
+    self.scoreboard.release_pid(pid)
+    def new_child():
+      if self.scoreboard.recycle_requested():
+        self.scoreboard.set_busy('/inherited')
+      else:
+        self.scoreboard.set_idle()
+    new_pid = self.fork_child(new_child)
+    self.assertEqual(self.scoreboard.get_status(new_pid)['state'],
+                     scoreboard.STATE_IDLE)
+
+  def test_child_sees_recycle_flag(self):
+    slot = self.scoreboard.allocate_slot()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+      try:
+        os.close(wfd)
+        self.scoreboard.child_init(slot, os.getpid())
+        self.scoreboard.set_idle()
+        os.read(rfd, 1)
+        if self.scoreboard.recycle_requested():
+          self.scoreboard.set_exiting()
+      finally:
+        os._exit(0)
+    os.close(rfd)
+    self.scoreboard.assign_slot(slot, pid)
+    self.scoreboard.request_recycle(pid)
+    os.write(wfd, '\0')
+    os.close(wfd)
+    os.waitpid(pid, 0)
+    self.assertEqual(self.scoreboard.get_status(pid)['state'],
+                     scoreboard.STATE_EXITING)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,4 +1,4 @@
 __author__ = 'Mike Solomon'
 __author_email__ = '<mas63 @t cornell d0t edu>'
-__version__ = '0.6.10'
+__version__ = '0.7'
 __license__ = 'BSD License'
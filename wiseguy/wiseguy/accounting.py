@@ -0,0 +1,175 @@
+"""Per request CPU and memory growth accounting kept in shared memory.
+
+This is laid out like the latency histograms - one row of counters per
+scoreboard slot and URL prefix class, only ever written by the child that
+owns the slot, folded into retired totals when the parent reaps it.
+
+Each request costs two getrusage() calls. RUSAGE_THREAD gives the CPU time
+of the calling thread only, so request threads don't bill each other. The
+memory figure is the growth of ru_maxrss, the high water mark of the whole
+process - a request that pushes it up is one that makes the child bigger,
+which is what eventually gets it recycled by max_rss. With request threads
+the growth is billed to whichever request happened to be running.
+
+Out-of-band garbage collections aren't part of any request, they get one
+more row per slot after the request rows.
+"""
+
+import mmap
+import resource
+import struct
+import sys
+import threading
+
+# python2 doesn't export this one
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None)
+if RUSAGE_THREAD is None and sys.platform.startswith('linux'):
+  RUSAGE_THREAD = 1
+if RUSAGE_THREAD is None:
+  RUSAGE_THREAD = resource.RUSAGE_SELF
+
+# ru_maxrss is in bytes on darwin, kb everywhere else
+if sys.platform == 'darwin':
+  MAXRSS_SCALE = 1024
+else:
+  MAXRSS_SCALE = 1
+
+# request_count, cpu_time, max_cpu_time, rss_growth, max_rss_growth,
+# grown_count
+ROW_FORMAT = '<QddQQQ'
+ROW_SIZE = struct.calcsize(ROW_FORMAT)
+EMPTY_ROW = (0, 0.0, 0.0, 0, 0, 0)
+# collection_count, gc_time, max_gc_time, collected
+GC_ROW_FORMAT = '<QddQ'
+GC_ROW_SIZE = struct.calcsize(GC_ROW_FORMAT)
+EMPTY_GC_ROW = (0, 0.0, 0.0, 0)
+
+
+def get_usage():
+  """Return (cpu_time, maxrss_kb) for the calling thread."""
+  usage = resource.getrusage(RUSAGE_THREAD)
+  return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / MAXRSS_SCALE
+
+def add_rows(total, row):
+  """Return the sum of two rows."""
+  return (total[0] + row[0], total[1] + row[1], max(total[2], row[2]),
+          total[3] + row[3], max(total[4], row[4]), total[5] + row[5])
+
+def add_gc_rows(total, row):
+  return (total[0] + row[0], total[1] + row[1], max(total[2], row[2]),
+          total[3] + row[3])
+
+
+class RequestAccounting(object):
+  def __init__(self, slot_count, class_names):
+    """class_names - the names of the URL classes, in the order of the
+    class indexes passed to record"""
+    self.slot_count = slot_count
+    self.class_names = list(class_names)
+    self._class_count = len(self.class_names)
+    self._gc_offset = slot_count * self._class_count * ROW_SIZE
+    self._mmap = mmap.mmap(-1, self._gc_offset + slot_count * GC_ROW_SIZE,
+                           mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    # parent side - totals from children that have been reaped
+    self._retired = [EMPTY_ROW] * self._class_count
+    self._retired_gc = EMPTY_GC_ROW
+    self._lock = threading.Lock()
+
+  def _row_offset(self, slot, class_index):
+    return (slot * self._class_count + class_index) * ROW_SIZE
+
+  # child side
+
+  def record(self, slot, class_index, cpu_time, rss_growth):
+    """Count one request that used cpu_time seconds and grew the process
+    by rss_growth kb."""
+    if slot is None:
+      return
+    offset = self._row_offset(slot, class_index)
+    row = add_rows(struct.unpack_from(ROW_FORMAT, self._mmap, offset),
+                   (1, cpu_time, cpu_time, rss_growth, rss_growth,
+                    rss_growth and 1 or 0))
+    struct.pack_into(ROW_FORMAT, self._mmap, offset, *row)
+
+  def record_gc(self, slot, seconds, collected):
+    """Count one collection that took seconds and freed collected
+    objects."""
+    if slot is None:
+      return
+    offset = self._gc_offset + slot * GC_ROW_SIZE
+    row = add_gc_rows(struct.unpack_from(GC_ROW_FORMAT, self._mmap, offset),
+                      (1, seconds, seconds, collected))
+    struct.pack_into(GC_ROW_FORMAT, self._mmap, offset, *row)
+
+  # parent side
+
+  def read_slot(self, slot):
+    """Return a row for each class."""
+    return [struct.unpack_from(ROW_FORMAT, self._mmap,
+                               self._row_offset(slot, class_index))
+            for class_index in xrange(self._class_count)]
+
+  def read_gc_slot(self, slot):
+    return struct.unpack_from(GC_ROW_FORMAT, self._mmap,
+                              self._gc_offset + slot * GC_ROW_SIZE)
+
+  def retire_slot(self, slot):
+    """Fold the rows of a reaped child into the totals and clear slot."""
+    if slot is None:
+      return
+    rows = self.read_slot(slot)
+    gc_row = self.read_gc_slot(slot)
+    self._lock.acquire()
+    try:
+      self._retired = [add_rows(total, row)
+                       for total, row in zip(self._retired, rows)]
+      self._retired_gc = add_gc_rows(self._retired_gc, gc_row)
+    finally:
+      self._lock.release()
+    start = self._row_offset(slot, 0)
+    self._mmap[start:start + self._class_count * ROW_SIZE] = (
+      '\0' * (self._class_count * ROW_SIZE))
+    start = self._gc_offset + slot * GC_ROW_SIZE
+    self._mmap[start:start + GC_ROW_SIZE] = '\0' * GC_ROW_SIZE
+
+  def get_class_rows(self, slots):
+    """Return class name -> row, for slots plus retired children."""
+    self._lock.acquire()
+    try:
+      totals = list(self._retired)
+    finally:
+      self._lock.release()
+    for slot in slots:
+      totals = [add_rows(total, row)
+                for total, row in zip(totals, self.read_slot(slot))]
+    return dict(zip(self.class_names, totals))
+
+  def get_gc_row(self, slots):
+    """Return the collection totals for slots plus retired children."""
+    self._lock.acquire()
+    try:
+      total = self._retired_gc
+    finally:
+      self._lock.release()
+    for slot in slots:
+      total = add_gc_rows(total, self.read_gc_slot(slot))
+    return total
+
+
+def format_usage_line(name, row):
+  (request_count, cpu_time, max_cpu_time, rss_growth, max_rss_growth,
+   grown_count) = row
+  if not request_count:
+    return '%s: count=0' % name
+  return ('%s: count=%s cpu=%.3f cpu_avg=%.4f cpu_max=%.4f rss_growth=%s '
+          'rss_growth_max=%s grown=%s' % (
+            name, request_count, cpu_time, cpu_time / request_count,
+            max_cpu_time, rss_growth, max_rss_growth, grown_count))
+
+def format_gc_line(row):
+  collection_count, gc_time, max_gc_time, collected = row
+  if not collection_count:
+    return 'gc: count=0'
+  return 'gc: count=%s time=%.3f avg=%.4f max=%.4f collected=%s' % (
+    collection_count, gc_time, gc_time / collection_count, max_gc_time,
+    collected)
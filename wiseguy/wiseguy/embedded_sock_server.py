@@ -51,7 +51,7 @@ class _SocketChatter(object):
 
   @disconnect_on_timeout
   def recv_int(self):
-    return int(struct.unpack(INT_FORMAT, self.socket.recv(INT_SIZE))[0])
+    return int(struct.unpack(INT_FORMAT, self.recv_exactly(INT_SIZE))[0])
 
   @disconnect_on_timeout
   def send_str(self, s):
@@ -65,8 +65,20 @@ class _SocketChatter(object):
   @disconnect_on_timeout
   def recv_str(self):
     strlen = self.recv_int()
-    return self.socket.recv(strlen)
-    
+    return self.recv_exactly(strlen)
+
+  @disconnect_on_timeout
+  def recv_exactly(self, size):
+    """Read size bytes, however many recv() calls that takes."""
+    chunks = []
+    while size > 0:
+      data = self.socket.recv(size)
+      if not data:
+        raise EOFError('connection closed, %s bytes short' % size)
+      chunks.append(data)
+      size -= len(data)
+    return ''.join(chunks)
+
 
 class SocketClient(_SocketChatter):
   def __init__(self, address, timeout=30.0):
@@ -101,7 +113,7 @@ class EmbeddedHandler(SocketServer.BaseRequestHandler, _SocketChatter):
   def get_cmd(self):
     try:
       return self.recv_str()
-    except struct.error, e:
+    except EOFError, e:
       # usually this means we failed to read net string because the client
       # closed the connection
       return None
@@ -0,0 +1,822 @@
+"""An HTTP server that reads and writes its connections from an event loop.
+
+HTTPServer gives each connection to a child (or a request thread) until the
+client is done with it, so a few hundred idle keep-alive connections or slow
+uploads can tie up every worker on a box. Here each child runs a poll loop
+over all of its connections - parsing request heads, reading bodies and
+sending responses without blocking - and hands complete requests to a small
+pool of application threads that run the WSGI app. An idle connection costs a
+dict entry and a file descriptor.
+
+There is no asyncio in python2, so the loop is plain epoll (poll where there
+is no epoll) and the applications are plain WSGI. Everything else is
+HTTPServer - binding, the fd_server handoff, reuse_port and accept_mutex -
+and ManagedServer still runs the init and exit functions, max_requests,
+memory policing, profiling and the management server.
+"""
+
+import BaseHTTPServer
+import Queue
+import cgi
+import errno
+import logging
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+from wsgiref import handlers
+
+from wiseguy import http_server
+from wiseguy import managed_server
+from wiseguy import preforking
+
+POLLIN = select.POLLIN
+POLLOUT = select.POLLOUT
+POLLERR = select.POLLERR
+POLLHUP = select.POLLHUP
+
+# where a chunked body is between chunks
+CHUNK_SIZE = 0
+CHUNK_END = 1
+CHUNK_TRAILER = 2
+max_chunk_line = 1024
+
+
+def find_head_end(data):
+  """Return (offset, length) of the blank line that ends the request head
+  in data, (-1, 0) if it isn't all there yet.
+
+  Lines can end in a bare LF as well as CRLF, like parse_headers allows."""
+  end = -1
+  length = 0
+  for terminator in ('\n\n', '\n\r\n'):
+    offset = data.find(terminator)
+    if offset >= 0 and (end < 0 or offset < end):
+      end = offset
+      length = len(terminator)
+  return end, length
+
+
+class BadRequest(Exception):
+  def __init__(self, code, message=None):
+    Exception.__init__(self, code, message)
+    self.code = code
+    self.message = message
+
+
+class Poller(object):
+  """epoll, or poll where there is no epoll, with the timeout in seconds."""
+  def __init__(self):
+    if hasattr(select, 'epoll'):
+      self._poller = select.epoll()
+      self._scale = 1
+    else:
+      self._poller = select.poll()
+      self._scale = 1000
+    self.register = self._poller.register
+    self.modify = self._poller.modify
+    self.unregister = self._poller.unregister
+
+  def poll(self, timeout):
+    try:
+      return self._poller.poll(timeout * self._scale)
+    except (select.error, IOError), e:
+      if e[0] == errno.EINTR:
+        return []
+      raise
+
+
+class RequestBody(tempfile.SpooledTemporaryFile):
+  """wsgi.input - the body has been read by the time the application runs.
+
+  Has readinto and iter_blocks like http_server.SocketFileWrapper."""
+  block_size = http_server.SocketFileWrapper.block_size
+
+  def readinto(self, buffer):
+    data = self.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+  def iter_blocks(self, block_size=None):
+    block_size = block_size or self.block_size
+    while True:
+      data = self.read(block_size)
+      if not data:
+        return
+      yield data
+
+
+class EventWSGIHandler(http_server.WiseguyWSGIHandler):
+  """WiseguyWSGIHandler writing to an EventRequest instead of a socket."""
+
+  def sendfile(self):
+    # the socket belongs to the event loop
+    return False
+
+
+class EventRequest(object):
+  """One request read off a connection.
+
+  This is also the request_handler and the stdout the WSGI handler sees
+  while the application runs in an application thread."""
+  debug = False
+
+  def __init__(self, server, connection, head):
+    """Parse the request line and headers in head the way
+    WiseguyRequestHandler does, raise BadRequest if they don't make sense."""
+    self.server = server
+    self.connection = connection
+    self.client_address = connection.client_address
+    self.start_time = time.time()
+    self.environ = None
+    self.body = None
+    self.body_done = False
+    self._chunked = False
+    self._chunk_state = CHUNK_SIZE
+    self._remaining = 0
+    self._body_size = 0
+    self._max_body_size = None
+
+    lines = head.split('\n')
+    self.raw_requestline = lines[0] + '\n'
+    requestline = lines[0].rstrip('\r')
+    if len(requestline) > http_server.max_header_line:
+      raise BadRequest(414)
+    words = requestline.split()
+    if len(words) != 3:
+      raise BadRequest(400, 'Bad request syntax (%r)' % requestline)
+    self.command, self.path, version = words
+    self.request_version = version
+    self.close_connection = True
+    if version == 'HTTP/1.1':
+      self.close_connection = False
+    elif version != 'HTTP/1.0':
+      try:
+        if version[:5] != 'HTTP/':
+          raise ValueError
+        version_number = version[5:].split('.')
+        if len(version_number) != 2:
+          raise ValueError
+        version_number = int(version_number[0]), int(version_number[1])
+      except ValueError:
+        raise BadRequest(400, 'Bad request version (%r)' % version)
+      if version_number >= (2, 0):
+        raise BadRequest(505, 'Invalid HTTP Version (%s)' % version[5:])
+      if version_number >= (1, 1):
+        self.close_connection = False
+
+    headers = self.headers = http_server.RequestHeaders()
+    environ = self.header_environ = {}
+    if len(lines) > http_server.max_header_count + 1:
+      raise BadRequest(400, 'Too many headers')
+    environ_key = None
+    for line in lines[1:]:
+      if len(line) > http_server.max_header_line:
+        raise BadRequest(400, 'Header line too long')
+      if line[:1] in (' ', '\t'):
+        # continuation of the previous header
+        if environ_key is None:
+          continue
+        value = ' ' + line.strip()
+        environ[environ_key] += value
+        headers[name] += value
+        continue
+      name, sep, value = line.partition(':')
+      if not sep:
+        break
+      value = value.strip()
+      environ_key = http_server.get_environ_key(name)
+      name = name.lower()
+      if environ_key in environ:
+        environ[environ_key] += ',' + value
+        headers[name] += ',' + value
+      else:
+        environ[environ_key] = value
+        headers[name] = value
+
+    conntype = headers.get('connection', '').lower()
+    if conntype == 'close':
+      self.close_connection = True
+    elif conntype == 'keep-alive':
+      self.close_connection = False
+
+  @property
+  def http_version(self):
+    return self.request_version.split('/')[-1]
+
+  def begin_body(self, max_body_size, spool_size):
+    """Work out how the body is framed. Raises RequestEntityTooLarge if the
+    declared length is over max_body_size, ValueError for a bogus one.
+
+    Returns True if the client is waiting for a 100 Continue."""
+    self.body = RequestBody(spool_size)
+    self._max_body_size = max_body_size
+    transfer_encoding = self.headers.get('transfer-encoding', '')
+    if transfer_encoding.lower().endswith('chunked'):
+      self._chunked = True
+    else:
+      content_length = int(self.headers.get('content-length') or 0)
+      if content_length < 0:
+        raise ValueError('negative Content-Length')
+      if max_body_size is not None and content_length > max_body_size:
+        raise http_server.RequestEntityTooLarge(
+          'request body too large: %s' % content_length)
+      self._remaining = content_length
+      if not content_length:
+        self.body_done = True
+    return (not self.body_done and self.request_version == 'HTTP/1.1' and
+            self.headers.get('expect', '').lower() == '100-continue')
+
+  def read_body(self, data):
+    """Move as much of the body as data holds into body, return how many
+    bytes of data were used. body_done is set once it is all there.
+
+    Raises ValueError for broken chunked framing and RequestEntityTooLarge
+    past max_body_size."""
+    offset = 0
+    while not self.body_done:
+      if self._remaining:
+        part = data[offset:offset + self._remaining]
+        if not part:
+          break
+        self._add_body(part)
+        offset += len(part)
+        self._remaining -= len(part)
+        if not self._remaining and not self._chunked:
+          self.body_done = True
+        continue
+      end = data.find('\n', offset)
+      if end < 0:
+        if len(data) - offset > max_chunk_line:
+          raise ValueError('chunk line too long')
+        break
+      line = data[offset:end + 1]
+      offset = end + 1
+      if self._chunk_state == CHUNK_SIZE:
+        size = int(line.split(';', 1)[0].strip(), 16)
+        if size < 0:
+          raise ValueError('bad chunk size: %r' % line[:80])
+        if size:
+          self._remaining = size
+          self._chunk_state = CHUNK_END
+        else:
+          self._chunk_state = CHUNK_TRAILER
+      elif self._chunk_state == CHUNK_END:
+        # the CRLF after the chunk
+        self._chunk_state = CHUNK_SIZE
+      elif line in ('\r\n', '\n'):
+        # the blank line after the trailers
+        self.body_done = True
+    return offset
+
+  def _add_body(self, data):
+    self._body_size += len(data)
+    if (self._max_body_size is not None and
+        self._body_size > self._max_body_size):
+      raise http_server.RequestEntityTooLarge(
+        'request body too large: %s' % self._body_size)
+    self.body.write(data)
+
+  def get_environ(self, base_environ):
+    env = base_environ.copy()
+    env.update(self.header_environ)
+    env['SERVER_PROTOCOL'] = self.request_version
+    env['REQUEST_METHOD'] = self.command
+    path, sep, query = self.path.partition('?')
+    if '%' in path:
+      path = urllib.unquote(path)
+    env['PATH_INFO'] = path
+    env['QUERY_STRING'] = query
+    env['REMOTE_ADDR'] = self.client_address[0]
+    if 'CONTENT_TYPE' not in env:
+      env['CONTENT_TYPE'] = 'text/plain'
+    if self._chunked:
+      # the body has been read already, so the length is known
+      env['CONTENT_LENGTH'] = str(self._body_size)
+    return env
+
+  # the request_handler and stdout of EventWSGIHandler, called from the
+  # application thread
+
+  def write(self, data):
+    self.server.queue_output(self.connection, data)
+
+  def flush(self):
+    self.server.wakeup()
+
+  def log_request(self, code='-', size='-'):
+    pass
+
+
+class EventConnection(object):
+  """A client connection and where the event loop is with it."""
+  def __init__(self, sock, client_address, deadline):
+    self.socket = sock
+    self.fd = sock.fileno()
+    self.client_address = client_address
+    # bytes read but not parsed yet, possibly the next pipelined request
+    self.input = ''
+    # the request being read or served. requests on a connection are served
+    # one at a time, in order.
+    self.request = None
+    # False while the request is with the application
+    self.reading = True
+    # when the connection is closed if nothing happens, None while the
+    # application is working on a response
+    self.deadline = deadline
+    self.events = POLLIN
+    self.closed = False
+    self.request_count = 0
+    # these are shared with the application thread, under the server's
+    # _output_condition. pending_size counts output until it's been sent.
+    self.pending = []
+    self.pending_size = 0
+    self.response_done = False
+    self.close_after_response = False
+    # what the loop is in the middle of sending
+    self.output = ''
+
+
+class EventHTTPServer(http_server.HTTPServer):
+  # SocketServer's default of 5 is for servers that accept one at a time
+  request_queue_size = socket.SOMAXCONN
+  # most connections a child holds open, past that it stops accepting
+  max_connections = 4096
+  # most connections accepted in one go from a reuse_port socket
+  max_accepts = 64
+  # how long a connection can sit between requests
+  keepalive_timeout = http_server.WiseguyRequestHandler.keepalive_timeout
+  # how long a client has to make progress sending a request or reading a
+  # response
+  request_timeout = 30.0
+  # largest request line plus headers
+  max_head_size = 64 * 1024
+  read_size = 64 * 1024
+  # request bodies bigger than this go to a temporary file
+  body_spool_size = 1024 * 1024
+  # an application thread waits once a connection has this much unsent
+  max_pending_output = 256 * 1024
+  # how long an exiting child keeps serving the requests it has started
+  drain_timeout = 5.0
+  # the longest the loop waits, so timeouts and recycle requests are noticed
+  poll_interval = 1.0
+
+  def __init__(self, *pargs, **kargs):
+    """app_threads - threads running the WSGI application in each child.
+      connections are read and written by the event loop, so this bounds
+      the requests being served at once, not the connections held open.
+
+    A child with open connections must never block in accept(), so this
+    turns on accept_mutex unless reuse_port is set. keepalive_parking and
+    threads don't apply, every connection is parked here."""
+    kargs = kargs.copy()
+    self._app_threads = max(1, kargs.pop('app_threads', 8))
+    kargs.pop('keepalive_parking', None)
+    if kargs.get('threads', 1) > 1:
+      logging.warning('the event loop has its own app_threads, '
+                      'ignoring threads')
+      kargs['threads'] = 1
+    if not kargs.get('reuse_port'):
+      kargs['accept_mutex'] = True
+    # fd -> EventConnection, only touched by the loop
+    self._connections = {}
+    self._event_poller = None
+    self._event_listen_fd = None
+    self._listening = False
+    self._app_queue = None
+    self._next_expiry = 0
+    # guards the output side of every connection, _output_ready and
+    # _in_flight between the loop and the application threads
+    self._output_condition = threading.Condition()
+    # connections with output or a finished response for the loop
+    self._output_ready = set()
+    self._in_flight = 0
+    http_server.HTTPServer.__init__(self, *pargs, **kargs)
+
+  def server_activate(self):
+    http_server.HTTPServer.server_activate(self)
+    if not self._reuse_port and self._accept_lock_file is None:
+      # reuse_port was asked for but couldn't be honored
+      self._accept_lock_file = tempfile.TemporaryFile(prefix='wiseguy-accept-')
+
+  def set_listen_socket(self, sock):
+    http_server.HTTPServer.set_listen_socket(self, sock)
+    # this socket belongs to this child alone, so it can be non-blocking.
+    # the shared one is guarded by the accept lock instead.
+    sock.setblocking(0)
+
+  def init_child(self):
+    http_server.HTTPServer.init_child(self)
+    self.init_wakeup_fd()
+    self._event_poller = Poller()
+    self._event_poller.register(self._wakeup_rfd, POLLIN)
+    self._event_listen_fd = self.socket.fileno()
+    self._app_queue = Queue.Queue()
+    for i in xrange(self._app_threads):
+      app_thread = threading.Thread(target=self._app_thread, name='app-%s' % i)
+      app_thread.setDaemon(True)
+      app_thread.start()
+
+  # the event loop
+
+  def handle_request(self):
+    """Run the event loop once - wait up to poll_interval for connections,
+    requests and responses and deal with whatever came up.
+
+    Like the other servers, only the child holding the accept lock watches
+    the listening socket. A child that has connections never blocks on the
+    lock, it keeps serving them and tries again in a moment. A child that
+    is already running a request in every application thread stops
+    accepting so the others get the new connections."""
+    listening = False
+    if (not self._quit and len(self._connections) < self.max_connections and
+        self._in_flight < self._app_threads):
+      if self._connections:
+        listening = self.acquire_accept_lock(blocking=False)
+      elif not self.acquire_accept_lock():
+        return
+      else:
+        listening = True
+    try:
+      self.set_listening(listening)
+      timeout = self.poll_interval
+      if not listening and self._connections and not self._quit:
+        timeout = self.accept_lock_retry_interval
+      self.run_once(timeout)
+    finally:
+      self.release_accept_lock()
+
+  def set_listening(self, listening):
+    if listening == self._listening:
+      return
+    if listening:
+      self._event_poller.register(self._event_listen_fd, POLLIN)
+    else:
+      self._event_poller.unregister(self._event_listen_fd)
+    self._listening = listening
+
+  def run_once(self, timeout):
+    for fd, event in self._event_poller.poll(timeout):
+      if fd == self._wakeup_rfd:
+        self.drain_wakeup_fd()
+      elif fd == self._event_listen_fd:
+        if self._listening:
+          self.accept_connections()
+      else:
+        connection = self._connections.get(fd)
+        if connection is None:
+          continue
+        if event & POLLOUT:
+          self.write_connection(connection)
+        if event & POLLIN:
+          if not connection.closed:
+            self.read_connection(connection)
+        elif event & (POLLERR | POLLHUP):
+          self.close_connection(connection)
+    self.write_ready_connections()
+    self.expire_connections()
+
+  def accept_connections(self):
+    if self._reuse_port:
+      accepts = self.max_accepts
+    else:
+      # the shared socket blocks, it's only safe to accept once per poll
+      accepts = 1
+    for i in xrange(accepts):
+      if len(self._connections) >= self.max_connections:
+        break
+      try:
+        sock, client_address = self.socket.accept()
+      except socket.error, e:
+        if e[0] not in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+          logging.warning('accept failed: %s', e)
+        break
+      sock.setblocking(0)
+      try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      except socket.error:
+        pass
+      connection = EventConnection(
+        sock, client_address, time.time() + self.keepalive_timeout)
+      self._connections[connection.fd] = connection
+      self._event_poller.register(connection.fd, POLLIN)
+
+  def set_events(self, connection, events):
+    if connection.events != events and not connection.closed:
+      self._event_poller.modify(connection.fd, events)
+      connection.events = events
+
+  def read_connection(self, connection):
+    try:
+      data = connection.socket.recv(self.read_size)
+    except socket.error, e:
+      if e[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      logging.debug('%s read failed: %s', connection.client_address[0], e)
+      data = ''
+    if not data:
+      self.close_connection(connection)
+      return
+    connection.input += data
+    connection.deadline = time.time() + self.request_timeout
+    self.process_input(connection)
+
+  def process_input(self, connection):
+    """Parse what has been read so far, hand the request over once it's all
+    there."""
+    request = connection.request
+    if request is None:
+      input = connection.input.lstrip('\r\n')
+      end, terminator_length = find_head_end(input)
+      if end < 0:
+        connection.input = input
+        if len(input) > self.max_head_size:
+          self.send_error(connection, 400, 'Request header too large')
+        return
+      head = input[:end]
+      connection.input = input[end + terminator_length:]
+      try:
+        request = EventRequest(self, connection, head)
+      except BadRequest, e:
+        self.send_error(connection, e.code, e.message)
+        return
+      connection.request = request
+      try:
+        expect_continue = request.begin_body(
+          self.max_body_size, self.body_spool_size)
+      except http_server.RequestEntityTooLarge:
+        self.send_error(connection, 413)
+        return
+      except ValueError:
+        self.send_error(connection, 400, 'Bad Content-Length')
+        return
+      if expect_continue and not connection.input:
+        self.queue_output(connection, 'HTTP/1.1 100 Continue\r\n\r\n',
+                          wait=False)
+        self.write_connection(connection)
+    if not request.body_done and connection.input:
+      try:
+        used = request.read_body(connection.input)
+      except http_server.RequestEntityTooLarge:
+        self.send_error(connection, 413)
+        return
+      except ValueError, e:
+        self.send_error(connection, 400, str(e))
+        return
+      connection.input = connection.input[used:]
+    if request.body_done:
+      self.dispatch(connection, request)
+
+  def dispatch(self, connection, request):
+    request.body.seek(0)
+    request.environ = request.get_environ(self.base_environ)
+    connection.reading = False
+    connection.deadline = None
+    self.set_events(connection, 0)
+    self._output_condition.acquire()
+    try:
+      self._in_flight += 1
+    finally:
+      self._output_condition.release()
+    self._app_queue.put(request)
+
+  def queue_output(self, connection, data, wait=True):
+    """Hand data to the loop to send on connection.
+
+    Called from the application threads, which wait while the connection
+    has max_pending_output unsent. Raises IOError if the client is gone."""
+    condition = self._output_condition
+    condition.acquire()
+    try:
+      while (wait and not connection.closed and
+             connection.pending_size > self.max_pending_output):
+        self.wakeup()
+        condition.wait()
+      if connection.closed:
+        raise IOError('Write failed', 'connection closed')
+      connection.pending.append(data)
+      connection.pending_size += len(data)
+      self._output_ready.add(connection)
+    finally:
+      condition.release()
+
+  def end_response(self, connection, close_connection):
+    """Called from the application thread once the response is complete."""
+    self._output_condition.acquire()
+    try:
+      connection.response_done = True
+      if close_connection:
+        connection.close_after_response = True
+      self._in_flight -= 1
+      self._output_ready.add(connection)
+    finally:
+      self._output_condition.release()
+    self.wakeup()
+
+  def write_ready_connections(self):
+    self._output_condition.acquire()
+    try:
+      ready = self._output_ready
+      self._output_ready = set()
+    finally:
+      self._output_condition.release()
+    for connection in ready:
+      if not connection.closed:
+        self.write_connection(connection)
+
+  def write_connection(self, connection):
+    """Send as much of the output as the socket takes in one send."""
+    condition = self._output_condition
+    condition.acquire()
+    try:
+      if connection.pending:
+        connection.output += ''.join(connection.pending)
+        del connection.pending[:]
+      response_done = connection.response_done
+    finally:
+      condition.release()
+    output = connection.output
+    sent = 0
+    if output:
+      try:
+        sent = connection.socket.send(output)
+      except socket.error, e:
+        if e[0] not in (errno.EAGAIN, errno.EINTR):
+          logging.debug('%s write failed: %s', connection.client_address[0], e)
+          self.close_connection(connection)
+          return
+      if sent:
+        connection.output = output[sent:]
+        condition.acquire()
+        try:
+          connection.pending_size -= sent
+          condition.notifyAll()
+        finally:
+          condition.release()
+    if connection.reading:
+      # a 100 Continue, the request body is still on its way
+      if connection.output:
+        self.set_events(connection, POLLIN | POLLOUT)
+      else:
+        self.set_events(connection, POLLIN)
+    elif connection.output:
+      if sent or connection.deadline is None:
+        connection.deadline = time.time() + self.request_timeout
+      self.set_events(connection, POLLOUT)
+    elif response_done:
+      self.finish_response(connection)
+    else:
+      connection.deadline = None
+      self.set_events(connection, 0)
+
+  def finish_response(self, connection):
+    """The response has been sent, go on to the next request."""
+    request = connection.request
+    connection.request = None
+    connection.response_done = False
+    connection.request_count += 1
+    if (connection.close_after_response or request is None or
+        self._quit):
+      self.close_connection(connection)
+      return
+    connection.reading = True
+    self.set_events(connection, POLLIN)
+    if connection.input:
+      # a pipelined request
+      connection.deadline = time.time() + self.request_timeout
+      self.process_input(connection)
+    else:
+      connection.deadline = time.time() + self.keepalive_timeout
+
+  def send_error(self, connection, code, message=None):
+    """Answer a request the application will never see and close."""
+    short, explain = BaseHTTPServer.BaseHTTPRequestHandler.responses.get(
+      code, ('???', ''))
+    body = BaseHTTPServer.DEFAULT_ERROR_MESSAGE % {
+      'code': code,
+      'message': cgi.escape(message or short),
+      'explain': explain,
+      }
+    request = connection.request
+    if request is not None and request.body is not None:
+      request.body.close()
+    connection.request = None
+    connection.reading = False
+    connection.input = ''
+    self.set_events(connection, 0)
+    self.queue_output(connection, ''.join([
+      'HTTP/1.1 %d %s\r\n' % (code, short),
+      'Server: %s\r\n' % http_server.WiseguyWSGIHandler.server_software,
+      'Date: %s\r\n' % handlers.format_date_time(time.time()),
+      'Content-Type: %s\r\n' % BaseHTTPServer.DEFAULT_ERROR_CONTENT_TYPE,
+      'Content-Length: %d\r\n' % len(body),
+      'Connection: close\r\n\r\n',
+      body]), wait=False)
+    connection.response_done = True
+    connection.close_after_response = True
+    self.write_connection(connection)
+
+  def expire_connections(self):
+    now = time.time()
+    if now < self._next_expiry:
+      return
+    self._next_expiry = now + self.poll_interval
+    for connection in self._connections.values():
+      if connection.deadline is not None and connection.deadline < now:
+        logging.debug('%s connection timed out',
+                      connection.client_address[0])
+        self.close_connection(connection)
+
+  def close_connection(self, connection):
+    if connection.closed:
+      return
+    self._output_condition.acquire()
+    try:
+      connection.closed = True
+      # let go of an application thread waiting to write
+      self._output_condition.notifyAll()
+    finally:
+      self._output_condition.release()
+    del self._connections[connection.fd]
+    try:
+      self._event_poller.unregister(connection.fd)
+    except (IOError, OSError, KeyError, ValueError):
+      pass
+    try:
+      connection.socket.close()
+    except socket.error:
+      pass
+    request = connection.request
+    if connection.reading and request is not None and request.body is not None:
+      # never got to the application
+      request.body.close()
+
+  def drain_requests(self):
+    """Stop accepting and close the idle keep-alive connections, then keep
+    going until the requests that have been started are answered or
+    drain_timeout is up.
+
+    A connection that hasn't sent its first request yet is kept too, the
+    client has no reason to expect it to be closed under it."""
+    self.set_listening(False)
+    deadline = time.time() + self.drain_timeout
+    while True:
+      for connection in self._connections.values():
+        if (connection.reading and connection.request is None and
+            not connection.input and connection.request_count):
+          self.close_connection(connection)
+      timeout = deadline - time.time()
+      if not self._connections or timeout <= 0:
+        break
+      self.run_once(min(timeout, self.poll_interval))
+    for connection in self._connections.values():
+      self.close_connection(connection)
+    for i in xrange(self._app_threads):
+      self._app_queue.put(None)
+
+  # the application threads
+
+  def _app_thread(self):
+    while True:
+      request = self._app_queue.get()
+      if request is None:
+        return
+      try:
+        self.serve_request(request)
+      except:
+        logging.exception('application thread error')
+
+  def serve_request(self, request):
+    """Run the application for request and wrap up the response."""
+    try:
+      managed_server.ManagedServer.process_request(
+        self, request, request.client_address)
+    finally:
+      request.body.close()
+      self.end_response(request.connection, request.close_connection)
+    managed_server.ManagedServer.close_request(self, request)
+    if self._quit:
+      # get the loop out of poll so the child can exit
+      self.wakeup()
+
+  def finish_request(self, request, client_address):
+    handler = EventWSGIHandler(
+      request.body, request, sys.stderr, request.environ)
+    # NOTE: handy backpointer, but gc problem?
+    handler.request_handler = request
+    handler.run(self.get_app())
+    handler.request_handler = None
+
+  def handle_error(self, request, client_address):
+    logging.exception('error serving "%s"', request.raw_requestline)
+    request.close_connection = True
+
+
+class PreForkingEventWSGIServer(preforking.PreForkingMixIn, EventHTTPServer):
+  def __init__(self, app, *pargs, **kargs):
+    EventHTTPServer.__init__(self, *pargs, **kargs)
+    self.set_app(app)
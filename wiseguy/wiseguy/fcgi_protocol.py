@@ -0,0 +1,359 @@
+"""A pure python FastCGI responder that can multiplex requests.
+
+libfcgi (and so fastcgi.fcgi) answers FCGI_GET_VALUES with FCGI_MPXS_CONNS=0
+and turns away a second request on a connection that is already busy, so the
+web server pays for a connect() and the worker for an accept() on every
+request. This speaks the record protocol itself - connections stay open for
+as long as the web server wants them (FCGI_KEEP_CONN) and requests with
+different ids can be interleaved on them. FCGIServer reads records as they
+arrive and runs each request once its params and stdin are complete.
+
+Request looks enough like fcgi.Request (environ, stdin, stdout, stderr) for
+WSGIMixIn.handle.
+"""
+
+import errno
+import logging
+import socket
+import struct
+import tempfile
+import time
+
+FCGI_VERSION_1 = 1
+
+# record types
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_NULL_REQUEST_ID = 0
+FCGI_RESPONDER = 1
+FCGI_KEEP_CONN = 1
+
+# protocol status of FCGI_END_REQUEST
+FCGI_REQUEST_COMPLETE = 0
+FCGI_CANT_MPX_CONN = 1
+FCGI_OVERLOADED = 2
+FCGI_UNKNOWN_ROLE = 3
+
+HEADER_FORMAT = '!BBHHBx'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+BEGIN_REQUEST_FORMAT = '!HB5x'
+END_REQUEST_FORMAT = '!IB3x'
+UNKNOWN_TYPE_FORMAT = '!B7x'
+# the largest record body, rounded down to a multiple of 8 so full records
+# don't need padding
+MAX_CONTENT_SIZE = 65528
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def encode_record(record_type, request_id, content=''):
+  length = len(content)
+  padding = -length & 7
+  return ''.join((struct.pack(HEADER_FORMAT, FCGI_VERSION_1, record_type,
+                              request_id, length, padding),
+                  content, '\0' * padding))
+
+def encode_stream(record_type, request_id, data):
+  """Split data into as many records as it takes."""
+  return ''.join([
+    encode_record(record_type, request_id, data[i:i + MAX_CONTENT_SIZE])
+    for i in xrange(0, len(data), MAX_CONTENT_SIZE)])
+
+def _encode_length(length):
+  if length < 128:
+    return chr(length)
+  return struct.pack('!I', length | 0x80000000)
+
+def encode_name_value_pairs(pairs):
+  return ''.join([_encode_length(len(name)) + _encode_length(len(value)) +
+                  name + value for name, value in pairs])
+
+def decode_name_value_pairs(data):
+  pairs = []
+  offset = 0
+  try:
+    while offset < len(data):
+      lengths = []
+      for i in (0, 1):
+        if ord(data[offset]) & 0x80:
+          lengths.append(
+            struct.unpack_from('!I', data, offset)[0] & 0x7fffffff)
+          offset += 4
+        else:
+          lengths.append(ord(data[offset]))
+          offset += 1
+      name_length, value_length = lengths
+      name = data[offset:offset + name_length]
+      offset += name_length
+      value = data[offset:offset + value_length]
+      offset += value_length
+      if offset > len(data):
+        raise ProtocolError('truncated name-value pair')
+      pairs.append((name, value))
+  except (IndexError, struct.error):
+    raise ProtocolError('truncated name-value pair')
+  return pairs
+
+
+class OutputStream(object):
+  """FCGI_STDOUT or FCGI_STDERR of one request, buffered until flush()."""
+  def __init__(self, request, record_type):
+    self._request = request
+    self._record_type = record_type
+    self._buffer = []
+    self._buffer_size = 0
+    # something was sent, so the stream has to be closed with an empty record
+    self.used = False
+
+  def write(self, data):
+    if not data:
+      return
+    self._buffer.append(data)
+    self._buffer_size += len(data)
+    if self._buffer_size >= MAX_CONTENT_SIZE:
+      self.flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def get_records(self):
+    """Return the buffered data as records and empty the buffer."""
+    if not self._buffer:
+      return ''
+    self.used = True
+    data = ''.join(self._buffer)
+    del self._buffer[:]
+    self._buffer_size = 0
+    return encode_stream(self._record_type, self._request.request_id, data)
+
+  def flush(self):
+    self._request.connection.send(self.get_records())
+
+
+class Request(object):
+  def __init__(self, connection, request_id, keep_conn, stdin_spool_size):
+    self.connection = connection
+    self.request_id = request_id
+    self.keep_conn = keep_conn
+    self.environ = {}
+    # bodies bigger than stdin_spool_size go to a temporary file
+    self.stdin = tempfile.SpooledTemporaryFile(stdin_spool_size)
+    self.stdout = OutputStream(self, FCGI_STDOUT)
+    self.stderr = OutputStream(self, FCGI_STDERR)
+    self.aborted = False
+    self.queued = False
+    self.finished = False
+    self.params_done = False
+    self.stdin_done = False
+    self._params = []
+
+  @property
+  def ready(self):
+    return self.params_done and self.stdin_done
+
+  def add_params(self, content):
+    if self.params_done:
+      raise ProtocolError('params after the end of params')
+    if content:
+      self._params.append(content)
+    else:
+      self.environ = dict(decode_name_value_pairs(''.join(self._params)))
+      self._params = None
+      self.params_done = True
+
+  def add_stdin(self, content):
+    if self.stdin_done:
+      raise ProtocolError('stdin after the end of stdin')
+    if content:
+      self.stdin.write(content)
+    else:
+      self.stdin.seek(0)
+      self.stdin_done = True
+
+  def finish(self, app_status=0, protocol_status=FCGI_REQUEST_COMPLETE):
+    """Send what is left of the output and FCGI_END_REQUEST in one write."""
+    if self.finished:
+      return
+    self.finished = True
+    self.stdin.close()
+    records = [self.stdout.get_records(), self.stderr.get_records()]
+    # close the streams
+    records.append(encode_record(FCGI_STDOUT, self.request_id))
+    if self.stderr.used:
+      records.append(encode_record(FCGI_STDERR, self.request_id))
+    records.append(encode_record(
+      FCGI_END_REQUEST, self.request_id,
+      struct.pack(END_REQUEST_FORMAT, app_status, protocol_status)))
+    self.connection.end_request(self, ''.join(records))
+
+
+class Connection(object):
+  """One connection from the web server and the requests in flight on it."""
+  read_size = 64 * 1024
+
+  def __init__(self, sock, values, max_requests, stdin_spool_size):
+    """values - the answers to FCGI_GET_VALUES
+    max_requests - requests in flight before new ones get FCGI_OVERLOADED"""
+    self.socket = sock
+    self.values = values
+    self.max_requests = max_requests
+    self.stdin_spool_size = stdin_spool_size
+    # request id -> Request, for requests that haven't been finished
+    self.requests = {}
+    self.closed = False
+    self.last_activity = time.time()
+    self._input = ''
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def read(self):
+    """Read whatever is available, return the requests it completed."""
+    try:
+      data = self.socket.recv(self.read_size)
+    except socket.error, e:
+      if e[0] in (errno.EINTR, errno.EAGAIN):
+        return []
+      logging.debug('fastcgi connection read failed: %s', e)
+      data = ''
+    if not data:
+      self.close()
+      return []
+    self.last_activity = time.time()
+    data = self._input + data
+    ready = []
+    offset = 0
+    try:
+      while len(data) - offset >= HEADER_SIZE:
+        version, record_type, request_id, length, padding = (
+          struct.unpack_from(HEADER_FORMAT, data, offset))
+        if version != FCGI_VERSION_1:
+          raise ProtocolError('unsupported version %s' % version)
+        end = offset + HEADER_SIZE + length + padding
+        if end > len(data):
+          break
+        request = self.handle_record(
+          record_type, request_id,
+          data[offset + HEADER_SIZE:offset + HEADER_SIZE + length])
+        offset = end
+        if request is not None:
+          ready.append(request)
+    except ProtocolError, e:
+      logging.warning('fastcgi protocol error, closing connection: %s', e)
+      self.close()
+      return []
+    except IOError, e:
+      # a reply to a management record failed, the connection is gone
+      return []
+    self._input = data[offset:]
+    return ready
+
+  def handle_record(self, record_type, request_id, content):
+    """Return the request if this record completed it."""
+    if request_id == FCGI_NULL_REQUEST_ID:
+      if record_type == FCGI_GET_VALUES:
+        self.send(encode_record(
+          FCGI_GET_VALUES_RESULT, FCGI_NULL_REQUEST_ID,
+          encode_name_value_pairs([
+            (name, self.values[name])
+            for name, value in decode_name_value_pairs(content)
+            if name in self.values])))
+      else:
+        self.send(encode_record(
+          FCGI_UNKNOWN_TYPE, FCGI_NULL_REQUEST_ID,
+          struct.pack(UNKNOWN_TYPE_FORMAT, record_type)))
+      return None
+
+    if record_type == FCGI_BEGIN_REQUEST:
+      if request_id in self.requests:
+        raise ProtocolError('duplicate request id %s' % request_id)
+      try:
+        role, flags = struct.unpack(BEGIN_REQUEST_FORMAT, content)
+      except struct.error:
+        raise ProtocolError('bad FCGI_BEGIN_REQUEST')
+      if role != FCGI_RESPONDER:
+        protocol_status = FCGI_UNKNOWN_ROLE
+      elif len(self.requests) >= self.max_requests:
+        protocol_status = FCGI_OVERLOADED
+      else:
+        self.requests[request_id] = Request(
+          self, request_id, flags & FCGI_KEEP_CONN, self.stdin_spool_size)
+        return None
+      self.send(encode_record(
+        FCGI_END_REQUEST, request_id,
+        struct.pack(END_REQUEST_FORMAT, 0, protocol_status)))
+      return None
+
+    request = self.requests.get(request_id)
+    if request is None:
+      # the rest of a request that was turned away or already finished
+      return None
+    if record_type == FCGI_PARAMS:
+      request.add_params(content)
+    elif record_type == FCGI_STDIN:
+      request.add_stdin(content)
+    elif record_type == FCGI_ABORT_REQUEST:
+      request.aborted = True
+      if not request.queued:
+        # the application never saw it, just end it
+        request.finish()
+      return None
+    elif record_type == FCGI_DATA:
+      # only used by the filter role
+      return None
+    else:
+      raise ProtocolError('unexpected record type %s' % record_type)
+
+    if request.ready and not request.queued:
+      request.queued = True
+      return request
+    return None
+
+  def send(self, data):
+    if self.closed:
+      raise IOError('Write failed', 'connection closed')
+    if not data:
+      return
+    try:
+      self.socket.sendall(data)
+    except socket.error, e:
+      logging.debug('fastcgi connection write failed: %s', e)
+      self.close()
+      raise IOError('Write failed', e)
+
+  def end_request(self, request, data):
+    if self.requests.get(request.request_id) is request:
+      del self.requests[request.request_id]
+    self.last_activity = time.time()
+    try:
+      self.send(data)
+    finally:
+      if not request.keep_conn:
+        # without FCGI_KEEP_CONN, closing the connection ends the response
+        self.close()
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    for request in self.requests.itervalues():
+      request.finished = True
+      request.stdin.close()
+    self.requests.clear()
+    try:
+      self.socket.close()
+    except socket.error:
+      pass
@@ -1,9 +1,12 @@
+import collections
 import errno
 import logging
 import os
+import select
 import socket
 import stat
 import sys
+import time
 
 from fastcgi import fcgi
 try:
@@ -11,10 +14,49 @@ try:
 except ImportError:
   # fd_server is python2.6 only
   fd_server = None
+from wiseguy import fcgi_protocol
 from wiseguy import managed_server
 
 
 class FCGIServer(managed_server.ManagedServer):
+  # multiplexed mode - the most connections a child keeps open and the most
+  # requests in flight on each of them, advertised through FCGI_GET_VALUES
+  max_connections = 32
+  max_connection_requests = 16
+  # close connections the web server has left idle this long
+  connection_idle_timeout = 60.0
+  # request bodies bigger than this are spooled to a temporary file
+  stdin_spool_size = 1024 * 1024
+  # how long an exiting child keeps serving requests already in flight
+  drain_timeout = 5.0
+  accept_lock_retry_interval = 0.1
+
+  def __init__(self, multiplexed=False, **kargs):
+    """multiplexed - speak FastCGI in python instead of through libfcgi, so
+      the web server can keep connections open and interleave requests on
+      them (FCGI_MPXS_CONNS). a child with open connections must never
+      block in accept(), so this turns on accept_mutex unless reuse_port
+      is set."""
+    self._multiplexed = multiplexed
+    self._fcgi_request = None
+    self._accept_socket = None
+    # fd -> fcgi_protocol.Connection
+    self._connections = {}
+    self._ready_requests = collections.deque()
+    self._fcgi_values = {
+      'FCGI_MAX_CONNS': str(self.max_connections),
+      'FCGI_MAX_REQS': str(self.max_connections *
+                           self.max_connection_requests),
+      'FCGI_MPXS_CONNS': '1',
+      }
+    if multiplexed and not kargs.get('reuse_port'):
+      kargs['accept_mutex'] = True
+    if multiplexed and kargs.get('threads', 1) > 1:
+      logging.warning('multiplexed connections are served by one thread, '
+                      'ignoring threads')
+      kargs['threads'] = 1
+    super(FCGIServer, self).__init__(**kargs)
+
   @property
   def server_address(self):
     return self._server_address
@@ -43,12 +85,12 @@ class FCGIServer(managed_server.ManagedServer):
         if e[0] == errno.EADDRINUSE and self._fd_server:
           try:
             fd_client = fd_server.FdClient(self._fd_server.server_address)
-            fd = fd_client.get_fd_for_address(self.server_address)
+            fd_info = fd_client.get_fd_for_address(self.server_address,
+                                                   self.socket_type)
             self._previous_umgmt_address = fd_client.get_micro_management_address()
             logging.info('previous micro_management address %s',
                          self._previous_umgmt_address)
-            self._listen_socket = socket.fromfd(
-              fd, self.socket_type, socket.SOCK_STREAM)
+            self._listen_socket = fd_info.socket()
           except socket.error, e:
             if self.socket_type == socket.AF_UNIX:
               logging.warning('forced teardown on %s', self.server_address)
@@ -67,8 +109,11 @@ class FCGIServer(managed_server.ManagedServer):
     self.lock_startup()
     if self._listen_socket:
       # NOTE: does listening with too much backlog break FIFO queuing? does this mean
-      # a slow worker will make some requests wait unfairly?
-      self._listen_socket.listen(socket.SOMAXCONN)
+      # a slow worker will make some requests wait unfairly? accept_mutex
+      # keeps a single child in accept() so the backlog is served in order.
+      # with reuse_port the children listen on their own sockets
+      if not self.check_reuse_port():
+        self._listen_socket.listen(socket.SOMAXCONN)
       self._listen_fd = self._listen_socket.fileno()
 
     # for legacy reasons, we support STDIN as a valid _listen_fd
@@ -76,18 +121,190 @@ class FCGIServer(managed_server.ManagedServer):
     if not stat.S_ISSOCK(mode):
       raise managed_server.WiseguyError("no listening socket available")
 
-    # 0 is 'flags' - I hate magic parameters
-    self._fcgi_request = fcgi.Request(
-      self._listen_fd, 0)
+    if self._multiplexed:
+      self._accept_socket = self._listen_socket or socket.fromfd(
+        self._listen_fd, self.socket_type, socket.SOCK_STREAM)
+    else:
+      # 0 is 'flags' - I hate magic parameters
+      self._fcgi_request = fcgi.Request(
+        self._listen_fd, 0)
     super(FCGIServer, self).server_activate()
 
+  def set_listen_socket(self, sock):
+    self._listen_socket = sock
+    self._listen_fd = sock.fileno()
+    if self._multiplexed:
+      # this socket belongs to this child alone, so it is safe to make it
+      # non-blocking. the shared one isn't, libfcgi can't handle EAGAIN.
+      sock.setblocking(0)
+      self._accept_socket = sock
+    else:
+      self._fcgi_request = fcgi.Request(self._listen_fd, 0)
+
   def get_request(self):
     # this is a little janky, the object upon which we call accept() is actually
     # used as a request. very fun for multithreading. for now, just make it
     # look like this operates like most other python servers
-    self._fcgi_request.accept()
+    if self._threads > 1:
+      # each request thread needs its own
+      fcgi_request = getattr(self._local, 'fcgi_request', None)
+      if fcgi_request is None:
+        fcgi_request = self._local.fcgi_request = fcgi.Request(
+          self._listen_fd, 0)
+    else:
+      fcgi_request = self._fcgi_request
+    fcgi_request.accept()
     # fixme: client_address is always None
-    return (self._fcgi_request, None)
+    return (fcgi_request, None)
+
+  def handle_request(self):
+    if not self._multiplexed:
+      return super(FCGIServer, self).handle_request()
+    if not self._ready_requests:
+      self.wait_for_requests()
+    if not self._quit:
+      self.serve_ready_request()
+
+  def wait_for_requests(self):
+    """Wait for a connection, a record or a signal and read what arrived.
+
+    A child with open connections only polls the accept lock, it has to
+    keep reading them while another child waits for new connections."""
+    # connections closed while serving requests have to go before select()
+    self.close_idle_connections()
+    listening = False
+    if len(self._connections) < self.max_connections:
+      if self._connections:
+        listening = self.acquire_accept_lock(blocking=False)
+      elif self.acquire_accept_lock():
+        listening = True
+      else:
+        return
+    try:
+      rfds = self._connections.keys()
+      if self._wakeup_rfd is not None:
+        rfds.append(self._wakeup_rfd)
+      if listening:
+        rfds.append(self._listen_fd)
+      ready_rfds, ready_wfds, ready_xfds = select.select(
+        rfds, [], [], self.get_connection_timeout(listening))
+      if self._wakeup_rfd in ready_rfds:
+        self.drain_wakeup_fd()
+      if listening and self._listen_fd in ready_rfds:
+        self.accept_connection()
+    finally:
+      self.release_accept_lock()
+    self.read_connections(ready_rfds)
+
+  def get_connection_timeout(self, listening):
+    timeout_list = [connection.last_activity + self.connection_idle_timeout -
+                    time.time()
+                    for connection in self._connections.itervalues()
+                    if not connection.requests]
+    if self._connections and not listening:
+      timeout_list.append(self.accept_lock_retry_interval)
+    if not timeout_list:
+      return None
+    return max(0, min(timeout_list))
+
+  def accept_connection(self):
+    try:
+      sock, client_address = self._accept_socket.accept()
+    except socket.error, e:
+      if e[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+        return
+      raise
+    sock.setblocking(1)
+    if sock.family == socket.AF_INET:
+      # no replies to outgoing data, so disable Nagle
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    connection = fcgi_protocol.Connection(
+      sock, self._fcgi_values, self.max_connection_requests,
+      self.stdin_spool_size)
+    self._connections[connection.fileno()] = connection
+
+  def read_connections(self, fds):
+    for fd in fds:
+      connection = self._connections.get(fd)
+      if connection is None:
+        continue
+      self._ready_requests.extend(connection.read())
+      if connection.closed:
+        del self._connections[fd]
+
+  def close_idle_connections(self):
+    """Forget closed connections, close the ones idle for too long."""
+    deadline = time.time() - self.connection_idle_timeout
+    for fd, connection in self._connections.items():
+      if (not connection.closed and not connection.requests and
+          connection.last_activity < deadline):
+        connection.close()
+      if connection.closed:
+        del self._connections[fd]
+
+  def get_ready_request(self):
+    """Return the next request that is complete and still wanted."""
+    while self._ready_requests:
+      request = self._ready_requests.popleft()
+      if request.finished:
+        continue
+      if request.aborted:
+        self.end_request(request)
+        continue
+      return request
+    return None
+
+  def serve_ready_request(self):
+    """Run the next complete request, return False if there wasn't one."""
+    request = self.get_ready_request()
+    if request is None:
+      return False
+    if self.verify_request(request, None):
+      try:
+        self.process_request(request, None)
+      except:
+        self.handle_error(request, None)
+      self.close_request(request)
+    return True
+
+  def end_request(self, req):
+    try:
+      req.finish()
+    except IOError, e:
+      logging.debug('request failed: %s', e)
+
+  def close_request(self, req):
+    if self._multiplexed:
+      # the response goes out before any of the bookkeeping
+      self.end_request(req)
+    super(FCGIServer, self).close_request(req)
+
+  def drain_connections(self):
+    """Serve the requests already in flight, then close every connection."""
+    deadline = time.time() + self.drain_timeout
+    while True:
+      while self.serve_ready_request():
+        pass
+      pending = [fd for fd, connection in self._connections.iteritems()
+                 if connection.requests and not connection.closed]
+      timeout = deadline - time.time()
+      if not pending or timeout <= 0:
+        break
+      try:
+        ready_rfds, ready_wfds, ready_xfds = select.select(
+          pending, [], [], timeout)
+      except select.error, e:
+        if e[0] != errno.EINTR:
+          raise
+        continue
+      self.read_connections(ready_rfds)
+    for connection in self._connections.itervalues():
+      connection.close()
+    self._connections.clear()
+
+  def drain_requests(self):
+    if self._multiplexed:
+      self.drain_connections()
 
   def handle(self, req):
     """Vaguely named, usually provided by the WSGIMix"""
@@ -4,16 +4,97 @@ import errno
 import logging
 import _multiprocessing
 import os
+import select
 import socket
+import struct
+import sys
 import time
 
 from wiseguy import embedded_sock_server
 
+INT_FORMAT = embedded_sock_server.INT_FORMAT
+INT_SIZE = embedded_sock_server.INT_SIZE
+# family, type, flags - followed by the bind address as a string
+ENTRY_FORMAT = '!iiI'
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+# entry flags
+FLAG_LISTENING = 1
+FLAG_REUSEADDR = 2
+FLAG_REUSEPORT = 4
+# the most descriptors a single handoff will take
+MAX_FDS = 64
+# python2 doesn't export these
+SO_DOMAIN = getattr(socket, 'SO_DOMAIN', 39)
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+SO_ACCEPTCONN = getattr(socket, 'SO_ACCEPTCONN', 30)
+SCM_RIGHTS = getattr(socket, 'SCM_RIGHTS', 1)
+MSG_CTRUNC = getattr(socket, 'MSG_CTRUNC', 8)
+
+# python2 sockets can't sendmsg() and _multiprocessing only passes one
+# descriptor per message, go straight to libc on linux to pass all of them
+# in a single SCM_RIGHTS message
+_libc = None
+if sys.platform.startswith('linux'):
+  try:
+    import ctypes
+    import ctypes.util
+
+    class _iovec(ctypes.Structure):
+      _fields_ = [('iov_base', ctypes.c_void_p),
+                  ('iov_len', ctypes.c_size_t)]
+
+    class _msghdr(ctypes.Structure):
+      _fields_ = [('msg_name', ctypes.c_void_p),
+                  ('msg_namelen', ctypes.c_uint32),
+                  ('msg_iov', ctypes.POINTER(_iovec)),
+                  ('msg_iovlen', ctypes.c_size_t),
+                  ('msg_control', ctypes.c_void_p),
+                  ('msg_controllen', ctypes.c_size_t),
+                  ('msg_flags', ctypes.c_int)]
+
+    class _cmsghdr(ctypes.Structure):
+      _fields_ = [('cmsg_len', ctypes.c_size_t),
+                  ('cmsg_level', ctypes.c_int),
+                  ('cmsg_type', ctypes.c_int)]
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    for _name in ('sendmsg', 'recvmsg'):
+      getattr(_libc, _name).argtypes = (
+        ctypes.c_int, ctypes.POINTER(_msghdr), ctypes.c_int)
+      getattr(_libc, _name).restype = ctypes.c_ssize_t
+  except (ImportError, OSError, AttributeError), e:
+    logging.debug('no batched fd handoff: %s', e)
+    _libc = None
+
+has_batched_handoff = _libc is not None
+
+# descriptors that came over in a batch and haven't been asked for yet,
+# fd_server address -> (micro management address, {bind string: FdInfo})
+_handoffs = {}
+
 
 class FdClientError(embedded_sock_server.ClientError):
   pass
 
 
+class FdInfo(object):
+  """A descriptor handed over by the server, and what it was bound to."""
+  def __init__(self, fd, address, family, type, flags):
+    self.fd = fd
+    self.address = address
+    self.family = family
+    self.type = type
+    self.flags = flags
+
+  def socket(self):
+    """Return a socket object of the right family and type for fd."""
+    return socket.fromfd(self.fd, self.family, self.type)
+
+  def __repr__(self):
+    return '<FdInfo %s %s family=%s type=%s flags=%s>' % (
+      self.fd, self.address, self.family, self.type, self.flags)
+
+
 class FdClient(embedded_sock_server.SocketClient):
   @embedded_sock_server.disconnect_on_completion
   def get_available_addresses(self):
@@ -26,8 +107,71 @@ class FdClient(embedded_sock_server.SocketClient):
     else:
       raise FdClientError('bad response: %r' % response)
 
+  def get_fd_for_address(self, bind_address, family=socket.AF_INET,
+                         type=socket.SOCK_STREAM):
+    """Return an FdInfo for the descriptor bound to bind_address.
+
+    The first call fetches every descriptor the server has in one
+    exchange, later calls for the other addresses are answered from that.
+    Falls back to one REQ_FD round trip per address if the server is too
+    old to know REQ_FDS. family and type are only used if the descriptor
+    can't be asked for its own."""
+    address = bind_string(bind_address)
+    handoff = self._get_handoff()
+    if handoff is not None and address in handoff[1]:
+      return handoff[1].pop(address)
+    fd = self.request_fd_for_address(bind_address)
+    try:
+      family, type, flags = describe_fd(fd)
+    except socket.error, e:
+      logging.debug('unable to describe fd %s: %s', fd, e)
+      flags = 0
+    return FdInfo(fd, address, family, type, flags)
+
+  def _get_handoff(self):
+    if not has_batched_handoff:
+      return None
+    if self.socket_address not in _handoffs:
+      try:
+        _handoffs[self.socket_address] = self.get_fds()
+      except (FdClientError, EOFError), e:
+        logging.info('batched fd handoff failed, falling back: %s', e)
+        _handoffs[self.socket_address] = None
+      except socket.error, e:
+        # not cached, there may be a server to ask later
+        logging.info('batched fd handoff failed, falling back: %s', e)
+        return None
+    return _handoffs[self.socket_address]
+
   @embedded_sock_server.disconnect_on_completion
-  def get_fd_for_address(self, bind_address):
+  def get_fds(self):
+    """Return (micro management address, {bind string: FdInfo}) for every
+    descriptor registered with the server, in a single exchange."""
+    self.send_str('REQ_FDS')
+    response = self.recv_str()
+    if response == 'OK':
+      data, fds = recv_fds(self.socket, 4096, MAX_FDS)
+      try:
+        # only the first part of the frame is sure to come with the
+        # descriptors
+        if len(data) < INT_SIZE:
+          data += self.recv_exactly(INT_SIZE - len(data))
+        frame_size = struct.unpack_from(INT_FORMAT, data)[0]
+        if len(data) < INT_SIZE + frame_size:
+          data += self.recv_exactly(INT_SIZE + frame_size - len(data))
+        return unpack_fd_frame(data[INT_SIZE:], fds)
+      except:
+        for fd in fds:
+          os.close(fd)
+        raise
+    elif response == 'ERROR':
+      raise FdClientError(self.recv_str())
+    else:
+      raise FdClientError('bad response: %r' % response)
+
+  @embedded_sock_server.disconnect_on_completion
+  def request_fd_for_address(self, bind_address):
+    """Fetch the descriptor for one address with its own round trip."""
     self.send_str('REQ_FD')
     self.send_str(bind_string(bind_address))
     response = self.recv_str()
@@ -57,8 +201,14 @@ class FdClient(embedded_sock_server.SocketClient):
       return self.recv_int()
     raise FdClientError('bad response: %r' % response)
 
-  @embedded_sock_server.disconnect_on_completion
   def get_micro_management_address(self):
+    handoff = self._get_handoff()
+    if handoff is not None:
+      return handoff[0]
+    return self.request_micro_management_address()
+
+  @embedded_sock_server.disconnect_on_completion
+  def request_micro_management_address(self):
     self.send_str('REQ_UMGMT_ADDR')
     response = self.recv_str()
     if response == 'OK':
@@ -81,6 +231,20 @@ class FdRequestHandler(embedded_sock_server.EmbeddedHandler):
       self.send_str('No fd matching %r on %s %s' % (bind_address, os.getpid(),
                     self.server.fd_map.keys()))
 
+  def handle_REQ_FDS(self):
+    entries = sorted(self.server.fd_map.items())
+    logging.info('sending fds: %s', ', '.join(
+      '%s %s' % entry for entry in entries))
+    if len(entries) > MAX_FDS:
+      self.send_str('ERROR')
+      self.send_str('%s fds is more than %s' % (len(entries), MAX_FDS))
+      return
+    self.send_str('OK')
+    frame = pack_fd_frame(self.server.micro_management_server_address,
+                          entries)
+    send_fds(self.request, struct.pack(INT_FORMAT, len(frame)) + frame,
+             [fd for address, fd in entries])
+
   def handle_REQ_PID(self):
     self.send_str('OK')
     self.send_int(os.getpid())
@@ -100,11 +264,18 @@ class FdServer(embedded_sock_server.EmbeddedSockServer):
   The basic protocol is netstring like so we can chat but periodically call
   out to do the sendfd/recvfd referencing the same socket we are listening on.
 
+  REQ_FDS hands over every registered descriptor at once, in one
+  SCM_RIGHTS message that carries a frame describing them - see
+  pack_fd_frame.
+
   CLIENT:
     send_str REQ_FD
     send_str (bind address)
     recv_str OK -> recvfd
              ERROR -> recv_str (error message)
+    send_str REQ_FDS
+    recv_str OK -> recvmsg (int frame size, frame, all fds)
+             ERROR -> recv_str (error message)
 
   SERVER:
     accept()
@@ -112,6 +283,9 @@ class FdServer(embedded_sock_server.EmbeddedSockServer):
              recv_str (bind address)
              send_str OK -> sendfd
                       ERROR -> send_str (error message)
+    recv_str REQ_FDS
+             send_str OK -> sendmsg (int frame size, frame, all fds)
+                      ERROR -> send_str (error message)
   """
 
   # map bind args to a socket object (maybe just an fd?)
@@ -141,8 +315,9 @@ class FdServer(embedded_sock_server.EmbeddedSockServer):
         logging.info('requesting bound fd %s', bind_address)
         try:
           fd_client = FdClient(self.server_address)
-          fd = fd_client.get_fd_for_address(self.server_address)
-          self.socket = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+          fd_info = fd_client.get_fd_for_address(self.server_address,
+                                                 socket.AF_UNIX)
+          self.socket = fd_info.socket()
         except socket.error, e:
           logging.warning('forced teardown on %s', bind_address)
           os.remove(self.server_address)
@@ -154,6 +329,151 @@ class FdServer(embedded_sock_server.EmbeddedSockServer):
     self._bound = True
     
 
+def pack_fd_frame(micro_management_address, entries):
+  """Describe the (bind string, fd) entries, in the order the descriptors
+  are sent.
+
+  frame: str micro management address, int entry count, entries
+  entry: int family, int type, int flags, str bind address
+  str: int length, bytes"""
+  parts = [_pack_str(micro_management_address),
+           struct.pack(INT_FORMAT, len(entries))]
+  for address, fd in entries:
+    parts.append(struct.pack(ENTRY_FORMAT, *describe_fd(fd)))
+    parts.append(_pack_str(address))
+  return ''.join(parts)
+
+def describe_fd(fd):
+  """Return (family, type, flags) of a socket descriptor.
+
+  Raises socket.error where the socket can't report its family."""
+  # the family passed here doesn't matter, getsockopt goes to the fd
+  sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    family = sock.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+    sock_type = sock.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    flags = 0
+    for flag, option in ((FLAG_LISTENING, SO_ACCEPTCONN),
+                         (FLAG_REUSEADDR, socket.SO_REUSEADDR),
+                         (FLAG_REUSEPORT, SO_REUSEPORT)):
+      try:
+        if sock.getsockopt(socket.SOL_SOCKET, option):
+          flags |= flag
+      except socket.error:
+        pass
+  finally:
+    sock.close()
+  return family, sock_type, flags
+
+def unpack_fd_frame(frame, fds):
+  """Return (micro management address, {bind string: FdInfo})."""
+  micro_management_address, offset = _unpack_str(frame, 0)
+  count = struct.unpack_from(INT_FORMAT, frame, offset)[0]
+  offset += INT_SIZE
+  if count != len(fds):
+    raise FdClientError('frame describes %s fds, got %s' % (count, len(fds)))
+  fd_infos = {}
+  for fd in fds:
+    family, sock_type, flags = struct.unpack_from(ENTRY_FORMAT, frame, offset)
+    address, offset = _unpack_str(frame, offset + ENTRY_SIZE)
+    fd_infos[address] = FdInfo(fd, address, family, sock_type, flags)
+  return micro_management_address, fd_infos
+
+def _pack_str(s):
+  return struct.pack(INT_FORMAT, len(s)) + s
+
+def _unpack_str(data, offset):
+  size = struct.unpack_from(INT_FORMAT, data, offset)[0]
+  offset += INT_SIZE
+  if offset + size > len(data):
+    raise FdClientError('truncated fd frame')
+  return data[offset:offset + size], offset + size
+
+def close_unclaimed_fds():
+  """Close the handed over descriptors nobody asked for, so they don't end
+  up in every child."""
+  for handoff in _handoffs.values():
+    if handoff is None:
+      continue
+    for fd_info in handoff[1].values():
+      logging.info('closing unclaimed fd %s', fd_info)
+      os.close(fd_info.fd)
+    handoff[1].clear()
+
+def _call_when_ready(sock, for_write, function, *pargs):
+  """Call a libc socket function, waiting out EAGAIN for up to the
+  socket's timeout - python puts sockets with a timeout in non-blocking
+  mode."""
+  while True:
+    result = function(*pargs)
+    if result >= 0:
+      return result
+    error = ctypes.get_errno()
+    if error == errno.EINTR:
+      continue
+    if error not in (errno.EAGAIN, errno.EWOULDBLOCK):
+      raise socket.error(error, os.strerror(error))
+    if for_write:
+      ready = select.select([], [sock], [], sock.gettimeout())[1]
+    else:
+      ready = select.select([sock], [], [], sock.gettimeout())[0]
+    if not ready:
+      raise socket.timeout('timed out')
+
+def _cmsg_align(size):
+  align = ctypes.sizeof(ctypes.c_size_t)
+  return (size + align - 1) & ~(align - 1)
+
+def send_fds(sock, data, fds):
+  """Send data with fds attached, the descriptors go with the first byte."""
+  fd_data = struct.pack('%di' % len(fds), *fds)
+  header_size = _cmsg_align(ctypes.sizeof(_cmsghdr))
+  control = ctypes.create_string_buffer(header_size + _cmsg_align(len(fd_data)))
+  header = _cmsghdr.from_buffer(control)
+  header.cmsg_len = header_size + len(fd_data)
+  header.cmsg_level = socket.SOL_SOCKET
+  header.cmsg_type = SCM_RIGHTS
+  ctypes.memmove(ctypes.addressof(control) + header_size, fd_data,
+                 len(fd_data))
+  data_buffer = ctypes.create_string_buffer(data, len(data))
+  iov = _iovec(ctypes.addressof(data_buffer), len(data))
+  msg = _msghdr(None, 0, ctypes.pointer(iov), 1, ctypes.addressof(control),
+                ctypes.sizeof(control), 0)
+  sent = _call_when_ready(sock, True, _libc.sendmsg, sock.fileno(),
+                          ctypes.byref(msg), 0)
+  if sent < len(data):
+    sock.sendall(data[sent:])
+
+def recv_fds(sock, size, max_fds):
+  """Return (data, fds) from a single recvmsg, data may be short."""
+  header_size = _cmsg_align(ctypes.sizeof(_cmsghdr))
+  fd_size = struct.calcsize('i')
+  control = ctypes.create_string_buffer(
+    header_size + _cmsg_align(max_fds * fd_size))
+  data_buffer = ctypes.create_string_buffer(size)
+  iov = _iovec(ctypes.addressof(data_buffer), size)
+  msg = _msghdr(None, 0, ctypes.pointer(iov), 1, ctypes.addressof(control),
+                ctypes.sizeof(control), 0)
+  received = _call_when_ready(sock, False, _libc.recvmsg, sock.fileno(),
+                              ctypes.byref(msg), 0)
+  fds = []
+  offset = 0
+  while offset + header_size <= msg.msg_controllen:
+    header = _cmsghdr.from_buffer(control, offset)
+    if (header.cmsg_level == socket.SOL_SOCKET and
+        header.cmsg_type == SCM_RIGHTS):
+      count = (header.cmsg_len - header_size) / fd_size
+      fds.extend(struct.unpack_from('%di' % count, control.raw,
+                                    offset + header_size))
+    offset += _cmsg_align(header.cmsg_len)
+  if msg.msg_flags & MSG_CTRUNC:
+    for fd in fds:
+      os.close(fd)
+    raise FdClientError('too many fds, the handoff was truncated')
+  if not received:
+    raise EOFError('connection closed')
+  return data_buffer.raw[:received], fds
+
 def bind_string(bind_address):
   if isinstance(bind_address, basestring):
     return bind_address
@@ -0,0 +1,178 @@
+"""Low rate profiling across every worker, merged in the parent.
+
+Each child runs a random fraction of its requests under cProfile and every
+dump_interval seconds writes what it has collected so far to the spool
+directory and starts over. The parent picks the dumps up, adds them
+together the way pstats.Stats.add does and keeps one merged profile per
+collection pass. The profile it serves is the sum of the passes from the
+last window seconds, so it follows the current traffic mix instead of
+growing forever.
+
+The files are the only thing shared between the two sides. A child writes
+to a temporary name and renames, so the parent never sees half a dump.
+"""
+
+import cProfile
+import glob
+import logging
+import marshal
+import os
+import pstats
+import random
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+
+DUMP_INTERVAL = 60
+WINDOW = 600
+FILE_PATTERN = 'fleet-*.pstats'
+
+
+class FleetProfile(object):
+  def __init__(self, rate, path=None, dump_interval=DUMP_INTERVAL,
+               window=WINDOW):
+    """rate - the fraction of requests each child profiles
+    path - the spool directory, a temporary one is made if this is None"""
+    self.rate = rate
+    self.dump_interval = dump_interval
+    self.window = window
+    if path is None:
+      self.path = tempfile.mkdtemp(prefix='wiseguy-fleet-')
+      self._owns_path = True
+    else:
+      self.path = os.path.abspath(path)
+      self._owns_path = False
+      if not os.path.isdir(self.path):
+        os.makedirs(self.path)
+    # child side
+    self._profile = None
+    self._profiled_count = 0
+    self._dump_count = 0
+    self._next_dump_time = 0
+    # parent side - a list of (collect_time, request_count, pstats.Stats)
+    self._windows = []
+    self._lock = threading.Lock()
+
+  # child side
+
+  def init_child(self):
+    self._profile = cProfile.Profile()
+    self._profiled_count = 0
+    self._dump_count = 0
+    self._next_dump_time = time.time() + self.dump_interval
+
+  def should_sample(self):
+    return self._profile is not None and random.random() < self.rate
+
+  def runcall(self, function, *pargs):
+    """Profile one request. The caller makes sure only one thread at a
+    time gets here."""
+    try:
+      return self._profile.runcall(function, *pargs)
+    finally:
+      self._profiled_count += 1
+      if time.time() >= self._next_dump_time:
+        self.dump()
+
+  def dump(self):
+    """Write out what has been collected since the last dump."""
+    if self._profile is None:
+      return
+    self._next_dump_time = time.time() + self.dump_interval
+    if not self._profiled_count:
+      return
+    self._profile.create_stats()
+    stats = self._profile.stats
+    self._profile.clear()
+    profiled_count = self._profiled_count
+    self._profiled_count = 0
+    self._dump_count += 1
+    filename = os.path.join(self.path, 'fleet-%s-%s.pstats' % (
+      os.getpid(), self._dump_count))
+    tmp_filename = os.path.join(self.path, '.tmp-%s' % os.getpid())
+    try:
+      f = open(tmp_filename, 'wb')
+      try:
+        # the request count rides along with the stats
+        marshal.dump((profiled_count, stats), f)
+      finally:
+        f.close()
+      os.rename(tmp_filename, filename)
+    except (IOError, OSError), e:
+      logging.warning('unable to dump fleet profile: %s', e)
+
+  # parent side
+
+  def collect(self):
+    """Merge the dumps the children have written since the last call."""
+    stats = None
+    request_count = 0
+    for filename in sorted(glob.glob(os.path.join(self.path, FILE_PATTERN))):
+      try:
+        f = open(filename, 'rb')
+        try:
+          profiled_count, child_stats = marshal.load(f)
+        finally:
+          f.close()
+        os.remove(filename)
+      except (IOError, OSError, EOFError, ValueError, TypeError), e:
+        logging.warning('unable to read fleet profile %s: %s', filename, e)
+        continue
+      if stats is None:
+        stats = pstats.Stats(_StatsDump(child_stats))
+      else:
+        stats.add(_StatsDump(child_stats))
+      request_count += profiled_count
+    now = time.time()
+    self._lock.acquire()
+    try:
+      if stats is not None:
+        self._windows.append((now, request_count, stats))
+      self._windows = [window for window in self._windows
+                       if window[0] > now - self.window]
+    finally:
+      self._lock.release()
+
+  def get_stats(self):
+    """Return (request_count, pstats.Stats) for the current window, the
+    stats are None if nothing has been collected."""
+    self._lock.acquire()
+    try:
+      windows = list(self._windows)
+    finally:
+      self._lock.release()
+    stats = None
+    request_count = 0
+    for collect_time, window_count, window_stats in windows:
+      if stats is None:
+        # add() works in place, so start from a copy
+        stats = pstats.Stats(_StatsDump(dict(window_stats.stats)))
+      else:
+        stats.add(window_stats)
+      request_count += window_count
+    return request_count, stats
+
+  def format_stats(self, sort='cumulative', limit=50):
+    request_count, stats = self.get_stats()
+    stream = StringIO.StringIO()
+    stream.write('profiled requests: %s (rate %s, last %ss)\n' % (
+      request_count, self.rate, self.window))
+    if stats is not None:
+      stats.stream = stream
+      stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+  def close(self):
+    if self._owns_path:
+      shutil.rmtree(self.path, ignore_errors=True)
+
+
+class _StatsDump(object):
+  """Stands in for a profiler so pstats.Stats will take a raw dict."""
+  def __init__(self, stats):
+    self.stats = stats
+
+  def create_stats(self):
+    pass
@@ -1,7 +1,9 @@
 import errno
 import logging
+import os
 import select
 import socket
+import stat
 import string
 import struct
 import sys
@@ -26,13 +28,119 @@ translate_header_table = string.maketrans(
   'abcdefghijklmnopqrstuvwxyz-',
   'ABCDEFGHIJKLMNOPQRSTUVWXYZ_')
 
+# header name as sent -> interned environ key. the same dozen names show up
+# on almost every request, so this saves the translate and the concatenation.
+# it's bounded so a client can't grow it forever with made up headers.
+_environ_key_cache = {}
+max_environ_key_cache_size = 1024
+max_header_count = 100
+max_header_line = 65536
+
+def get_environ_key(name):
+  try:
+    return _environ_key_cache[name]
+  except KeyError:
+    pass
+  key = name.translate(translate_header_table)
+  if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+    key = 'HTTP_' + key
+  key = intern(key)
+  if len(_environ_key_cache) < max_environ_key_cache_size:
+    _environ_key_cache[name] = key
+  return key
+
+
+class RequestHeaders(dict):
+  """The parsed request headers, lower case name -> value.
+
+  Stands in for the mimetools.Message that BaseHTTPRequestHandler builds,
+  at least as far as wiseguy uses it."""
+  def getheader(self, name, default=None):
+    return self.get(name.lower(), default)
+
+# python2 doesn't have os.sendfile, go straight to libc on linux
+sendfile = getattr(os, 'sendfile', None)
+if sendfile is None and sys.platform.startswith('linux'):
+  try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                               ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    _libc.sendfile.restype = ctypes.c_ssize_t
+  except (ImportError, OSError, AttributeError), e:
+    logging.debug('no sendfile: %s', e)
+  else:
+    def sendfile(out_fd, in_fd, offset, count):
+      """Same as os.sendfile in python3."""
+      c_offset = ctypes.c_int64(offset)
+      sent = _libc.sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+      if sent < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+      return sent
+
+
+def parse_byte_range(value, size):
+  """Return (start, stop) for a single byte range header value.
+
+  Returns None if the header should be ignored - it's malformed or asks for
+  more than one range. The range can't be satisfied if start >= size."""
+  value = value.strip()
+  if not value.startswith('bytes=') or ',' in value:
+    return None
+  first, sep, last = value[6:].partition('-')
+  # int() would take signs and spaces
+  if (not sep or not (first or last) or (first and not first.isdigit()) or
+      (last and not last.isdigit())):
+    return None
+  if not first:
+    # the last n bytes
+    length = int(last)
+    if not length:
+      return (size, size)
+    return (max(0, size - length), size)
+  start = int(first)
+  if last:
+    stop = int(last) + 1
+    if stop <= start:
+      return None
+  else:
+    stop = size
+  return (start, min(stop, size))
+
 class HTTPServer(simple_server.WSGIServer, managed_server.ManagedServer):
+  # most idle keep-alive connections a child will park, past that it waits
+  # on them itself like it used to
+  max_parked_connections = 256
+  # how often a child with parked connections retries the accept lock
+  accept_lock_retry_interval = 0.1
+
   def __init__(self, *pargs, **kargs):
+    """keepalive_parking - instead of waiting on an idle keep-alive
+      connection, a child parks it in an epoll set and goes back to accepting.
+      it picks the connection up again when the next request arrives.
+    max_body_size - largest request body accepted, in bytes. larger bodies
+      get a 413, or an error from wsgi.input when they are chunked."""
     # don't bind_and_activate in the managed_server
     # that will be handled when the WSGIServer initializes, or externally by
     # the calling code
     managed_kargs = kargs.copy()
     managed_kargs['bind_and_activate'] = False
+    self._keepalive_parking = managed_kargs.pop('keepalive_parking', False)
+    self.max_body_size = managed_kargs.pop('max_body_size', None)
+    if self._keepalive_parking and not hasattr(select, 'epoll'):
+      logging.warning('keepalive_parking needs epoll, ignoring it')
+      self._keepalive_parking = False
+    if self._keepalive_parking and managed_kargs.get('threads', 1) > 1:
+      # the parked connections belong to the child, not to a thread
+      logging.warning('keepalive_parking does not work with threads, '
+                      'ignoring it')
+      self._keepalive_parking = False
+    # fd -> (request, client_address, deadline), the poller is created in
+    # the child the first time it parks something
+    self._parked = {}
+    self._poller = None
     managed_server.ManagedServer.__init__(self, *pargs, **managed_kargs)
     RequestHandlerClass = kargs.get(
       'RequestHandlerClass', WiseguyRequestHandler)
@@ -58,15 +166,14 @@ class HTTPServer(simple_server.WSGIServer, managed_server.ManagedServer):
         if self._drop_privileges_callback:
           self._drop_privileges_callback()
         fd_client = fd_server.FdClient(self._fd_server.server_address)
-        fd = fd_client.get_fd_for_address(self.server_address)
+        fd_info = fd_client.get_fd_for_address(self.server_address)
         self._previous_umgmt_address = fd_client.get_micro_management_address()
         logging.info('previous micro_management address %s',
                      self._previous_umgmt_address)
         # reassign the socket for the SocketServer
         # fixme: does it make more sense to do this as a rebindable socket
         # rather than at the server level?
-        self.socket = self._listen_socket = socket.fromfd(
-          fd, socket.AF_INET, socket.SOCK_STREAM)
+        self.socket = self._listen_socket = fd_info.socket()
         # manually call bits of the base http handler:
         host, port = self.socket.getsockname()[:2]
         self.server_name = socket.getfqdn(host)
@@ -85,31 +192,188 @@ class HTTPServer(simple_server.WSGIServer, managed_server.ManagedServer):
 
   def server_activate(self):
     self.lock_startup()
-    simple_server.WSGIServer.server_activate(self)
+    # with reuse_port the children listen on their own sockets
+    if not self.check_reuse_port():
+      simple_server.WSGIServer.server_activate(self)
     managed_server.ManagedServer.server_activate(self)
 
+  def set_listen_socket(self, sock):
+    self.socket = self._listen_socket = sock
+
   def close_request(self, request):
     simple_server.WSGIServer.close_request(self, request)
     managed_server.ManagedServer.close_request(self, request)    
 
   # this is the main entry point and it will override the implementation in
-  # ManagedServer. it is inherited from the base class.
-  # def handle_request(self):
+  # ManagedServer.
+  def handle_request(self):
+    """Wait for a connection or a signal, handle the connection if any.
+
+    SocketServer.handle_request retries select() on EINTR, so an idle child
+    would not notice a SIGTERM until the next connection showed up. Waiting
+    on the wakeup fd as well hands control back to the request loop so it
+    can check _quit.
+
+    With accept_mutex, only the child holding the lock waits here, it lets
+    go as soon as it has accepted (see get_request). A child with parked
+    connections never blocks on the lock, it watches them instead."""
+    if self._wakeup_rfd is None:
+      return simple_server.WSGIServer.handle_request(self)
+    if self._parked:
+      listening = self.acquire_accept_lock(blocking=False)
+    elif self.acquire_accept_lock():
+      listening = True
+    else:
+      return
+    try:
+      rfds = [self._wakeup_rfd]
+      if listening:
+        rfds.append(self)
+      timeout = self.timeout
+      if self._parked:
+        rfds.append(self._poller.fileno())
+        timeout = self.get_parked_timeout(timeout, listening)
+      ready_rfds, ready_wfds, ready_xfds = select.select(
+        rfds, [], [], timeout)
+      if self._wakeup_rfd in ready_rfds:
+        self.drain_wakeup_fd()
+      if self in ready_rfds:
+        self._handle_request_noblock()
+      elif not ready_rfds and not self._parked:
+        self.handle_timeout()
+    finally:
+      self.release_accept_lock()
+    if self._parked:
+      self.handle_parked_connections()
+
+  def park_connection(self, handler):
+    """Hold on to the idle keep-alive connection of handler without waiting
+    on it. Returns True if the connection was parked, the handler should
+    return without closing it."""
+    if (not self._keepalive_parking or self._quit or
+        len(self._parked) >= self.max_parked_connections or
+        handler.rfile.buffered_size()):
+      # a pipelined request that has already been read has to be handled
+      # right here
+      return False
+    if self._poller is None:
+      self._poller = select.epoll()
+    request = handler.request
+    fd = request.fileno()
+    self._poller.register(fd, select.EPOLLIN)
+    self._parked[fd] = (request, handler.client_address,
+                        time.time() + handler.keepalive_timeout)
+    self._scoreboard.set_idle()
+    return True
+
+  def get_parked_timeout(self, timeout, listening):
+    """Shorten timeout to the next parked connection expiring."""
+    timeout_list = [deadline - time.time()
+                    for request, client_address, deadline
+                    in self._parked.itervalues()]
+    if timeout is not None:
+      timeout_list.append(timeout)
+    if not listening:
+      timeout_list.append(self.accept_lock_retry_interval)
+    return max(0, min(timeout_list))
+
+  def handle_parked_connections(self):
+    """Serve the parked connections that have a request waiting, close the
+    ones that have been idle past their keep-alive timeout."""
+    for fd, event in self._poller.poll(0):
+      if self._quit:
+        break
+      if fd not in self._parked:
+        continue
+      request, client_address, deadline = self._unpark(fd)
+      try:
+        self.process_request(request, client_address)
+      except:
+        self.handle_error(request, client_address)
+        self.shutdown_request(request)
+    now = time.time()
+    for fd, (request, client_address, deadline) in self._parked.items():
+      if deadline < now or self._quit:
+        self._unpark(fd)
+        try:
+          request.shutdown(socket.SHUT_WR)
+        except socket.error:
+          pass
+        request.close()
+
+  def _unpark(self, fd):
+    self._poller.unregister(fd)
+    return self._parked.pop(fd)
+
+  def shutdown_request(self, request):
+    # parked connections stay open
+    if self._parked and request.fileno() in self._parked:
+      return
+    simple_server.WSGIServer.shutdown_request(self, request)
+
+  def get_request(self):
+    try:
+      return simple_server.WSGIServer.get_request(self)
+    finally:
+      self.release_accept_lock()
 
 
 class WiseguyWSGIHandler(simple_server.ServerHandler):
   """This class controls the dispatch to the WSGI application itself.
 
   It's *very* confusing, but this class actually controls the logging
-  for dynamic requests in the close method."""
+  for dynamic requests in the close method.
+
+  A body without a Content-Length is sent chunked to HTTP/1.1 clients so the
+  connection can stay open, anybody else gets the connection closed."""
 
   server_software = 'wiseguy/%s' % wiseguy.__version__
   start = None
   request_handler = None
+  # largest single sendfile() call, so a huge file doesn't hold up signals
+  sendfile_chunk_size = 1024 * 1024
+  # the status line, headers and body are collected and sent together.
+  # when the whole body is already in memory (a list or tuple), blocks are
+  # held back until there is this much to send. anything else is sent a
+  # block at a time, as PEP 333 asks for streaming responses.
+  write_buffer_size = 16 * 1024
+  _coalesce = False
+  _write_buffer = None
+  _write_buffer_size = 0
+  _chunked = False
+  _headers_written = False
+
+  def _write(self, data):
+    if self._chunked and self._headers_written and data:
+      data = '%x\r\n%s\r\n' % (len(data), data)
+    if self._write_buffer is None:
+      self._write_buffer = []
+    self._write_buffer.append(data)
+    self._write_buffer_size += len(data)
+
+  def _flush(self):
+    # BaseHandler.write calls this after every block
+    if not self._coalesce or self._write_buffer_size >= self.write_buffer_size:
+      self.flush_buffer()
+
+  def flush_buffer(self):
+    """Send everything buffered so far in a single write."""
+    if self._write_buffer:
+      if len(self._write_buffer) == 1:
+        data = self._write_buffer[0]
+      else:
+        data = ''.join(self._write_buffer)
+      self._write_buffer = None
+      self._write_buffer_size = 0
+      # not SimpleHandler._write and _flush, they replace themselves with
+      # the stdout methods on first use and the buffering would be bypassed
+      self.stdout.write(data)
+    self.stdout.flush()
   
   def log_exception(self, exc_info):
     try:
-      elapsed = time.time() - self.start      
+      # the application can fail before finish_response sets start
+      elapsed = time.time() - (self.start or self.request_handler.start_time)
       logging.exception('wsgi error %s "%s" %s',
          elapsed, self.request_handler.raw_requestline, self.headers)
     finally:
@@ -129,14 +393,42 @@ class WiseguyWSGIHandler(simple_server.ServerHandler):
     return self.request_handler.http_version
   
   def cleanup_headers(self):
+    request = self.request_handler
+    if request.command == 'HEAD' or self.status[:3] in ('204', '304'):
+      pass
+    elif ('Content-Length' not in self.headers and
+          'Transfer-Encoding' not in self.headers):
+      self.set_content_length()
+      if 'Content-Length' in self.headers:
+        pass
+      elif (request.request_version == 'HTTP/1.1' and
+            not request.close_connection):
+        self.headers['Transfer-Encoding'] = 'chunked'
+        self._chunked = True
+      else:
+        # the end of the body is the end of the connection
+        request.close_connection = True
+    if not request.close_connection and request.request_version == 'HTTP/1.0':
+      self.headers['Connection'] = 'keep-alive'
     # NOTE: make sure you communicate to the client that you will close the
     # underlying connection
-    if self.request_handler.close_connection:
+    if request.close_connection:
       self.headers['Connection'] = 'close'
 
+  def send_headers(self):
+    simple_server.ServerHandler.send_headers(self)
+    self._headers_written = True
+
+  def finish_content(self):
+    simple_server.ServerHandler.finish_content(self)
+    if self._chunked:
+      self._chunked = False
+      self._write('0\r\n\r\n')
+
   def finish_response(self):
     self.start = time.time()
     if not self.result_is_file() or not self.sendfile():
+      self._coalesce = isinstance(self.result, (list, tuple))
       for data in self.result:
         if self.request_handler.command != 'HEAD':
           self.write(data)
@@ -144,49 +436,305 @@ class WiseguyWSGIHandler(simple_server.ServerHandler):
       if self.request_handler.command == 'HEAD':
         self.write('')
       self.finish_content()
+      self.flush_buffer()
     self.close()
 
+  def sendfile(self):
+    """Send a wsgi.file_wrapper response wrapping a regular file with
+    sendfile(), honoring a single byte Range.
 
-class SocketFileWrapper(object):
-  """A simple wrapper to keep track of the bytes read.
+    Anything else (no sendfile, pipes, StringIO...) returns False and goes
+    through the normal iteration, a block at a time."""
+    if sendfile is None or self.request_handler.command not in ('GET', 'HEAD'):
+      return False
+    filelike = self.result.filelike
+    try:
+      in_fd = filelike.fileno()
+      stat_result = os.fstat(in_fd)
+      offset = filelike.tell()
+    except (AttributeError, EnvironmentError, ValueError):
+      return False
+    if not stat.S_ISREG(stat_result.st_mode):
+      return False
+    size = max(0, stat_result.st_size - offset)
+    length = size
+
+    self.headers['Accept-Ranges'] = 'bytes'
+    byte_range = None
+    range_value = self.environ.get('HTTP_RANGE')
+    if range_value and self.status.startswith('200'):
+      if_range = self.environ.get('HTTP_IF_RANGE')
+      if if_range is None or if_range in (
+        self.headers.get('ETag'), self.headers.get('Last-Modified')):
+        byte_range = parse_byte_range(range_value, size)
+    if byte_range is not None:
+      start, stop = byte_range
+      if start >= size:
+        self.status = '416 Requested Range Not Satisfiable'
+        self.headers['Content-Range'] = 'bytes */%s' % size
+        length = 0
+      else:
+        self.status = '206 Partial Content'
+        self.headers['Content-Range'] = 'bytes %s-%s/%s' % (
+          start, stop - 1, size)
+        offset += start
+        length = stop - start
+    elif self.headers.get('Content-Length') is not None:
+      length = min(length, int(self.headers['Content-Length']))
+    self.headers['Content-Length'] = str(length)
+
+    self.send_headers()
+    self.flush_buffer()
+    if self.request_handler.command == 'HEAD':
+      return True
+    out_fd = self.request_handler.connection.fileno()
+    while length > 0:
+      try:
+        sent = sendfile(out_fd, in_fd, offset,
+                        min(length, self.sendfile_chunk_size))
+      except OSError, e:
+        if e[0] == errno.EINTR:
+          continue
+        if e[0] == errno.EAGAIN:
+          # the socket has a timeout, so it's non-blocking underneath
+          select.select([], [out_fd], [],
+                        self.request_handler.connection.gettimeout())
+          continue
+        raise
+      if not sent:
+        # the file got shorter, the client is not getting what we promised
+        self.request_handler.close_connection = True
+        break
+      offset += sent
+      length -= sent
+      self.bytes_sent += sent
+    return True
 
-  This is not complete and may break - for instance if people start sending
-  us data with 'Transfer-Encoding: chunked', but it works for now.
+
+class RequestEntityTooLarge(IOError):
+  pass
+
+
+class SocketFileWrapper(object):
+  """Wrap the connection's rfile, count the bytes read and serve as
+  wsgi.input.
+
+  Between requests this reads the raw stream - the request line and the
+  headers. Once begin_body has been called, reads are limited to the request
+  body, plain or chunked, so an application can't read into the next
+  request. Nothing here reads more than asked for, so a large upload can be
+  streamed a block at a time with read(n), readinto or iter_blocks.
   """
+  # what read() with no size and iter_blocks read at a time
+  block_size = 64 * 1024
+  max_chunk_line = 1024
+
   def __init__(self, _file, request_handler):
     self.file = _file
     self.request_handler = request_handler
     self._bytes_read = 0
+    # body state - None when not reading a body, otherwise the bytes left in
+    # the body (or in the current chunk)
+    self._remaining = None
+    self._chunked = False
+    self._chunk_started = False
+    self._eof = True
+    self._body_read = 0
+    self._max_body_size = None
 
   def __getattr__(self, name):
     return getattr(self.file, name)
 
+  def __iter__(self):
+    return iter(self.readline, '')
+
   def get_content_length(self):
     cl = self.request_handler.headers.getheader('Content-Length')
     if cl is None:
       return cl
     return int(cl)
-    
-  def read(self, size=-1):
-    if self.get_content_length() is None:
-      return ''
-    
-    if size < 0:
-      # read up to the content-length
-      size = self.get_content_length()
 
-    result = self.file.read(size)
-    self._bytes_read += len(result)
-    return result
+  def begin_body(self, max_body_size=None):
+    """Limit reads to the body of the request whose headers were just
+    parsed. Raises RequestEntityTooLarge if the declared length is over
+    max_body_size, and ValueError for a bogus Content-Length."""
+    headers = self.request_handler.headers
+    self._max_body_size = max_body_size
+    self._body_read = 0
+    self._chunk_started = False
+    transfer_encoding = headers.getheader('Transfer-Encoding', '')
+    if transfer_encoding.lower().endswith('chunked'):
+      self._chunked = True
+      self._remaining = 0
+      self._eof = False
+      return
+    self._chunked = False
+    content_length = self.get_content_length() or 0
+    if content_length < 0:
+      raise ValueError('negative Content-Length')
+    if max_body_size is not None and content_length > max_body_size:
+      raise RequestEntityTooLarge('request body too large: %s' %
+                                  content_length)
+    self._remaining = content_length
+    self._eof = not content_length
+
+  def end_body(self):
+    """Go back to reading the raw stream for the next request."""
+    self._remaining = None
+    self._chunked = False
+    self._eof = True
+
+  def body_finished(self):
+    """True if the whole body has been read."""
+    return self._remaining is None or self._eof
+
+  def drain(self, limit, timeout=None):
+    """Read and throw away the rest of the body, up to limit bytes.
+
+    Gives up if the client doesn't send anything for timeout seconds.
+    Returns True if the end of the body was reached."""
+    while not self.body_finished() and limit > 0:
+      if not self.buffered_size():
+        ready_rfds, ready_wfds, ready_xfds = select.select(
+          [self.file], [], [], timeout)
+        if not ready_rfds:
+          return False
+      data = self._read_some(min(limit, self.block_size))
+      limit -= len(data)
+    return self.body_finished()
+
+  def _read_chunk_header(self):
+    if self._chunk_started:
+      # the CRLF after the previous chunk
+      self._bytes_read += len(self.file.readline(self.max_chunk_line))
+    self._chunk_started = True
+    line = self.file.readline(self.max_chunk_line)
+    self._bytes_read += len(line)
+    try:
+      size = int(line.split(';', 1)[0].strip(), 16)
+    except ValueError:
+      self.request_handler.close_connection = True
+      raise IOError('bad chunk size: %r' % line[:80])
+    if size < 0:
+      self.request_handler.close_connection = True
+      raise IOError('bad chunk size: %r' % line[:80])
+    if not size:
+      # skip the trailers
+      while True:
+        line = self.file.readline(self.max_chunk_line)
+        self._bytes_read += len(line)
+        if line in ('\r\n', '\n', ''):
+          break
+      self._eof = True
+    self._remaining = size
+
+  def _available(self):
+    """Return how much of the body can be read without crossing a chunk."""
+    if self._eof:
+      return 0
+    if not self._remaining and self._chunked:
+      self._read_chunk_header()
+    return self._remaining
+
+  def _account(self, data):
+    length = len(data)
+    self._bytes_read += length
+    self._body_read += length
+    self._remaining -= length
+    if not data:
+      # the client went away mid-body
+      self._eof = True
+      self.request_handler.close_connection = True
+    elif not self._remaining and not self._chunked:
+      self._eof = True
+    if (self._max_body_size is not None and
+        self._body_read > self._max_body_size):
+      self._eof = True
+      self.request_handler.close_connection = True
+      raise RequestEntityTooLarge('request body too large: %s' %
+                                  self._body_read)
+
+  def _read_some(self, size):
+    size = min(size, self._available())
+    if size <= 0:
+      return ''
+    data = self.file.read(size)
+    self._account(data)
+    return data
 
-  def readline(self, *args):
-    result = self.file.readline(*args)
-    self._bytes_read += len(result)
-    return result
+  def read(self, size=-1):
+    if self._remaining is None:
+      result = self.file.read(size)
+      self._bytes_read += len(result)
+      return result
+    if size is None or size < 0:
+      size = sys.maxint
+    chunks = []
+    while size > 0:
+      data = self._read_some(min(size, self.block_size))
+      if not data:
+        break
+      chunks.append(data)
+      size -= len(data)
+    return ''.join(chunks)
+
+  def readline(self, size=-1):
+    if self._remaining is None:
+      if size is None or size < 0:
+        result = self.file.readline()
+      else:
+        result = self.file.readline(size)
+      self._bytes_read += len(result)
+      return result
+    if size is None or size < 0:
+      size = sys.maxint
+    chunks = []
+    while size > 0:
+      available = min(size, self._available())
+      if available <= 0:
+        break
+      data = self.file.readline(available)
+      self._account(data)
+      if not data:
+        break
+      chunks.append(data)
+      size -= len(data)
+      if data.endswith('\n'):
+        break
+    return ''.join(chunks)
+
+  def readlines(self, hint=-1):
+    lines = []
+    total = 0
+    for line in self:
+      lines.append(line)
+      total += len(line)
+      if 0 < hint <= total:
+        break
+    return lines
+
+  def readinto(self, buffer):
+    """Read up to len(buffer) bytes of the body into buffer."""
+    data = self.read(len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+  def iter_blocks(self, block_size=None):
+    """Yield the rest of the body at most block_size bytes at a time."""
+    block_size = block_size or self.block_size
+    while True:
+      data = self.read(block_size)
+      if not data:
+        return
+      yield data
 
   def socket_tell(self):
     return self._bytes_read
-   
+
+  def buffered_size(self):
+    """Return the number of bytes read from the socket but not consumed."""
+    return self.file._rbuf.tell()
+
 
 class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
   # force http 1.1 protocol version
@@ -200,6 +748,8 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
   # how long will we wait after accepting a connection or processing a request
   # before we return to the accept() loop
   keepalive_timeout = 5.0
+  # the most unread request body we'll throw away to keep a connection alive
+  max_drain_size = 64 * 1024
 
   def setup(self):
     self.connection = self.request
@@ -214,13 +764,104 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
     self.rfile = SocketFileWrapper(self.rfile, self)
 
   def parse_request(self):
+    """Parse the request line and the headers in one pass.
+
+    This replaces BaseHTTPRequestHandler.parse_request - rather than building
+    a mimetools.Message and walking it again in get_environ, the header block
+    goes straight into the environ keys (header_environ) and a plain dict
+    (headers)."""
     try:
-      return simple_server.WSGIRequestHandler.parse_request(self)
+      return self._parse_request()
     finally:
-      # save the amount of data read at this point to optimize POST
-      # keep-alive
+      # save the size of the request line and headers
       self.header_size = self.rfile.socket_tell()
 
+  def _parse_request(self):
+    self.command = None  # set in case of error on the first line
+    self.request_version = version = self.default_request_version
+    self.close_connection = 1
+    requestline = self.raw_requestline.rstrip('\r\n')
+    self.requestline = requestline
+    words = requestline.split()
+    if len(words) == 3:
+      command, path, version = words
+      if version == 'HTTP/1.1':
+        self.close_connection = 0
+      elif version != 'HTTP/1.0':
+        try:
+          if version[:5] != 'HTTP/':
+            raise ValueError
+          version_number = version[5:].split('.')
+          if len(version_number) != 2:
+            raise ValueError
+          version_number = int(version_number[0]), int(version_number[1])
+        except ValueError:
+          self.send_error(400, 'Bad request version (%r)' % version)
+          return False
+        if version_number >= (2, 0):
+          self.send_error(505, 'Invalid HTTP Version (%s)' % version[5:])
+          return False
+        if version_number >= (1, 1):
+          self.close_connection = 0
+    elif len(words) == 2:
+      command, path = words
+      if command != 'GET':
+        self.send_error(400, 'Bad HTTP/0.9 request type (%r)' % command)
+        return False
+    elif not words:
+      return False
+    else:
+      self.send_error(400, 'Bad request syntax (%r)' % requestline)
+      return False
+    self.command, self.path, self.request_version = command, path, version
+
+    if not self.parse_headers():
+      return False
+    conntype = self.headers.get('connection', '').lower()
+    if conntype == 'close':
+      self.close_connection = 1
+    elif conntype == 'keep-alive':
+      self.close_connection = 0
+    return True
+
+  def parse_headers(self):
+    """Read the header block into headers and header_environ."""
+    headers = self.headers = RequestHeaders()
+    environ = self.header_environ = {}
+    readline = self.rfile.readline
+    environ_key = None
+    for i in xrange(max_header_count + 1):
+      line = readline(max_header_line + 1)
+      if len(line) > max_header_line:
+        self.send_error(400, 'Header line too long')
+        return False
+      if line in ('\r\n', '\n', ''):
+        return True
+      if line[0] in ' \t':
+        # continuation of the previous header
+        if environ_key is None:
+          continue
+        value = ' ' + line.strip()
+        environ[environ_key] += value
+        headers[name] += value
+        continue
+      name, sep, value = line.partition(':')
+      if not sep:
+        # no colon, not a header. mimetools would stop here too.
+        return True
+      value = value.strip()
+      environ_key = get_environ_key(name)
+      name = name.lower()
+      if environ_key in environ:
+        # comma-separate multiple headers
+        environ[environ_key] += ',' + value
+        headers[name] += ',' + value
+      else:
+        environ[environ_key] = value
+        headers[name] = value
+    self.send_error(400, 'Too many headers')
+    return False
+
   @property
   def http_version(self):
     return self.request_version.split('/')[-1]
@@ -242,6 +883,10 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
     try:
       self.handle_one_request()
       while not self.close_connection:
+        # let the server hold on to the idle connection so this child can
+        # get on with other requests
+        if self.server.park_connection(self):
+          return
         self.handle_one_request()
     except select.error, e:
       raise
@@ -253,45 +898,62 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
                           self.address_string(), self.raw_requestline, e, elapsed)
 
   def handle_one_request(self):
-    ready_rfds, ready_wfds, ready_xfds = select.select(
-      [self.rfile], [], [self.rfile], self.keepalive_timeout)
-    if not ready_rfds:
-      logging.debug('%s closing idle connection', self.address_string())
-      self.close_connection = True
-      return
+    # a pipelined request might already be sitting in the read buffer, where
+    # select() can't see it
+    if not self.rfile.buffered_size():
+      ready_rfds, ready_wfds, ready_xfds = select.select(
+        [self.rfile], [], [self.rfile], self.keepalive_timeout)
+      if not ready_rfds:
+        logging.debug('%s closing idle connection', self.address_string())
+        self.close_connection = True
+        return
 
     self.start_time = time.time()
+    path = None
     try:
-      self.raw_requestline = self.rfile.readline()
+      self.raw_requestline = self.rfile.readline(max_header_line + 1)
+      if len(self.raw_requestline) > max_header_line:
+        self.requestline = ''
+        self.request_version = ''
+        self.command = ''
+        self.send_error(414)
+        self.close_connection = True
+        return
       if not self.parse_request(): # An error code has been sent, just exit
         return
-
-      if self.server._should_profile_request(self):
-        profiling = True
-        self.server._profile.runcall(self._run_wsgi_app)
-      else:
-        self._run_wsgi_app()
-
-      # This deserves some explanation. If we get a malformed request, bail
-      # out early or for any other reason don't consume the inbound stream,
-      # we need to close the connection to prevent a persistent connection
-      # from getting confused. The best way to handle this is to assume we
-      # close on a POST and only keep alive when we are pretty sure we can.
-      # This check means that only urlencoded POSTs are going to stay alive,
-      # multipart forms with close every time.
-      if self.command == 'POST':
+      try:
+        self.rfile.begin_body(self.server.max_body_size)
+      except RequestEntityTooLarge:
+        self.send_error(413)
+        self.close_connection = True
+        return
+      except ValueError:
+        self.send_error(400, 'Bad Content-Length')
         self.close_connection = True
-        content_length_value = self.headers.getheader('Content-Length')
-        if content_length_value is not None:
-          content_length = int(content_length_value)
-          # We consider the POST request 'safe' to keep alive when we know the
-          # size before hand and that matches exactly the amount of data we
-          # have read from the inbound stream.
-          if self.rfile.socket_tell() == (self.header_size + content_length):
-            self.close_connection = False
+        return
+      path = self.path.split('?', 1)[0]
+      self.server._scoreboard.set_busy(path)
+      self.server.run_request(path, self._run_wsgi_app)
+
+      # If the application didn't consume the whole body, the rest of it is
+      # still in the stream ahead of the next request. Read and discard it
+      # so the connection can stay open, but don't spend more than
+      # max_drain_size bytes or keepalive_timeout seconds on it - past that,
+      # closing the connection is cheaper.
+      if not self.close_connection and not self.rfile.body_finished():
+        try:
+          if not self.rfile.drain(self.max_drain_size, self.keepalive_timeout):
+            self.close_connection = True
+        except (IOError, socket.error), e:
+          logging.debug('%s error draining request body: %s',
+                        self.address_string(), e)
+          self.close_connection = True
     finally:
+      self.rfile.end_body()
       # this tracks the number of requests handled by a persistent connection
       self.request_count += 1
+      if path is not None:
+        self.server.record_latency(path, time.time() - self.start_time)
 
       # we need to call the close_request functionality here, but only if we
       # are dealing with persistent connections - otherwise this will be
@@ -309,6 +971,8 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
         # no immediately upleasant implication.
         if self.server._quit:
           self.close_connection = True
+        else:
+          self.server._scoreboard.set_keepalive()
 
   def _run_wsgi_app(self):
     handler = self.wsgi_handler_class(
@@ -321,41 +985,19 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
   def get_environ(self):
     """An optimization for code orginally wsgiref.handlers."""
     env = self.server.base_environ.copy()
+    env.update(self.header_environ)
     env['SERVER_PROTOCOL'] = self.request_version
     env['REQUEST_METHOD'] = self.command
-    if '?' in self.path:
-      path, query = self.path.split('?', 1)
-    else:
-      path, query = self.path, ''
-
-    env['PATH_INFO'] = urllib.unquote(path)
+    path, sep, query = self.path.partition('?')
+    if '%' in path:
+      path = urllib.unquote(path)
+    env['PATH_INFO'] = path
     env['QUERY_STRING'] = query
-
-    host = self.address_string()
-    if host != self.client_address[0]:
-      env['REMOTE_HOST'] = host
+    # address_string doesn't resolve, so REMOTE_HOST stays as it is
     env['REMOTE_ADDR'] = self.client_address[0]
-
-    if self.headers.typeheader is None:
-      env['CONTENT_TYPE'] = self.headers.type
-    else:
-      env['CONTENT_TYPE'] = self.headers.typeheader
-
-    length = self.headers.getheader('content-length')
-    if length:
-      env['CONTENT_LENGTH'] = length
-
-    for h in self.headers.headers:
-      k, v = h.split(':', 1)
-      k = k.translate(translate_header_table)
-      v = v.strip()
-      if k in env:
-        continue
-      http_key = 'HTTP_' + k
-      if http_key in env:
-        env[http_key] += ',' + v     # comma-separate multiple headers
-      else:
-        env[http_key] = v
+    if 'CONTENT_TYPE' not in env:
+      # what mimetools.Message used to default to
+      env['CONTENT_TYPE'] = 'text/plain'
     return env
 
 
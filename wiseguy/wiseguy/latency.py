@@ -0,0 +1,163 @@
+"""Fixed bucket request latency histograms kept in shared memory.
+
+Every scoreboard slot gets a row of counters for each URL prefix class. A
+child only ever increments the counters of its own slot, so recording a
+request is a bucket lookup and a single 8 byte write - there is nothing to
+flush and nothing is lost when a child exits. The counters only go up, so a
+reader that races with a writer is at worst one request behind.
+
+When the parent reaps a child, it folds the slot into its retired totals
+and zeroes it for the next child.
+
+The buckets are log-linear: each power of two between MIN_LATENCY and
+MIN_LATENCY * 2**OCTAVES is split into SUB_BUCKETS equal steps, which keeps
+the relative error under 1/SUB_BUCKETS at any scale.
+"""
+
+import math
+import mmap
+import struct
+import threading
+
+MIN_LATENCY = 0.0001
+OCTAVES = 20
+SUB_BUCKETS = 4
+# bucket 0 is everything under MIN_LATENCY, the last bucket everything over
+# the top of the range
+BUCKET_COUNT = OCTAVES * SUB_BUCKETS + 2
+COUNTER_FORMAT = '<Q'
+COUNTER_SIZE = struct.calcsize(COUNTER_FORMAT)
+ROW_FORMAT = '<%dQ' % BUCKET_COUNT
+ROW_SIZE = struct.calcsize(ROW_FORMAT)
+
+# the class for paths that don't match any of the prefixes
+OTHER_CLASS = 'other'
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def bucket_index(seconds):
+  if seconds < MIN_LATENCY:
+    return 0
+  # frexp gives seconds / MIN_LATENCY = mantissa * 2**exponent with the
+  # mantissa in [0.5, 1)
+  mantissa, exponent = math.frexp(seconds / MIN_LATENCY)
+  index = 1 + (exponent - 1) * SUB_BUCKETS + int(
+    (mantissa * 2 - 1) * SUB_BUCKETS)
+  return min(index, BUCKET_COUNT - 1)
+
+def bucket_upper_bound(index):
+  """Return the largest latency that lands in bucket index."""
+  if index == 0:
+    return MIN_LATENCY
+  if index == BUCKET_COUNT - 1:
+    return float('inf')
+  octave, step = divmod(index - 1, SUB_BUCKETS)
+  return MIN_LATENCY * 2 ** octave * (1 + float(step + 1) / SUB_BUCKETS)
+
+def get_percentiles(counts, percentiles=PERCENTILES):
+  """Return the upper bound of the bucket holding each percentile."""
+  total = sum(counts)
+  results = []
+  for percentile in percentiles:
+    if not total:
+      results.append(None)
+      continue
+    target = percentile * total
+    running = 0
+    for index, count in enumerate(counts):
+      running += count
+      if running >= target:
+        results.append(bucket_upper_bound(index))
+        break
+  return results
+
+def add_counts(total, counts):
+  for index, count in enumerate(counts):
+    total[index] += count
+
+
+class LatencyHistograms(object):
+  def __init__(self, slot_count, prefixes=()):
+    """prefixes - URL prefixes that get their own histogram, a path is
+    counted against the longest prefix it starts with"""
+    self.slot_count = slot_count
+    # longest first, so the first match is the most specific one
+    self.prefixes = sorted(prefixes, key=len, reverse=True)
+    self.class_names = list(self.prefixes) + [OTHER_CLASS]
+    self._class_count = len(self.class_names)
+    self._mmap = mmap.mmap(-1, slot_count * self._class_count * ROW_SIZE,
+                           mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    # parent side - counts from children that have been reaped
+    self._retired = [[0] * BUCKET_COUNT for name in self.class_names]
+    self._lock = threading.Lock()
+
+  def _row_offset(self, slot, class_index):
+    return (slot * self._class_count + class_index) * ROW_SIZE
+
+  def get_class_index(self, path):
+    for class_index, prefix in enumerate(self.prefixes):
+      if path.startswith(prefix):
+        return class_index
+    return self._class_count - 1
+
+  # child side
+
+  def record(self, slot, path, seconds):
+    if slot is None:
+      return
+    offset = (self._row_offset(slot, self.get_class_index(path)) +
+              bucket_index(seconds) * COUNTER_SIZE)
+    struct.pack_into(COUNTER_FORMAT, self._mmap, offset,
+                     struct.unpack_from(COUNTER_FORMAT, self._mmap, offset)[0]
+                     + 1)
+
+  # parent side
+
+  def read_slot(self, slot):
+    """Return a list of bucket counts for each class."""
+    return [list(struct.unpack_from(ROW_FORMAT, self._mmap,
+                                    self._row_offset(slot, class_index)))
+            for class_index in xrange(self._class_count)]
+
+  def retire_slot(self, slot):
+    """Fold the counts of a reaped child into the totals and clear slot."""
+    if slot is None:
+      return
+    rows = self.read_slot(slot)
+    self._lock.acquire()
+    try:
+      for total, counts in zip(self._retired, rows):
+        add_counts(total, counts)
+    finally:
+      self._lock.release()
+    start = self._row_offset(slot, 0)
+    self._mmap[start:start + self._class_count * ROW_SIZE] = (
+      '\0' * (self._class_count * ROW_SIZE))
+
+  def get_class_counts(self, slots):
+    """Return class name -> bucket counts, for slots plus retired children."""
+    self._lock.acquire()
+    try:
+      totals = [list(counts) for counts in self._retired]
+    finally:
+      self._lock.release()
+    for slot in slots:
+      for total, counts in zip(totals, self.read_slot(slot)):
+        add_counts(total, counts)
+    return dict(zip(self.class_names, totals))
+
+  def get_slot_counts(self, slot):
+    """Return the bucket counts of a live slot across all classes."""
+    total = [0] * BUCKET_COUNT
+    for counts in self.read_slot(slot):
+      add_counts(total, counts)
+    return total
+
+
+def format_latency_line(name, counts):
+  percentiles = get_percentiles(counts)
+  if percentiles[0] is None:
+    return '%s: count=0' % name
+  return '%s: count=%s %s' % (name, sum(counts), ' '.join(
+    'p%d=%.4f' % (percentile * 100, value)
+    for percentile, value in zip(PERCENTILES, percentiles)))
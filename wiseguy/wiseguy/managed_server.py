@@ -1,11 +1,15 @@
 import errno
 import fcntl
+import gc
 import logging
+import marshal
 import os
 import signal
 import socket
 import sys
+import tempfile
 import threading
+import time
 
 try:
   from wiseguy import fd_server
@@ -13,8 +17,21 @@ except ImportError:
   # fd_server is python2.6 only
   fd_server = None
   
+from wiseguy import accounting
+from wiseguy import fleet_profile
+from wiseguy import latency
 from wiseguy import management_server
 from wiseguy import micro_management_server
+from wiseguy import scoreboard
+
+# python2 doesn't export this one
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+  SO_REUSEPORT = 15
+
+
+# a generation 2 threshold the count never gets to
+OOB_GC_THRESHOLD = 2 ** 31 - 1
 
 
 class WiseguyError(Exception):
@@ -23,6 +40,12 @@ class WiseguyError(Exception):
 
 class ManagedServer(object):
   management_server_class = management_server.ManagementServer
+  # the most workers you can ask for at runtime
+  worker_limit = 64
+  # how often the children dump their share of the fleet profile, and how
+  # far back the parent's merged profile goes
+  fleet_profile_interval = fleet_profile.DUMP_INTERVAL
+  fleet_profile_window = fleet_profile.WINDOW
   
   def __init__(self, server_address=None, management_address=None,
                workers=5, max_requests=None,
@@ -33,6 +56,19 @@ class ManagedServer(object):
                fd_server_address=None,
                drop_privileges_callback=None,
                max_total_mem=None,
+               min_workers=None, max_workers=None,
+               freeze_heap=False,
+               reuse_port=False,
+               accept_mutex=False,
+               latency_prefixes=(),
+               threads=1,
+               fleet_profile_rate=0,
+               fleet_profile_path=None,
+               oob_gc=False,
+               oob_gc_requests=None,
+               oob_gc_allocations=None,
+               request_deadline=None,
+               request_deadline_overrides=(),
                **kargs):
     """Construct the manager for a particular server instance.
     server_address - a (host, port) tuple or string
@@ -40,11 +76,43 @@ class ManagedServer(object):
       if there is no server address, assume STDIN is a socket
     accept_input_timeout - set a timeout between the accept() call
       and the time we get data on an incoming socket, milliseconds 
+    min_workers, max_workers - if max_workers is set, the number of workers
+      adapts to load between these bounds, starting at workers
+    freeze_heap - collect (and freeze, if the interpreter can) the parent's
+      heap after the prefork functions run, so the children share more pages.
+      without gc.freeze the children never run full collections on their
+      own, see freeze_heap
+    reuse_port - each child listens on its own SO_REUSEPORT socket and the
+      kernel balances connections between them. the parent keeps the shared
+      socket bound (but not listening) so the fd_server handoff still works.
+    accept_mutex - serialize accept() across the children with a lock file,
+      so only one idle child waits on the listening socket at a time
+    latency_prefixes - URL prefixes that get their own latency histogram
+      and usage counters, everything else is counted as 'other'
+    threads - request threads per child. they share the listening socket,
+      only one thread in each child waits for a connection at a time
+    fleet_profile_rate - the fraction of requests every child runs under
+      cProfile. the children dump their stats to fleet_profile_path (a
+      temporary directory by default) every fleet_profile_interval seconds
+      and the parent serves the merged profile of the last
+      fleet_profile_window seconds.
+    oob_gc - turn off automatic full collections in the children and run
+      them from close_request, once the response has gone out. a child
+      collects every oob_gc_requests requests, or once it has allocated
+      about oob_gc_allocations more objects than it has freed - by default
+      as often as the interpreter's own thresholds would have.
+    request_deadline - seconds a request may run before the parent logs the
+      child's stack and kills it
+    request_deadline_overrides - (URL prefix, seconds) pairs for paths that
+      need a different deadline, the longest matching prefix wins. 0 means
+      no deadline.
     """
     if kargs:
       logging.warning('passing deprecated args: %s', ', '.join(kargs.keys()))
       
     self._workers = workers
+    self._min_workers = None
+    self._max_workers = None
     self._server_address = server_address
     self._management_address = management_address
     self._fd_server_address = fd_server_address
@@ -52,6 +120,10 @@ class ManagedServer(object):
     self._listen_fd = 0
     self._accept_input_timeout = accept_input_timeout
     self._child_pids = set()
+    # pid -> deadline for children that have been asked to exit gracefully
+    self._recycle_deadlines = {}
+    # pids flagged by other threads, for manage_children to recycle
+    self._pending_recycles = []
     self._quit = False
     self._max_requests = max_requests
     self._max_rss = max_rss
@@ -65,10 +137,55 @@ class ManagedServer(object):
     self._profile_memory = profile_memory
     self._profile_memory_min_delta = 0
     self._profile = None
-    self._profiling = None
     self._profiler_module = profiler_module
+    if fleet_profile_rate:
+      self._fleet_profile = fleet_profile.FleetProfile(
+        fleet_profile_rate, fleet_profile_path, self.fleet_profile_interval,
+        self.fleet_profile_window)
+    else:
+      self._fleet_profile = None
+    self._last_fleet_profile_time = 0
+    self._oob_gc = oob_gc
+    self._oob_gc_requests = oob_gc_requests
+    self._oob_gc_allocations = oob_gc_allocations
+    self._oob_gc_request_count = 0
+    self._request_deadline = request_deadline
+    # longest first, so the first match is the most specific one
+    self._request_deadline_overrides = sorted(
+      request_deadline_overrides, key=lambda x: len(x[0]), reverse=True)
+    # pid -> (time to SIGKILL, request_start_time of the overrun request),
+    # None once killed, for children that have overrun a deadline
+    self._deadline_kills = {}
+    self._deadline_kill_count = 0
+    self._threads = max(1, threads)
+    # per thread request state - whether the current request is profiled,
+    # whether this thread holds the accept lock
+    self._local = threading.local()
+    # the request threads of a child share the request count, the latency
+    # histograms and the memory stats. only one of them can be profiled at
+    # a time. none of these locks are used in the parent.
+    self._accounting_lock = threading.Lock()
+    self._profile_lock = threading.Lock()
+    if self._threads > 1:
+      self._accept_thread_lock = threading.Lock()
+    else:
+      self._accept_thread_lock = None
+    self._prefork_functions = []
     self._init_functions = []
     self._exit_functions = []
+    self._freeze_heap = freeze_heap
+    self._reuse_port = reuse_port
+    # the lock file is opened once and inherited. lockf() locks belong to
+    # the process, not the descriptor, so every child still competes for
+    # it and the kernel drops it if the holder dies.
+    self._accept_lock_file = None
+    if accept_mutex:
+      if reuse_port:
+        logging.warning('accept_mutex is pointless with reuse_port, '
+                        'ignoring it')
+      else:
+        self._accept_lock_file = tempfile.TemporaryFile(
+          prefix='wiseguy-accept-')
     # FIXME: should we add a _privileged_functions? this would run before
     # we drop down from root. would we run these if you weren't root?
     self._drop_privileges_callback = drop_privileges_callback
@@ -83,6 +200,19 @@ class ManagedServer(object):
     # modify the internal state of the running server.
     self._lock = threading.RLock()
     self._fd_server_lock_fd = None
+    self._wakeup_rfd = None
+    self._wakeup_wfd = None
+    # the scoreboard has to exist before the first fork so every child maps
+    # the same pages. leave room for replacements forked before the old
+    # children have exited.
+    self._scoreboard = scoreboard.Scoreboard(
+      2 * max(workers, max_workers or 0, self.worker_limit))
+    self._latency = latency.LatencyHistograms(
+      self._scoreboard.slot_count, latency_prefixes)
+    self._accounting = accounting.RequestAccounting(
+      self._scoreboard.slot_count, self._latency.class_names)
+    if max_workers:
+      self.set_worker_bounds(min_workers or 1, max_workers)
 
     if fd_server and self._fd_server_address:
       # create the instance, but don't start it up just yet
@@ -150,6 +280,52 @@ class ManagedServer(object):
       os.close(self._fd_server_lock_fd)
       self._fd_server_lock_fd = None
 
+  # the self-pipe is used to wake a process blocked in select() when a signal
+  # arrives. the parent uses it for SIGCHLD, so dead children are replaced
+  # immediately, the children use it so SIGTERM is noticed while idle.
+  def init_wakeup_fd(self):
+    if self._wakeup_rfd is not None:
+      return
+    self._wakeup_rfd, self._wakeup_wfd = os.pipe()
+    for fd in (self._wakeup_rfd, self._wakeup_wfd):
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+      flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+      fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+  def close_wakeup_fd(self):
+    for fd in (self._wakeup_rfd, self._wakeup_wfd):
+      if fd is not None:
+        try:
+          os.close(fd)
+        except OSError:
+          pass
+    self._wakeup_rfd = self._wakeup_wfd = None
+
+  def wakeup(self):
+    """Interrupt whatever this process is blocked on.
+
+    Safe to call from any thread. In the parent, the supervision loop will
+    reap, respawn and re-read any shared state (_workers, _allow_spawning)
+    right away."""
+    if self._wakeup_wfd is None:
+      return
+    try:
+      os.write(self._wakeup_wfd, '\0')
+    except OSError, e:
+      # EAGAIN means the pipe is full, so a wakeup is already pending
+      if e[0] not in (errno.EAGAIN, errno.EBADF):
+        logging.warning('wakeup failed: %s', e)
+
+
+  def drain_wakeup_fd(self):
+    try:
+      while os.read(self._wakeup_rfd, 4096):
+        pass
+    except OSError, e:
+      if e[0] != errno.EAGAIN:
+        raise
+
   @property
   def child_pids(self):
     """Return an immutable, consistent copy of the current child pids."""
@@ -162,6 +338,55 @@ class ManagedServer(object):
   def server_bind(self):
     raise NotImplementedError
 
+  def set_listen_socket(self, sock):
+    """Accept on sock from now on - used by children with reuse_port."""
+    raise NotImplementedError
+
+  def check_reuse_port(self):
+    """Decide if reuse_port can be honored, called once the parent is bound.
+
+    Returns True if the parent should leave the shared socket bound but not
+    listening and let each child open its own."""
+    if not self._reuse_port:
+      return False
+    sock = self._listen_socket
+    if (SO_REUSEPORT is None or sock is None or
+        sock.family not in (socket.AF_INET, socket.AF_INET6)):
+      logging.warning('reuse_port needs a TCP server address, ignoring it')
+      self._reuse_port = False
+      return False
+    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+      # the socket came from an fd_server that is already accepting on it,
+      # the children wouldn't be able to share the port with it.
+      logging.warning('inherited a listening socket, ignoring reuse_port '
+                      'until the next cold start')
+      self._reuse_port = False
+      return False
+    # the children open their sockets after privileges are dropped, make
+    # sure they will actually be able to
+    try:
+      self.open_reuse_port_socket(listen=False).close()
+    except socket.error, e:
+      logging.warning('unable to use reuse_port on %s: %s',
+                      sock.getsockname(), e)
+      self._reuse_port = False
+      return False
+    return True
+
+  def open_reuse_port_socket(self, listen=True):
+    """Open a new SO_REUSEPORT socket on the address of the shared socket."""
+    sock = socket.socket(self._listen_socket.family, socket.SOCK_STREAM)
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+      sock.bind(self._listen_socket.getsockname())
+      if listen:
+        sock.listen(socket.SOMAXCONN)
+    except socket.error:
+      sock.close()
+      raise
+    return sock
+
   def server_activate(self):
     # you need to very precisely control the order of operations here so
     # that you don't end up trying to negotiate for a port from yourself.
@@ -183,7 +408,13 @@ class ManagedServer(object):
     if self._management_server:
       logging.debug('start management_server')
       self._management_server.start()
+    if fd_server:
+      fd_server.close_unclaimed_fds()
         
+  def register_prefork_function(self, function, *pargs, **kargs):
+    """these run once in the parent process, before the first fork"""
+    _register_function(self._prefork_functions, function, pargs, kargs)
+
   def register_init_function(self, function, *pargs, **kargs):
     """these run in the child process prior to starting the request loop"""
     _register_function(self._init_functions, function, pargs, kargs)
@@ -192,6 +423,15 @@ class ManagedServer(object):
     """these run in the child process, after the request loop completes"""
     _register_function(self._exit_functions, function, pargs, kargs)
 
+  def _run_prefork_functions(self):
+    """run functions in FIFO order, raise all exceptions"""
+    for (func, targs, kargs) in self._prefork_functions:
+      try:
+        func(*targs, **kargs)
+      except:
+        logging.exception('exception during prefork function')
+        raise
+
   def _run_init_functions(self):
     """run functions in FIFO order, raise all exceptions"""
     for (func, targs, kargs) in self._init_functions:
@@ -218,18 +458,82 @@ class ManagedServer(object):
     """Override me"""
     raise NotImplementedError
 
+  def init_parent(self):
+    """Run once in the parent before the first child is forked.
+
+    Anything imported or cached here is shared copy-on-write by every child
+    instead of being rebuilt in each of them."""
+    start_time = time.time()
+    self._run_prefork_functions()
+    if self._freeze_heap:
+      freeze_heap()
+    logging.info('init_parent took %.3fs', time.time() - start_time)
+
   def init_child(self):
     """Run before entering the accept loop."""
     
     if self._profile_memory:
       self.init_profile_memory()
+    if self._fleet_profile:
+      self._fleet_profile.init_child()
+    if self._oob_gc:
+      self.init_oob_gc()
+    elif self._freeze_heap and not hasattr(gc, 'freeze'):
+      disable_full_collections()
     self._run_init_functions()
+    if self._reuse_port:
+      self.set_listen_socket(self.open_reuse_port_socket())
+    self._scoreboard.set_idle()
+
+  def acquire_accept_lock(self, blocking=True):
+    """Wait for this child's turn to accept a connection.
+
+    Returns False if a signal interrupted the wait, so the caller can go
+    back and check _quit, or if blocking is False and another child has
+    the lock. With request threads, the other threads of this child count
+    as other children."""
+    if self._accept_thread_lock is not None:
+      if not self._accept_thread_lock.acquire(blocking):
+        return False
+      if self._quit:
+        self._accept_thread_lock.release()
+        return False
+    if self._accept_lock_file is not None:
+      flags = fcntl.LOCK_EX
+      if not blocking:
+        flags |= fcntl.LOCK_NB
+      try:
+        fcntl.lockf(self._accept_lock_file.fileno(), flags)
+      except IOError, e:
+        if self._accept_thread_lock is not None:
+          self._accept_thread_lock.release()
+        if e[0] in (errno.EINTR, errno.EAGAIN, errno.EACCES):
+          return False
+        raise
+    self._local.accept_lock_held = True
+    return True
+
+  def release_accept_lock(self):
+    """Let the next child accept, safe to call if the lock isn't held."""
+    # the flag is per thread - a thread releasing twice must not release
+    # the lock another thread has picked up in the meantime
+    if getattr(self._local, 'accept_lock_held', False):
+      self._local.accept_lock_held = False
+      if self._accept_lock_file is not None:
+        fcntl.lockf(self._accept_lock_file.fileno(), fcntl.LOCK_UN)
+      if self._accept_thread_lock is not None:
+        self._accept_thread_lock.release()
 
   def handle_request(self):
-    try:
-      request, client_address = self.get_request()
-    except socket.error:
+    if not self.acquire_accept_lock():
       return
+    try:
+      try:
+        request, client_address = self.get_request()
+      except socket.error:
+        return
+    finally:
+      self.release_accept_lock()
     if self.verify_request(request, client_address):
       try:
         self.process_request(request, client_address)
@@ -260,19 +564,68 @@ class ManagedServer(object):
     return True
 
   def process_request(self, request, client_address):
-    self._profiling = False
+    path = request.environ.get('PATH_INFO', '')
+    self._scoreboard.set_busy(path)
+    start_time = time.time()
     try:
-      if self._should_profile_request(request):
-        self._profiling = True
-        logging.debug('profile: %s', request.environ.get('PATH_INFO', ''))
-        self._profile.runcall(self.finish_request, request, client_address)
-      else:
-        self.finish_request(request, client_address)
+      self.run_request(path, self.finish_request, request, client_address)
     except IOError, e:
       self._handle_io_error(e)
     except Exception, e:
       self.handle_error(request, client_address)
+    self.record_latency(path, time.time() - start_time)
+
+  def run_request(self, path, function, *pargs):
+    """Call function to serve the request for path, under the profiler if
+    it should be profiled.
+
+    Only one thread at a time can use the profiler, a request that comes up
+    while another thread is being profiled just runs normally.
+
+    The CPU time and memory growth of the request are recorded either way."""
+    start_usage = accounting.get_usage()
+    try:
+      self._run_request(path, function, *pargs)
+    finally:
+      self.record_usage(path, start_usage)
+
+  def _run_request(self, path, function, *pargs):
+    self._local.profiling = False
+    if (self._should_profile_request(path) and
+        self._profile_lock.acquire(False)):
+      self._local.profiling = True
+      try:
+        logging.debug('profile: %s', path)
+        self._profile.runcall(function, *pargs)
+      finally:
+        self._profile_lock.release()
+    elif (self._fleet_profile and self._fleet_profile.should_sample() and
+          self._profile_lock.acquire(False)):
+      try:
+        self._fleet_profile.runcall(function, *pargs)
+      finally:
+        self._profile_lock.release()
+    else:
+      function(*pargs)
+
+  def record_latency(self, path, seconds):
+    self._accounting_lock.acquire()
+    try:
+      self._latency.record(self._scoreboard.slot, path, seconds)
+    finally:
+      self._accounting_lock.release()
       
+  def record_usage(self, path, start_usage):
+    start_cpu_time, start_maxrss = start_usage
+    cpu_time, maxrss = accounting.get_usage()
+    self._accounting_lock.acquire()
+    try:
+      self._accounting.record(
+        self._scoreboard.slot, self._latency.get_class_index(path),
+        cpu_time - start_cpu_time, maxrss - start_maxrss)
+    finally:
+      self._accounting_lock.release()
+
   def get_request(self):
     """Return (request, client_address)
 
@@ -283,6 +636,11 @@ class ManagedServer(object):
     """Finish one request - usually by calling handle()."""
     self.handle(req)
     
+  def drain_requests(self):
+    """Serve requests that have already been read, run once the accept
+    loop is done and before the profile is closed."""
+    pass
+
   def exit_child(self):
     """Run after finishing the accept loop."""
     # note: os._exit skips atexit handlers and doesn't flush stdio
@@ -294,6 +652,9 @@ class ManagedServer(object):
     # descriptors that may have been inherited after the initial fork,
     # for instance the embedded managment server
     #sys.exit(0)
+    self._scoreboard.set_exiting()
+    if self._fleet_profile:
+      self._fleet_profile.dump()
     try:
       # emulating the atexit() functionality here - you want certain
       # thing to tear down, but others (inherited file descriptors
@@ -305,25 +666,37 @@ class ManagedServer(object):
   def exit_parent(self):
     if self._micro_management_server:
       self._micro_management_server.server_unbind()
+    if self._fleet_profile:
+      self._fleet_profile.close()
 
   def close_request(self, req):
     """Run after handle() returns for each connection.
 
     The problem is that the standard library is phrased in terms of 'requests',
     but in reality it is talking about connections."""
-    if self._profile_memory:
-      self.handle_profile_memory(req)
-      
-    if self._max_requests is not None:
-      # if we are profiling a specific servlet, only count the
-      # hits to that servlet against the request limit
-      if self._profile_uri_regex:
-        if self._profiling:
+    self._scoreboard.set_idle()
+    if self._scoreboard.recycle_requested():
+      # the parent has already forked our replacement
+      self._quit = True
+    self._accounting_lock.acquire()
+    try:
+      if self._profile_memory:
+        self.handle_profile_memory(req)
+
+      if self._max_requests is not None:
+        # if we are profiling a specific servlet, only count the
+        # hits to that servlet against the request limit
+        if self._profile_uri_regex:
+          if getattr(self._local, 'profiling', False):
+            self._request_count += 1
+        else:
           self._request_count += 1
-      else:
-        self._request_count += 1
-      if self._request_count >= self._max_requests:
-        self._quit = True
+        if self._request_count >= self._max_requests:
+          self._quit = True
+    finally:
+      self._accounting_lock.release()
+    if self._oob_gc and not self._quit:
+      self.run_oob_gc()
       
     
   # The functionality below is generally about resource and process management
@@ -342,6 +715,40 @@ class ManagedServer(object):
     else:
       raise ValueError('max_rss %s out of sane bounds' % max_rss)
 
+  def set_request_deadline(self, request_deadline):
+    """Set the default request deadline in seconds, 0 turns it off."""
+    request_deadline = float(request_deadline)
+    if request_deadline and request_deadline < 1:
+      raise ValueError('request_deadline %s out of sane bounds' %
+                       request_deadline)
+    self._request_deadline = request_deadline or None
+
+  def get_request_deadline(self, path):
+    """Return the deadline in seconds for a request for path, or None."""
+    for prefix, request_deadline in self._request_deadline_overrides:
+      if path.startswith(prefix):
+        return request_deadline or None
+    return self._request_deadline
+
+  def set_worker_bounds(self, min_workers, max_workers):
+    """Enable adaptive pool sizing between min_workers and max_workers.
+
+    Passing a max_workers of 0 turns it off again."""
+    min_workers, max_workers = int(min_workers), int(max_workers)
+    if not max_workers:
+      self._min_workers = self._max_workers = None
+      return
+    if not 1 <= min_workers <= max_workers <= self.worker_limit:
+      raise ValueError('worker bounds %s-%s out of sane bounds' %
+                       (min_workers, max_workers))
+    self._lock.acquire()
+    try:
+      self._min_workers = min_workers
+      self._max_workers = max_workers
+      self._workers = min(max(self._workers, min_workers), max_workers)
+    finally:
+      self._lock.release()
+
   def set_max_total_mem(self, max_total_mem):
     """Set max_total_mem in kb"""
     max_total_mem = int(max_total_mem)
@@ -352,6 +759,41 @@ class ManagedServer(object):
     else:
       raise ValueError('max_total_mem %s out of sane bounds' % max_total_mem)
 
+  def init_oob_gc(self):
+    """Stop the interpreter from running full collections on its own."""
+    threshold0, threshold1, threshold2 = gc.get_threshold()
+    if not self._oob_gc_requests and not self._oob_gc_allocations:
+      self._oob_gc_allocations = threshold0 * threshold1 * threshold2
+    disable_full_collections()
+    if self._threads > 1:
+      logging.warning('oob_gc with request threads still pauses the '
+                      'requests of the other threads')
+
+  def run_oob_gc(self):
+    """Run a full collection if one is due."""
+    self._accounting_lock.acquire()
+    try:
+      self._oob_gc_request_count += 1
+      if self._oob_gc_requests:
+        due = self._oob_gc_request_count >= self._oob_gc_requests
+      else:
+        due = get_gc_allocation_count() >= self._oob_gc_allocations
+      if due:
+        self._oob_gc_request_count = 0
+    finally:
+      self._accounting_lock.release()
+    if not due:
+      return
+    start_time = time.time()
+    collected = gc.collect()
+    elapsed = time.time() - start_time
+    self._accounting_lock.acquire()
+    try:
+      self._accounting.record_gc(self._scoreboard.slot, elapsed, collected)
+    finally:
+      self._accounting_lock.release()
+    logging.debug('oob_gc collected %s in %.4fs', collected, elapsed)
+
   def set_profile_memory(self, profile_memory, min_delta=None):
     self._profile_memory = profile_memory
     if min_delta is not None:
@@ -388,13 +830,12 @@ class ManagedServer(object):
       current = 'CurRSS:%(VmRSS)s' % current_mem_stats
       logging.info('profile_memory %s %s %s', current, delta, request_uri)
       
-  def _should_profile_request(self, req):
+  def _should_profile_request(self, path):
     # this a little fugly
     if (self._profile and
       (not self._profile_uri_regex or
        (self._profile_uri_regex and
-        self._profile_uri_regex.search(
-        req.environ.get('PATH_INFO', ''))))):
+        self._profile_uri_regex.search(path)))):
       if self._request_count < self._skip_profile_requests:
         return False
       return True
@@ -413,6 +854,81 @@ class ManagedServer(object):
     except:
       logging.exception("handle_server_profile")
 
+  def handle_server_status(self):
+    """Return the scoreboard as a human readable table."""
+    if self._max_workers:
+      workers = 'workers: %s (adaptive %s-%s)\n' % (
+        self._workers, self._min_workers, self._max_workers)
+    else:
+      workers = 'workers: %s\n' % self._workers
+    if self._threads > 1:
+      workers += 'threads: %s per worker\n' % self._threads
+    if self._deadline_kill_count:
+      workers += 'deadline kills: %s\n' % self._deadline_kill_count
+    rolling_status = getattr(self, 'rolling_status', None)
+    if rolling_status:
+      workers += 'rolling restart: %s\n' % rolling_status
+    return workers + scoreboard.format_status(self._scoreboard.snapshot())
+
+  def handle_server_latency(self):
+    """Return request latency percentiles by URL class and by child."""
+    child_pids = set(self.child_pids)
+    slots = [status for status in self._scoreboard.snapshot()
+             if status['pid'] in child_pids]
+    class_counts = self._latency.get_class_counts(
+      [status['slot'] for status in slots])
+    all_counts = [0] * latency.BUCKET_COUNT
+    lines = []
+    for name in self._latency.class_names:
+      latency.add_counts(all_counts, class_counts[name])
+      lines.append(latency.format_latency_line(name, class_counts[name]))
+    lines.insert(0, latency.format_latency_line('all', all_counts))
+    lines.append('')
+    for status in slots:
+      lines.append(latency.format_latency_line(
+        'pid %s' % status['pid'],
+        self._latency.get_slot_counts(status['slot'])))
+    return '\n'.join(lines) + '\n'
+
+  def handle_server_usage(self):
+    """Return per request CPU time and memory growth by URL class, and
+    the out-of-band collections."""
+    child_pids = set(self.child_pids)
+    slots = [status['slot'] for status in self._scoreboard.snapshot()
+             if status['pid'] in child_pids]
+    class_rows = self._accounting.get_class_rows(slots)
+    all_row = accounting.EMPTY_ROW
+    lines = []
+    for name in self._accounting.class_names:
+      all_row = accounting.add_rows(all_row, class_rows[name])
+      lines.append(accounting.format_usage_line(name, class_rows[name]))
+    lines.insert(0, accounting.format_usage_line('all', all_row))
+    lines.append('')
+    lines.append(accounting.format_gc_line(self._accounting.get_gc_row(slots)))
+    return '\n'.join(lines) + '\n'
+
+  def collect_fleet_profile(self):
+    """Merge the profile dumps the children have left since the last call,
+    run by the parent on its check timer."""
+    now = time.time()
+    if (self._fleet_profile and
+        now >= self._last_fleet_profile_time + self.fleet_profile_interval):
+      self._last_fleet_profile_time = now
+      self._fleet_profile.collect()
+
+  def handle_server_fleet_profile(self, format='text', sort='cumulative',
+                                  limit=50):
+    """Return (content_type, data) for the merged fleet profile - a
+    marshalled pstats dict or a pstats report."""
+    if not self._fleet_profile:
+      raise ValueError('fleet profiling is off')
+    if format == 'pstats':
+      request_count, stats = self._fleet_profile.get_stats()
+      if stats is None:
+        return 'application/octet-stream', marshal.dumps({})
+      return 'application/octet-stream', marshal.dumps(stats.stats)
+    return 'text/plain', self._fleet_profile.format_stats(sort, limit)
+
   def handle_fd_server_shutdown(self):
     # this comes from the micromanagement server telling this process that the
     # new process tree is ready to take sole ownership of the fd_server socket
@@ -420,6 +936,42 @@ class ManagedServer(object):
       self._fd_server.shutdown()
 
 
+def freeze_heap():
+  """Get the parent's heap into the best shape for sharing with children.
+
+  Collect everything first so garbage isn't inherited by every child. Then,
+  where the interpreter supports it (3.7+), move the survivors into the
+  permanent generation - otherwise the first full collection in each child
+  writes to the gc header of every object and unshares the pages. On older
+  interpreters, init_child keeps the children from running full collections
+  instead. They are left to oob_gc if it's on - cycles that reach the oldest
+  generation are otherwise only reclaimed when the child is recycled."""
+  collected = gc.collect()
+  if hasattr(gc, 'freeze'):
+    gc.freeze()
+    logging.info('freeze_heap collected %s, froze %s objects', collected,
+                 gc.get_freeze_count())
+  else:
+    logging.info('freeze_heap collected %s, gc.freeze unavailable, children '
+                 'won\'t run full collections on their own', collected)
+
+
+def disable_full_collections():
+  """Stop the interpreter from collecting the oldest generation by itself,
+  the young generations are cheap enough to leave alone."""
+  threshold0, threshold1, threshold2 = gc.get_threshold()
+  gc.set_threshold(threshold0, threshold1, OOB_GC_THRESHOLD)
+
+
+def get_gc_allocation_count():
+  """Estimate the objects allocated (less those freed) since the last full
+  collection from the generation counts - each count is the number of
+  collections of the next younger generation."""
+  threshold0, threshold1, threshold2 = gc.get_threshold()
+  count0, count1, count2 = gc.get_count()
+  return (count2 * threshold1 + count1) * threshold0 + count0
+
+
 def compute_memory_delta(mem_stats1, mem_stats2):
   return dict([(key, value - mem_stats1.get(key, 0))
                for key, value in mem_stats2.iteritems()])
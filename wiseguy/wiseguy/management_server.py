@@ -38,8 +38,8 @@ class ManagementServer(embedded_http_server.EmbeddedHTTPServer):
       if e[0] == errno.EADDRINUSE and self.fd_server:
         logging.info('requesting bound fd %s', self.server_address)
         fd_client = fd_server.FdClient(self.fd_server.server_address)
-        fd = fd_client.get_fd_for_address(self.server_address)
-        self.socket = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        fd_info = fd_client.get_fd_for_address(self.server_address)
+        self.socket = fd_info.socket()
 
         # clear out any backlog that's hanging around
         self.socket.setblocking(False)
@@ -70,6 +70,9 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
   path_map = embedded_http_server.EmbeddedRequestHandler.path_map.copy()
   path_map.update({
     '/server-cycle': 'handle_server_cycle',
+    '/server-fleet-profile': 'handle_server_fleet_profile',
+    '/server-latency': 'handle_server_latency',
+    '/server-memory': 'handle_server_memory',
     '/server-profile': 'handle_server_profile',
     '/server-profile-data': 'handle_server_last_profile_data',
     '/server-profile-memory': 'handle_profile_memory',
@@ -78,6 +81,10 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
     '/server-suspend-spawning': 'handle_suspend_spawning',
     '/server-set-max-rss': 'handle_set_max_rss',
     '/server-set-max-total-mem': 'handle_set_max_total_mem',
+    '/server-set-request-deadline': 'handle_set_request_deadline',
+    '/server-set-worker-bounds': 'handle_set_worker_bounds',
+    '/server-status': 'handle_server_status',
+    '/server-usage': 'handle_server_usage',
     })
   
   def handle_set_max_rss(self):
@@ -98,6 +105,26 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
       logging.warning('ignored bizzare max_total_mem: %s', max_total_mem)
       return 'ERROR.\n%s\n' % e
 
+  def handle_set_request_deadline(self):
+    request_deadline = self._get_float('request_deadline', 0)
+    try:
+      self.server.fcgi_server.set_request_deadline(request_deadline)
+      return 'OK.\n'
+    except ValueError, e:
+      logging.warning('ignored bizzare request_deadline: %s', request_deadline)
+      return 'ERROR.\n%s\n' % e
+
+  def handle_set_worker_bounds(self):
+    min_workers = self._get_int('min_workers', 1)
+    max_workers = self._get_int('max_workers', 0)
+    try:
+      self.server.fcgi_server.set_worker_bounds(min_workers, max_workers)
+      return 'OK.\n'
+    except ValueError, e:
+      logging.warning('ignored bizzare worker bounds: %s-%s',
+                      min_workers, max_workers)
+      return 'ERROR.\n%s\n' % e
+
   def handle_resume_spawning(self):
     self.server.fcgi_server.set_allow_spawning(True)
     return 'OK.\n'
@@ -110,9 +137,35 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
     skew = self._get_int('skew', 0)
     workers = self._get_int('workers', None)
     force = self._get_int('force', False)
-    self.server.fcgi_server.handle_server_cycle(skew, workers, force)
+    batch = self._get_int('batch', 0)
+    min_ready = self._get_int('min_ready', None)
+    ready_timeout = self._get_float('ready_timeout', None)
+    try:
+      self.server.fcgi_server.handle_server_cycle(
+        skew, workers, force, batch, min_ready, ready_timeout)
+    except ValueError, e:
+      return 'ERROR.\n%s\n' % e
+    if batch:
+      return 'rolling.\n'
     return 'cycled.\n'
 
+  def handle_server_memory(self):
+    stats, mem_usage_map = self.server.fcgi_server.get_memory_stats()
+    lines = ['%s: %s' % (key, value) for key, value in sorted(stats.iteritems())]
+    for pid, mem in sorted(mem_usage_map.iteritems()):
+      lines.append('pid %s: %s' % (pid, ' '.join(
+        '%s=%s' % (key, mem[key]) for key in sorted(mem))))
+    return '\n'.join(lines) + '\n'
+
+  def handle_server_latency(self):
+    return self.server.fcgi_server.handle_server_latency()
+
+  def handle_server_status(self):
+    return self.server.fcgi_server.handle_server_status()
+
+  def handle_server_usage(self):
+    return self.server.fcgi_server.handle_server_usage()
+
   def handle_prune_worker(self):
     self.server.fcgi_server.handle_server_prune_worker()
     return 'pruned.\n'
@@ -140,6 +193,19 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
       self.content_type = 'application/octet-stream'
     return data
 
+  def handle_server_fleet_profile(self):
+    format = self._get_str('format', 'text')
+    sort = self._get_str('sort', 'cumulative')
+    limit = self._get_int('limit', 50)
+    try:
+      content_type, data = self.server.fcgi_server.handle_server_fleet_profile(
+        format, sort, limit)
+    except (ValueError, KeyError), e:
+      return 'ERROR.\n%s\n' % e
+    if content_type != 'text/plain':
+      self.content_type = content_type
+    return data
+
   # note: this sets a variable in the parent - now you need
   # to cycle the children to actually collect data
   def handle_profile_memory(self):
@@ -9,10 +9,12 @@ import signal
 import socket
 import threading
 import time
+import traceback
 import sys
 
 from wiseguy import micro_management_server
 from wiseguy import resource_manager
+from wiseguy import scoreboard
 
 log = logging.getLogger('wsgi')
 
@@ -23,9 +25,40 @@ class PreForkingMixIn(object):
   signal_list = (signal.SIGTERM, signal.SIGINT, signal.SIGALRM,
                  signal.SIGHUP)
   alarm_interval = None
+  # how often the parent runs check_children when nothing else wakes it up
   check_interval = 1
   mem_check_interval = 30
   last_mem_check_time = 0
+  # cost of the memory sampling passes and the last snapshot taken, both
+  # owned by the parent's supervision loop
+  mem_check_stats = None
+  last_mem_usage_map = None
+  # adaptive pool sizing, only active when max_workers is set. grow when at
+  # least grow_busy_ratio of the children are tied up and connections are
+  # waiting to be accepted, shrink by one child at a time once no more than
+  # shrink_busy_ratio of them have been busy for shrink_delay seconds.
+  grow_busy_ratio = 0.8
+  shrink_busy_ratio = 0.3
+  shrink_delay = 30
+  last_busy_time = 0
+  # how long a child being recycled gets to finish its current request
+  # before it gets a SIGKILL
+  recycle_timeout = 60
+  # request deadlines - the signal that asks a child for its stack, and how
+  # long it gets to write it before the SIGKILL
+  stack_dump_signal = signal.SIGUSR2
+  stack_dump_timeout = 2
+  # rolling restarts - how long to wait for a batch of replacements to come
+  # up, and how often to look at the scoreboard while waiting
+  ready_timeout = 60
+  ready_poll_interval = 0.1
+  # request threads - how often the main thread of a child looks for a
+  # reason to exit, and how long it waits for the threads once it has one
+  thread_check_interval = 0.1
+  thread_join_interval = 0.1
+  thread_join_timeout = 30
+  _rolling_thread = None
+  rolling_status = None
   
   def parent_signal_handler(self, signalnum, stack_frame):
     if signalnum != signal.SIGALRM:
@@ -56,9 +89,39 @@ class PreForkingMixIn(object):
       # the child process just eats up CPU somewhere in a futex() loop
       #os.kill(pid, signal.SIGUSR1)
 
+  def parent_sigchld_handler(self, signalnum, stack_frame):
+    # nothing to do here - the interpreter writes to the wakeup fd at the C
+    # level and manage_children does the actual reaping
+    pass
+
   def install_parent_signals(self):
     for sig in self.signal_list:
       signal.signal(sig, self.parent_signal_handler)
+    signal.signal(signal.SIGCHLD, self.parent_sigchld_handler)
+    # the management threads are sitting in blocking socket calls and the
+    # signal can be delivered to any of them, so make sure they restart
+    # rather than fail with EINTR on every child exit
+    signal.siginterrupt(signal.SIGCHLD, False)
+    if self._wakeup_wfd is not None:
+      # the signal may land on a thread other than the one blocked in
+      # select(), the wakeup fd is the only reliable way to interrupt it
+      signal.set_wakeup_fd(self._wakeup_wfd)
+
+  def wait_for_wakeup(self, timeout):
+    """Block until a signal arrives, wakeup() is called or timeout expires."""
+    if self._wakeup_rfd is None:
+      time.sleep(timeout)
+      return
+    try:
+      ready_rfds, ready_wfds, ready_xfds = select.select(
+        [self._wakeup_rfd], [], [], max(timeout, 0))
+    except select.error, e:
+      if e[0] == errno.EINTR:
+        return
+      raise
+    if ready_rfds:
+      # one byte per event is meaningless - we reap everything in one pass
+      self.drain_wakeup_fd()
 
   def child_signal_handler(self, signalnum, stack_frame):
     # HUP seems to have some issues - something must be registering it
@@ -68,12 +131,41 @@ class PreForkingMixIn(object):
     if signalnum in (signal.SIGTERM, signal.SIGINT):
       self._quit = True
 
+  def child_stack_dump_handler(self, signalnum, stack_frame):
+    """Log the stack of every thread, the parent is about to kill us."""
+    thread_names = dict((t.ident, t.name) for t in threading.enumerate())
+    current_ident = threading.current_thread().ident
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+      if ident == current_ident:
+        frame = stack_frame
+      elif ident not in thread_names:
+        # python2 keeps the thread states of the parent's threads around
+        # after fork, they aren't running here
+        continue
+      stacks.append('thread %s:\n%s' % (
+        thread_names.get(ident, ident),
+        ''.join(traceback.format_stack(frame))))
+    logging.error('stack of pid %s:\n%s', os.getpid(), '\n'.join(stacks))
+
   def install_child_signals(self):
     for sig in self.signal_list:
       signal.signal(sig, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
 
     signal.signal(signal.SIGTERM, self.child_signal_handler)
     signal.signal(signal.SIGINT, self.child_signal_handler)
+    signal.signal(self.stack_dump_signal, self.child_stack_dump_handler)
+    # the dump must not change what the request does - a blocking call that
+    # failed with EINTR would raise inside the application. a child stuck in
+    # one may not get to log its stack before the SIGKILL
+    signal.siginterrupt(self.stack_dump_signal, False)
+    # the child gets its own self-pipe so a signal can break it out of an
+    # idle accept loop, see HTTPServer.handle_request
+    signal.set_wakeup_fd(-1)
+    self.close_wakeup_fd()
+    self.init_wakeup_fd()
+    signal.set_wakeup_fd(self._wakeup_wfd)
 
 #   # NOTE: this can't be used reliably in a thread.
 #   # on some platforms, you get stats about a process by exec'ing a tool and
@@ -87,43 +179,200 @@ class PreForkingMixIn(object):
 #       except:
 #         logging.exception('check_children error')
 
+  def sample_children_memory(self):
+    """Read the memory usage of every child exactly once.
+
+    Returns a dict of pid -> mem_stats and records the cost of the pass in
+    mem_check_stats. The expensive smaps data is only collected when the
+    max_total_mem policy needs it."""
+    pids = self.child_pids
+    start_time = time.time()
+    start_cpu = sum(os.times()[:2])
+    try:
+      mem_usage_map = resource_manager.sample_memory_usage(
+        pids, detailed=bool(self._max_total_mem))
+    except resource_manager.MemoryException, e:
+      logging.warning('resource manager error: %s', e)
+      mem_usage_map = {}
+    elapsed = time.time() - start_time
+    cpu_time = sum(os.times()[:2]) - start_cpu
+
+    if self.mem_check_stats is None:
+      self.mem_check_stats = {}
+    stats = self.mem_check_stats
+    stats['check_count'] = stats.get('check_count', 0) + 1
+    stats['last_check_time'] = start_time
+    stats['last_duration'] = elapsed
+    stats['last_cpu_time'] = cpu_time
+    stats['last_pid_count'] = len(pids)
+    stats['last_error_count'] = len(pids) - len(mem_usage_map)
+    stats['total_duration'] = stats.get('total_duration', 0.0) + elapsed
+    stats['total_cpu_time'] = stats.get('total_cpu_time', 0.0) + cpu_time
+    stats['max_duration'] = max(stats.get('max_duration', 0.0), elapsed)
+    self.last_mem_usage_map = mem_usage_map
+    logging.debug('sampled memory for %s children in %.4fs (cpu %.4fs)',
+                  len(pids), elapsed, cpu_time)
+    return mem_usage_map
+
+  def get_memory_stats(self):
+    """Return (mem_check_stats, last_mem_usage_map) copies for reporting."""
+    return (dict(self.mem_check_stats or {}),
+            dict(self.last_mem_usage_map or {}))
+
+  def recycle_child(self, pid):
+    """Replace pid without interrupting the request it is working on.
+
+    The replacement is forked first, then pid is flagged through the
+    scoreboard and exits after its current request. check_recycling does the
+    rest. This forks, so it only runs in the main thread - other threads go
+    through queue_recycle."""
+    self._lock.acquire()
+    try:
+      if pid in self._recycle_deadlines:
+        return
+      self._recycle_deadlines[pid] = time.time() + self.recycle_timeout
+    finally:
+      self._lock.release()
+    self._start_recycle(pid)
+
+  def queue_recycle(self, pids):
+    """Have manage_children recycle pids. Safe to call from any thread."""
+    self._lock.acquire()
+    try:
+      for pid in pids:
+        if pid not in self._recycle_deadlines:
+          self._recycle_deadlines[pid] = time.time() + self.recycle_timeout
+          self._pending_recycles.append(pid)
+    finally:
+      self._lock.release()
+    self.wakeup()
+
+  def start_pending_recycles(self):
+    self._lock.acquire()
+    try:
+      pids = list(self._pending_recycles)
+    finally:
+      self._lock.release()
+    if not pids:
+      return
+    for pid in pids:
+      self._start_recycle(pid)
+    # only cleared once the replacements exist, rolling_cycle is waiting on
+    # this
+    self._lock.acquire()
+    try:
+      del self._pending_recycles[:len(pids)]
+    finally:
+      self._lock.release()
+
+  def _start_recycle(self, pid):
+    # don't replace children the pool no longer has room for
+    active_count = len([child_pid for child_pid in self.child_pids
+                        if child_pid not in self._recycle_deadlines])
+    if not self._quit and self._allow_spawning and active_count < self._workers:
+      self.spawn_child()
+    if not self._scoreboard.request_recycle(pid):
+      # no way to ask nicely
+      _kill(pid, signal.SIGTERM)
+      return
+    self.check_recycling()
+
+  def check_recycling(self):
+    """Nudge or kill the children that have been asked to exit.
+
+    An idle child gets a SIGTERM since it isn't in the middle of anything. A
+    busy one is left alone until recycle_timeout runs out."""
+    if not self._recycle_deadlines:
+      return
+    now = time.time()
+    for pid, deadline in self._recycle_deadlines.items():
+      status = self._scoreboard.get_status(pid)
+      if now > deadline:
+        logging.warning('recycle timed out, kill child pid: %s', pid)
+        _kill(pid, signal.SIGKILL)
+        # only try once, reap_children cleans up after it
+        self._recycle_deadlines[pid] = now + self.recycle_timeout
+      elif (status is None or
+            status['state'] in (scoreboard.STATE_IDLE,
+                                scoreboard.STATE_STARTING)):
+        _kill(pid, signal.SIGTERM)
+
+  def check_deadlines(self):
+    """Kill the children that have been on one request for too long.
+
+    The child is asked to log its stack first and gets stack_dump_timeout
+    seconds to do it before the SIGKILL. The signal interrupts blocking
+    calls, so the request may well finish in the meantime - the child is
+    only killed if it is still on the same request. manage_children
+    replaces it once it has been reaped."""
+    now = time.time()
+    child_pids = set(self.child_pids)
+    for pid, kill in self._deadline_kills.items():
+      if pid not in child_pids:
+        del self._deadline_kills[pid]
+        continue
+      if kill is None:
+        continue
+      kill_time, request_start_time = kill
+      if now < kill_time:
+        continue
+      status = self._scoreboard.get_status(pid)
+      if (status is not None and
+          status['state'] == scoreboard.STATE_BUSY and
+          status['request_start_time'] == request_start_time):
+        _kill(pid, signal.SIGKILL)
+        self._deadline_kill_count += 1
+        # only try once, reap_children cleans up after it
+        self._deadline_kills[pid] = None
+      else:
+        logging.info('child pid %s finished its request, not killed', pid)
+        del self._deadline_kills[pid]
+    if not self._request_deadline and not self._request_deadline_overrides:
+      return
+    for status in self._scoreboard.snapshot():
+      pid = status['pid']
+      if (pid not in child_pids or pid in self._deadline_kills or
+          status['state'] != scoreboard.STATE_BUSY):
+        continue
+      request_deadline = self.get_request_deadline(status['path'])
+      elapsed = now - status['request_start_time']
+      if request_deadline and elapsed > request_deadline:
+        logging.error('request deadline exceeded, kill child pid: %s, '
+                      'path: %s, busy: %.1fs, deadline: %ss', pid,
+                      status['path'], elapsed, request_deadline)
+        self._deadline_kills[pid] = (now + self.stack_dump_timeout,
+                                     status['request_start_time'])
+        _kill(pid, self.stack_dump_signal)
+
   def check_children(self):
-    # limit children based on memory consumption
-    # FIXME: might want to fork off this new children first, presuming
-    # there are resources to do so, then kill the unruly children. this
-    # might result in smoother response times
+    # limit children based on memory consumption. the replacement children
+    # are forked first and the fat ones exit after their current request,
+    # see recycle_child
     if (self.last_mem_check_time and
         self.last_mem_check_time + self.mem_check_interval > time.time()):
       return
 
-    if not self._quit and self._allow_spawning:
+    if (not self._quit and self._allow_spawning and
+        (self._max_rss or self._max_total_mem)):
+      # one snapshot is shared between both policies
+      mem_usage_map = self.sample_children_memory()
+
       # We kill children using max-rss (per child) or max-total-mem
       killed = {}
       if self._max_rss:
-        for pid in self.child_pids:
-          try:
-            rss = resource_manager.get_memory_usage(pid)['VmRSS']
-          except resource_manager.MemoryException, e:
-            logging.warning('resource manager error pid: %s %s', pid, e)
+        for pid, mem in sorted(mem_usage_map.iteritems()):
+          if pid in self._recycle_deadlines:
             continue
+          rss = mem['VmRSS']
           if rss > self._max_rss:
-            logging.info('kill child pid: %s, rss: %s', pid, rss)
-            _kill(pid, signal.SIGTERM)
+            logging.info('recycle child pid: %s, rss: %s', pid, rss)
+            self.recycle_child(pid)
             killed[pid] = True
-            # fixme: sigterm is ok for now, but we might need to escalate to a
-            # sigkill at some point
-
-      if self._max_total_mem:
-        mem_usage = []
-        try:
-          for pid in self.child_pids:
-            if pid in killed: # we killed this guy above already
-              continue
-            mem_usage.append((resource_manager.get_memory_usage(pid), pid))
-        except resource_manager.MemoryException, e:
-          logging.warning('resource manager error: %s', e)
-          return
 
+      # we killed these guys above already, or are in the process of doing so
+      mem_usage = [(mem, pid) for pid, mem in mem_usage_map.iteritems()
+                   if pid not in killed and pid not in self._recycle_deadlines]
+      if self._max_total_mem and mem_usage:
         # we assume swap is private (there is no way to find the
         # shared component of swap)
 
@@ -134,31 +383,31 @@ class PreForkingMixIn(object):
         logging.debug('checking children total in use %s. max %s',
                       total_in_use, self._max_total_mem)
         if total_in_use >= self._max_total_mem:
-          # children too fat, we will kill some
+          # children too fat, we will recycle some
           overage = total_in_use - self._max_total_mem
 
           mem_usage.sort(key=lambda p:(p[0]['private'] + p[0]['swap']))
 
-          # Kill chilren, largest first, until we are just below
+          # Recycle chilren, largest first, until we are just below
           # limit. This means we might go over limit right after the
           # first re-spwan and we will kill more - that is ok as it
           # provides automatic jitter.
           freed_private_mem = 0
           while mem_usage and freed_private_mem < overage:
             mem, pid = mem_usage.pop()
-            logging.info('kill child pid: %s, pvt-mem: %s', pid,
+            logging.info('recycle child pid: %s, pvt-mem: %s', pid,
                          mem['private'])
-            _kill(pid, signal.SIGTERM)
+            self.recycle_child(pid)
             freed_private_mem += mem['private']
             
-          # and kill one more for good luck (or to add hysteresis)
+          # and recycle one more for good luck (or to add hysteresis)
           if not mem_usage:
-            logging.error("Killed all of our children trying to reclaim RAM.")
+            logging.error("Recycled all of our children trying to reclaim RAM.")
           else:
             mem, pid = mem_usage.pop()
-            logging.info('kill child pid: %s, pvt-mem: %s', pid,
+            logging.info('recycle child pid: %s, pvt-mem: %s', pid,
                          mem['private'])
-            _kill(pid, signal.SIGTERM)
+            self.recycle_child(pid)
             
           mem_per_worker_estimate = ((self._max_total_mem - max_shared_mem)
                                      / self._workers)
@@ -169,58 +418,181 @@ class PreForkingMixIn(object):
 
       self.last_mem_check_time = time.time()
 
-  def manage_children(self):
-    # NOTE: this code looks a little fishy to me, too much sharing of data
-    # between separate systems - would much prefer one mechanesm for
-    # cleanly registering periodic tasks. unfortunately, mixing threads and
-    # subprocesses is a bit unclean with overlapping calls to wait().
+  def get_memory_worker_limit(self):
+    """Estimate how many workers fit in max_total_mem.
 
-    while len(self.child_pids):
+    Uses the last detailed snapshot from check_children, returns None if there
+    is no budget or no snapshot to go on."""
+    if not self._max_total_mem or not self.last_mem_usage_map:
+      return None
+    mem_usage = [mem for mem in self.last_mem_usage_map.itervalues()
+                 if 'private' in mem]
+    if not mem_usage:
+      return None
+    max_shared_mem = max(mem['shared'] for mem in mem_usage)
+    private_mem_per_worker = (sum(mem['private'] + mem['swap']
+                                  for mem in mem_usage) / len(mem_usage))
+    if private_mem_per_worker <= 0:
+      return None
+    return max(1, ((self._max_total_mem - max_shared_mem) /
+                   private_mem_per_worker))
+
+  def adjust_workers(self):
+    """Resize the pool based on how busy the children are.
+
+    Only runs when max_workers is set, the pool stays between min_workers and
+    max_workers and never grows past what max_total_mem can hold."""
+    if not self._max_workers or self._quit or not self._allow_spawning:
+      return
+
+    now = time.time()
+    child_pids = set(self.child_pids)
+    slots = [status for status in self._scoreboard.snapshot()
+             if status['pid'] in child_pids]
+    if not slots:
+      return
+    busy_count = len([status for status in slots
+                      if status['state'] in (scoreboard.STATE_BUSY,
+                                             scoreboard.STATE_KEEPALIVE)])
+    busy_ratio = float(busy_count) / len(slots)
+    if self._reuse_port:
+      # the parent's socket isn't listening, the queues are in the children
+      queue_length = None
+    else:
+      queue_length = resource_manager.get_listen_queue_length(
+        self._listen_socket)
+    memory_limit = self.get_memory_worker_limit()
+
+    self._lock.acquire()
+    try:
+      workers = self._workers
+      max_workers = self._max_workers
+      if memory_limit is not None:
+        max_workers = max(self._min_workers, min(max_workers, memory_limit))
+
+      if busy_ratio > self.shrink_busy_ratio or not self.last_busy_time:
+        self.last_busy_time = now
+
+      if workers > max_workers:
+        # the memory budget has shrunk, don't keep respawning children
+        # check_children is going to kill anyway
+        new_workers = max_workers
+      elif (busy_ratio >= self.grow_busy_ratio and
+            (queue_length is None or queue_length > 0)):
+        if queue_length is None:
+          # can't see the backlog, grow one at a time
+          grow = 1
+        else:
+          # grow enough to drain the backlog in one go
+          grow = min(queue_length, workers)
+        new_workers = min(max_workers, workers + grow)
+      elif (busy_ratio <= self.shrink_busy_ratio and
+            now - self.last_busy_time >= self.shrink_delay):
+        new_workers = max(self._min_workers, workers - 1)
+        # wait another full period before shrinking any further
+        self.last_busy_time = now
+      else:
+        new_workers = workers
+      self._workers = new_workers
+    finally:
+      self._lock.release()
+
+    if new_workers == workers:
+      return
+    logging.info('adjust workers %s -> %s (busy %s/%s, queued %s, '
+                 'memory limit %s)', workers, new_workers, busy_count,
+                 len(slots), queue_length, memory_limit)
+    if new_workers < workers:
+      # prefer the children that have been idle the longest
+      idle_pids = self._scoreboard.get_idle_pids()
+      for pid in idle_pids[:workers - new_workers]:
+        _kill(pid, signal.SIGTERM)
+
+  def reap_children(self):
+    """Collect every child that has exited since the last call.
+
+    Never blocks. Raises OSError(ECHILD) if there were no children to
+    begin with."""
+    reaped = False
+    while True:
       try:
         pid, status = os.waitpid(-1, os.WNOHANG)
-        if pid:
-          try:
-            # NOTE: this is the first good place I can think of to use the
-            # 'with' statement
-            self._lock.acquire()
-            try:
-              self._child_pids.remove(pid)
-            finally:
-              self._lock.release()
-            logging.info("child finished: %s, %s", pid, status)
-          except KeyError, e:
-            logging.debug("child finished, no such pid: %s, %s",
-                      pid, status)
-            # this is probably a secondary process that we aren't
-            # interested in - just wait for the next child to die
-            continue
-          if pid and status != 0:
-            self.handle_bad_child(pid, status)
       except OSError, e:
         if e[0] == errno.EINTR:
           logging.debug("process interrupted")
-        elif e[0] == errno.ECHILD:
-          logging.error("no children, terminating parent: %s", e)
+          continue
+        if e[0] == errno.ECHILD and reaped:
+          # every child exited at once, they still have to be replaced
+          return
+        raise
+      if not pid:
+        return
+      reaped = True
+
+      self._lock.acquire()
+      try:
+        is_child = pid in self._child_pids
+        self._child_pids.discard(pid)
+        self._recycle_deadlines.pop(pid, None)
+      finally:
+        self._lock.release()
+      slot = self._scoreboard.release_pid(pid)
+      self._latency.retire_slot(slot)
+      self._accounting.retire_slot(slot)
+      self._deadline_kills.pop(pid, None)
+
+      if not is_child:
+        # this is probably a secondary process that we aren't
+        # interested in - just wait for the next child to die
+        logging.debug("child finished, no such pid: %s, %s", pid, status)
+        continue
+      logging.info("child finished: %s, %s", pid, status)
+      if status != 0:
+        self.handle_bad_child(pid, status)
+
+  def manage_children(self):
+    # the parent sleeps in select() on the wakeup fd. SIGCHLD (and any other
+    # parent signal) makes it readable, so a dead child is reaped and
+    # replaced right away. check_children runs on its own timer, every
+    # check_interval seconds, regardless of how often children exit.
+    # NOTE: all calls to wait() happen in this thread, mixing threads and
+    # subprocesses is a bit unclean with overlapping calls to wait().
+    next_check_time = time.time() + self.check_interval
+    while len(self.child_pids):
+      try:
+        self.reap_children()
+      except OSError, e:
+        if e[0] == errno.ECHILD:
+          # reaping the last child is the normal way out of this loop
+          if self.child_pids:
+            logging.error("no children, terminating parent: %s", e)
           break
         else:
           # error that aren't expected, or understood should log, but
           # not stop the server
           logging.exception("unhandled error in manage_children")
 
-      # if would be better to run this in it's own execution thread
-      # but there are issues with too many execution paths using waitpid()
-      # if something died, respawn - there will be plenty of time to scan for
-      # misbehaving children later
-      if not pid:
-        time.sleep(self.check_interval)
-        self.check_children()
-
+      # if something died, respawn first - there will be plenty of time to
+      # scan for misbehaving children later
       while (not self._quit and
              len(self.child_pids) < self._workers):
         if not self._allow_spawning:
           logging.warning("spawning disabled")
           break
         self.spawn_child()
+      # replacements asked for by a rolling restart
+      self.start_pending_recycles()
+
+      now = time.time()
+      if now >= next_check_time:
+        self.check_children()
+        self.check_recycling()
+        self.check_deadlines()
+        self.adjust_workers()
+        self.collect_fleet_profile()
+        now = time.time()
+        next_check_time = now + self.check_interval
+      self.wait_for_wakeup(next_check_time - now)
 
   # spawn another n children and kill off the old ones so the code cleanly
   # restarts
@@ -229,8 +601,17 @@ class PreForkingMixIn(object):
   # that get modified, but this shouldn't cause a problem since we mostly
   # operate on a consistent copy. the server as a whole should trend towards
   # consistency.
-  def handle_server_cycle(self, skew=0, workers=None, force=False):
-    if workers is not None and not 1 <= workers <= 64:
+  def handle_server_cycle(self, skew=0, workers=None, force=False,
+                          batch=0, min_ready=None, ready_timeout=None):
+    """Replace every child.
+
+    By default all the children are sent a SIGTERM (SIGKILL if force is set),
+    skew seconds apart, and manage_children respawns them.
+
+    If batch is set, do a rolling restart instead - see rolling_cycle. It
+    runs in its own thread, progress shows up in rolling_status.
+    """
+    if workers is not None and not 1 <= workers <= self.worker_limit:
       raise ValueError('unsane worker count: %s', workers)
 
     self.set_allow_spawning(True)
@@ -241,6 +622,20 @@ class PreForkingMixIn(object):
         self._workers = workers
       finally:
         self._lock.release()
+      # growing the pool doesn't generate a SIGCHLD
+      self.wakeup()
+
+    if batch:
+      if self._rolling_thread and self._rolling_thread.isAlive():
+        raise ValueError('rolling restart already in progress')
+      if min_ready is None:
+        min_ready = max(0, self._workers - batch)
+      self._rolling_thread = threading.Thread(
+        target=self.rolling_cycle, name='rolling_cycle',
+        args=(old_pids, batch, min_ready, ready_timeout or self.ready_timeout))
+      self._rolling_thread.setDaemon(True)
+      self._rolling_thread.start()
+      return
 
     for i, pid in enumerate(old_pids):
       # this is no longer helpful since it runs in a thread.
@@ -254,6 +649,80 @@ class PreForkingMixIn(object):
       if skew:
         time.sleep(skew)
 
+  def get_ready_pids(self):
+    """Return the children that are serving and not on their way out.
+
+    A child is ready once init_child has run all the init functions and it
+    has entered the request loop."""
+    child_pids = set(self.child_pids)
+    return set(status['pid'] for status in self._scoreboard.snapshot()
+               if status['pid'] in child_pids and
+               status['pid'] not in self._recycle_deadlines and
+               status['state'] in (scoreboard.STATE_IDLE,
+                                   scoreboard.STATE_BUSY,
+                                   scoreboard.STATE_KEEPALIVE))
+
+  # NOTE: THREADED this executes in another thread. it only picks the pids,
+  # manage_children forks the replacements in the main thread, reaps and
+  # handles the graceful exit of the old pids.
+  def rolling_cycle(self, old_pids, batch, min_ready, ready_timeout):
+    """Replace old_pids at most batch at a time.
+
+    A child is only recycled while there are more than min_ready ready
+    children, so capacity never drops below that floor - its replacement
+    is forked before it is asked to exit. Each batch waits for the previous
+    batch of replacements to become ready. The roll is abandoned if a
+    replacement dies before it gets there, or takes longer than
+    ready_timeout.
+    """
+    pending = list(old_pids)
+    new_pids = set()
+    logging.info('rolling restart of %s children, batch %s, min_ready %s',
+                 len(pending), batch, min_ready)
+    self.rolling_status = 'rolling: 0/%s' % len(pending)
+    while pending:
+      deadline = time.time() + ready_timeout
+      while True:
+        if self._quit:
+          self.rolling_status = 'aborted: shutting down'
+          return
+        ready_pids = self.get_ready_pids()
+        child_pids = set(self.child_pids)
+        crashed_pids = [pid for pid in new_pids
+                        if pid not in child_pids and pid not in ready_pids]
+        if crashed_pids:
+          logging.error('rolling restart aborted, new children died: %s',
+                        crashed_pids)
+          self.rolling_status = 'aborted: new children died %s' % crashed_pids
+          return
+        new_pids -= ready_pids
+        room = len(ready_pids) - min_ready
+        if not new_pids and room > 0:
+          break
+        if time.time() > deadline:
+          logging.error('rolling restart aborted, timed out waiting for '
+                        'ready children: %s ready, %s starting',
+                        len(ready_pids), len(new_pids))
+          self.rolling_status = 'aborted: timed out with %s pending' % len(
+            pending)
+          return
+        time.sleep(self.ready_poll_interval)
+
+      # children might have exited on their own in the meantime
+      current_batch = [pid for pid in pending[:min(batch, room)]
+                       if pid in child_pids]
+      pending = pending[min(batch, room):]
+      before_pids = set(self.child_pids)
+      self.queue_recycle(current_batch)
+      # wait for manage_children to fork the replacements
+      while self._pending_recycles and not self._quit:
+        time.sleep(self.ready_poll_interval)
+      new_pids = set(self.child_pids) - before_pids
+      self.rolling_status = 'rolling: %s/%s' % (
+        len(old_pids) - len(pending), len(old_pids))
+    logging.info('rolling restart complete')
+    self.rolling_status = 'complete: %s children' % len(old_pids)
+
   # NOTE: THREADED this executes in another thread. there are shared variables
   # that get modified, but this shouldn't cause a problem since we mostly
   # operate on a consistent copy. the server as a whole should trend towards
@@ -264,7 +733,12 @@ class PreForkingMixIn(object):
     try:
       if self._workers:
         self._workers -= 1
-        pid = self.child_pids[0]
+        # prefer a child that isn't in the middle of something
+        idle_pids = self._scoreboard.get_idle_pids()
+        if idle_pids:
+          pid = idle_pids[0]
+        else:
+          pid = self.child_pids[0]
     finally:
       self._lock.release()
     if pid is not None:
@@ -328,14 +802,25 @@ class PreForkingMixIn(object):
       return
 
     logging.debug("respawning a child")
-    pid = os.fork()
+    slot = self._scoreboard.allocate_slot()
+    try:
+      pid = os.fork()
+    except OSError:
+      self._scoreboard.cancel_slot(slot)
+      raise
     if pid:
       # parent
-      self._child_pids.add(pid)
+      self._lock.acquire()
+      try:
+        self._child_pids.add(pid)
+      finally:
+        self._lock.release()
+      self._scoreboard.assign_slot(slot, pid)
       return pid
 
     # child
     self.post_fork_reinit()
+    self._scoreboard.child_init(slot, os.getpid())
 
     if not profile_path:
       profile_path = self._profile_path
@@ -369,6 +854,13 @@ class PreForkingMixIn(object):
                         last_profile_link)
       self._profile = resource_manager.get_profiler(profiler_module, path,
                                                     bias=profile_bias)
+      if profiler_module == 'sampling':
+        # the signal handler can only be installed from the main thread,
+        # and requests might run on others
+        self._profile.start()
+      if getattr(self._profile, 'dump_interval', None):
+        # this one writes its data out as it goes, point at it right away
+        _link_last_profile(path)
 
     if profile_uri:
       self._profile_uri_regex = re.compile(profile_uri)
@@ -378,19 +870,12 @@ class PreForkingMixIn(object):
     # prior
     self.init_child()
     self._child_request_loop()
+    self.drain_requests()
 
     # fixme: move to managed_server.exit_child?
     if self._profile:
       self._profile.close()
-      last_profile_link = os.path.join(
-        os.path.dirname(self._profile.filename),
-        last_profile_symlink_name)
-      try:
-        os.symlink(self._profile.filename, last_profile_link)
-      except OSError, e:
-        if e[0] not in (errno.EEXIST,):
-          logging.exception("error creating symlink %s",
-                            self._profile.filename)
+      _link_last_profile(self._profile.filename)
       
     self.exit_child()
 
@@ -423,13 +908,64 @@ class PreForkingMixIn(object):
     logging._releaseLock()
     
   def _child_request_loop(self):
+    if self._threads > 1:
+      self._run_request_threads()
+    else:
+      self._request_loop()
+
+  def _request_loop(self):
     while not self._quit:
+      if self._scoreboard.recycle_requested():
+        logging.info('recycle requested, exiting')
+        break
       try:
         self.handle_request()
       except (select.error, IOError), e:
         self._handle_io_error(e)
 
+  def _request_thread(self):
+    try:
+      self._request_loop()
+    except:
+      logging.exception('request thread died')
+      # take the whole child down, the parent will replace it
+      self._quit = True
+
+  def _run_request_threads(self):
+    """Serve requests from _threads threads until it's time to exit.
+
+    Signals are only delivered to the main thread, so it stays out of the
+    request loop. Once it's time to exit it keeps poking the self-pipe until
+    every thread has finished its current request and left, or until
+    thread_join_timeout is up."""
+    threads = []
+    for i in xrange(self._threads):
+      request_thread = threading.Thread(
+        target=self._request_thread, name='request-%s' % i)
+      request_thread.setDaemon(True)
+      request_thread.start()
+      threads.append(request_thread)
+    while not self._quit:
+      if self._scoreboard.recycle_requested():
+        logging.info('recycle requested, exiting')
+        break
+      if not [t for t in threads if t.isAlive()]:
+        break
+      time.sleep(self.thread_check_interval)
+    self._quit = True
+    deadline = time.time() + self.thread_join_timeout
+    for request_thread in threads:
+      while request_thread.isAlive() and time.time() < deadline:
+        self.wakeup()
+        request_thread.join(self.thread_join_interval)
+      if request_thread.isAlive():
+        logging.warning('%s still busy, exiting anyway', request_thread.name)
+
   def serve_forever(self):
+    # warm up the application once, in the parent, while the previous process
+    # tree (if any) is still serving
+    self.init_parent()
+
     # if you are a stealing existing file descriptors and you know the previous
     # pid, fire up a client so you can gracefully prune the children as you
     # start up. the thinking is that if you start too quickly you will use up
@@ -477,6 +1013,7 @@ class PreForkingMixIn(object):
       except Exception, e:
         logging.warning('graceful_shutdown failed: %s', e)
       
+    self.init_wakeup_fd()
     self.install_parent_signals()
     self.unlock_startup()
     try:
@@ -485,6 +1022,15 @@ class PreForkingMixIn(object):
       logging.exception("unhandled exception in manage_children, exitting")
     self.exit_parent()
 
+def _link_last_profile(filename):
+  last_profile_link = os.path.join(os.path.dirname(filename),
+                                   last_profile_symlink_name)
+  try:
+    os.symlink(filename, last_profile_link)
+  except OSError, e:
+    if e[0] not in (errno.EEXIST,):
+      logging.exception("error creating symlink %s", filename)
+
 def _kill(pid, signo):
   try:
     logging.info('send kill pid: %s signo: %s', pid, signo)
@@ -1,5 +1,9 @@
 import errno
 import logging
+import os
+import re
+import socket
+import struct
 import subprocess
 import sys
 
@@ -40,11 +44,44 @@ def generic_get_memory_usage(pid):
 
   return {'VmRSS':rss_size_kb, 'VmSize':vsz_kb}
 
+def generic_sample_memory_usage(pids, detailed=True):
+  """
+  get memory usage for a list of pids with a single exec of ps, rather than
+  one per pid. returns a dict of pid -> mem_stats, pids that have gone away
+  are simply missing. detailed is ignored, ps can't tell us any more.
+  """
+  usage = {}
+  if not pids:
+    return usage
+  cmd = ['ps', '-opid,rss,vsz', '-p', ','.join(str(pid) for pid in pids)]
+  try:
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
+    lines = proc.stdout.readlines()
+    # if you don't wait, you leak file descriptors
+    proc.wait()
+  except OSError, e:
+    if e[0] in (errno.EINTR,):
+      raise MemoryException("interrupted during wait()")
+    else:
+      logging.exception("unexpected error in sample_memory_usage")
+      raise MemoryException("unexpected error: %s" % e)
+  # skip the header
+  for line in lines[1:]:
+    try:
+      pid, rss_size_kb, vsz_kb = [int(x) for x in line.split()]
+    except ValueError:
+      logging.warning('bad ps line: %r', line)
+      continue
+    usage[pid] = {'VmRSS':rss_size_kb, 'VmSize':vsz_kb}
+  return usage
+
 # guarantee that at least VmRSS and VmSize are in the mem_stats
 vm_keys = ('VmRSS', 'VmSize') #, 'VmData', 'VmPeak')
-def linux_get_memory_usage(pid):
+def linux_get_memory_usage(pid, detailed=True):
   """
   return dict of memory usage numbers from the procfs entry
+  detailed - also compute shared/private/swap from smaps, this is the
+    expensive part so skip it if you only need VmRSS
   """
   try:
     path = '/proc/%s/status' % pid
@@ -59,43 +96,95 @@ def linux_get_memory_usage(pid):
       if key not in mem_stats:
         raise MemoryException('missing key: %s' % key)
 
-    shared, private, swap = get_smaps_memory(pid)
-    mem_stats['shared'] = shared
-    mem_stats['private'] = private
-    mem_stats['swap'] = swap
+    if detailed:
+      shared, private, swap = get_smaps_memory(pid)
+      mem_stats['shared'] = shared
+      mem_stats['private'] = private
+      mem_stats['swap'] = swap
 
     return mem_stats
   except Exception, e:
     raise MemoryException("unexpected error: %s" % e)
 
+def linux_sample_memory_usage(pids, detailed=True):
+  """
+  return dict of pid -> mem_stats, reading procfs exactly once per pid.
+  pids that can't be read (usually because they just exited) are logged and
+  left out.
+  """
+  usage = {}
+  for pid in pids:
+    try:
+      usage[pid] = linux_get_memory_usage(pid, detailed)
+    except MemoryException, e:
+      logging.warning('resource manager error pid: %s %s', pid, e)
+  return usage
+
+# smaps_rollup (linux 4.14+) has the per-process totals precomputed by the
+# kernel, which is a single small read instead of one stanza per mapping.
+has_smaps_rollup = os.path.exists('/proc/self/smaps_rollup')
+
+# matches Shared_*, Private_* and Swap, but not SwapPss. anchoring on a
+# literal newline is considerably faster than ^ with re.M, and the first line
+# of either file is always a mapping header.
+smaps_pattern = re.compile(r'\n(Shared|Private|Swap)(?:_\w+)?:\s+(\d+)')
+
 def get_smaps_memory(pid):
-  """Returns (shared_memory, private_memory) in kb"""
-  smaps_file = open('/proc/%s/smaps' % pid)
-  private_mem = 0
-  shared_mem = 0
-  swap_mem = 0
-  for line in smaps_file:
-    if line[:7] == 'Private':
-      # line =~ 'Private_Dirty:        12 kB'
-      # hope it's always 'kB'
-      _, value, unit = line.split()
-      private_mem += int(value)
-    elif line[:6] == 'Shared':
-      _, value, unit = line.split()
-      shared_mem += int(value)
-    elif line[:5] == 'Swap:':
-      _, value, unit = line.split()
-      swap_mem += int(value)
-  return shared_mem, private_mem, swap_mem
+  """Returns (shared_memory, private_memory, swap_memory) in kb"""
+  if has_smaps_rollup:
+    return _parse_smaps('/proc/%s/smaps_rollup' % pid)
+  return _parse_smaps('/proc/%s/smaps' % pid)
+
+def _parse_smaps(path):
+  # read the whole file in one go and let the regex engine find the handful
+  # of interesting lines rather than splitting every line in python
+  smaps_file = open(path)
+  try:
+    data = smaps_file.read()
+  finally:
+    smaps_file.close()
+  totals = {'Shared': 0, 'Private': 0, 'Swap': 0}
+  for key, value in smaps_pattern.findall(data):
+    totals[key] += int(value)
+  return totals['Shared'], totals['Private'], totals['Swap']
+
+# struct tcp_info starts with 8 bytes of flags and then a run of u32s. for a
+# listening socket, tcpi_unacked is the current accept queue length.
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+tcp_info_format = '8B6I'
+tcp_info_size = struct.calcsize(tcp_info_format)
+tcp_info_unacked = 12
+
+def linux_get_listen_queue_length(sock):
+  """
+  return the number of connections waiting to be accepted on sock, or None
+  if that can't be determined (not a TCP socket for instance)
+  """
+  if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+    return None
+  try:
+    tcp_info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, tcp_info_size)
+  except socket.error, e:
+    logging.debug('unable to get TCP_INFO: %s', e)
+    return None
+  return struct.unpack(tcp_info_format, tcp_info)[tcp_info_unacked]
+
+def generic_get_listen_queue_length(sock):
+  return None
 
 if sys.platform == 'linux2':
+  get_listen_queue_length = linux_get_listen_queue_length
   get_memory_usage = linux_get_memory_usage
+  sample_memory_usage = linux_sample_memory_usage
 else:
+  get_listen_queue_length = generic_get_listen_queue_length
   get_memory_usage = generic_get_memory_usage
+  sample_memory_usage = generic_sample_memory_usage
 
 
 # make hotshot/profile/cProfile work the same way by selectively wrapping
-# certain classes with a proxy
+# certain classes with a proxy. the sampling profiler already has the same
+# interface.
 def get_profiler(profiler_module, path, bias=None):
   if profiler_module == 'cProfile':
     import cProfile
@@ -105,6 +194,9 @@ def get_profiler(profiler_module, path, bias=None):
     import cpuprofile
     prof = cpuprofile.Profile()
     return ProfileProxy(path, prof)
+  elif profiler_module == 'sampling':
+    from wiseguy import sampling_profiler
+    return sampling_profiler.SamplingProfiler(path)
 
 class ProfileProxy(object):
   def __init__(self, filename, profile):
@@ -0,0 +1,190 @@
+"""A statistical profiler driven by ITIMER_PROF.
+
+The deterministic profilers hook every call and return, which makes a
+profiled request two or three times slower. This one lets the kernel send a
+SIGPROF every interval seconds of CPU time and records the python stack of
+each thread that is inside runcall at that moment, so the overhead is a
+stack walk per tick and nothing at all between ticks. That's cheap enough
+to leave running on a worker indefinitely.
+
+Samples are kept as stack -> count and written out two ways:
+  filename - a marshalled pstats dict, like cProfile.dump_stats, so
+    pstats.Stats and /server-profile-data work the same as for cProfile
+  filename.collapsed - one 'frame;frame;frame count' line per stack, the
+    input format of flamegraph.pl
+
+Only the main thread receives signals, and only the main thread can
+install a handler, so start() has to be called from there once - the
+worker does it right after fork. runcall() can be called from any thread,
+it just marks the calling thread as one to sample. Samples for request
+threads come from sys._current_frames(), the handler runs as soon as the
+main thread gets the GIL back.
+"""
+
+import logging
+import marshal
+import os
+import signal
+import sys
+import thread
+import time
+
+# 100 samples per cpu second
+SAMPLE_INTERVAL = 0.01
+# how often a long running profile is written out, so the data can be
+# fetched without waiting for the worker to exit
+DUMP_INTERVAL = 60
+# stacks deeper than this are cut off at the root end
+MAX_DEPTH = 256
+
+
+def _frame_key(code):
+  return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class SamplingProfiler(object):
+  def __init__(self, filename, interval=SAMPLE_INTERVAL,
+               dump_interval=DUMP_INTERVAL):
+    self.filename = filename
+    self.interval = interval
+    self.dump_interval = dump_interval
+    # stack tuple (root first) -> sample count
+    self.samples = {}
+    self.sample_count = 0
+    # ticks that landed while no thread was being profiled
+    self.idle_count = 0
+    # idents of the threads currently inside runcall
+    self._active = set()
+    self._main_ident = thread.get_ident()
+    self._next_dump_time = time.time() + dump_interval
+    self._running = False
+
+  def start(self):
+    """Install the SIGPROF handler and start the timer, from the main
+    thread."""
+    if self._running:
+      return
+    signal.signal(signal.SIGPROF, self._handle_sigprof)
+    # the signal must not break blocking calls in the application with EINTR
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    self._running = True
+
+  def stop(self):
+    if not self._running:
+      return
+    signal.setitimer(signal.ITIMER_PROF, 0)
+    # a tick might still be pending, and the default action is to exit
+    signal.signal(signal.SIGPROF, signal.SIG_IGN)
+    self._running = False
+
+  def runcall(self, function, *pargs, **kargs):
+    ident = thread.get_ident()
+    self._active.add(ident)
+    try:
+      return function(*pargs, **kargs)
+    finally:
+      self._active.discard(ident)
+      if time.time() >= self._next_dump_time:
+        self._next_dump_time = time.time() + self.dump_interval
+        try:
+          self.dump_stats(self.filename)
+        except (IOError, OSError), e:
+          logging.warning('unable to dump sampling profile: %s', e)
+
+  def close(self):
+    self.stop()
+    self.dump_stats(self.filename)
+
+  def _handle_sigprof(self, signalnum, stack_frame):
+    self.sample_count += 1
+    # copy, request threads come and go while we're in here
+    active = list(self._active)
+    if not active:
+      self.idle_count += 1
+      return
+    current_frames = None
+    for ident in active:
+      if ident == self._main_ident:
+        frame = stack_frame
+      else:
+        if current_frames is None:
+          current_frames = sys._current_frames()
+        frame = current_frames.get(ident)
+      if frame is not None:
+        self._record(frame)
+
+  def _record(self, frame):
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+      code = frame.f_code
+      if code is _runcall_code:
+        # everything above this is server scaffolding
+        break
+      stack.append(_frame_key(code))
+      frame = frame.f_back
+    if not stack:
+      return
+    stack.reverse()
+    stack = tuple(stack)
+    self.samples[stack] = self.samples.get(stack, 0) + 1
+
+  def get_stats(self):
+    """Return the samples as a pstats dict - func -> (cc, nc, tt, ct,
+    callers). Call counts are sample counts, times are samples * interval.
+    A recursive function is only counted once per sample."""
+    stats = {}
+    interval = self.interval
+    for stack, count in self.samples.items():
+      seen = set()
+      last = len(stack) - 1
+      for index, func in enumerate(stack):
+        entry = stats.get(func)
+        if entry is None:
+          entry = stats[func] = [0, 0, 0.0, 0.0, {}]
+        if func not in seen:
+          seen.add(func)
+          entry[0] += count
+          entry[1] += count
+          entry[3] += count * interval
+        if index == last:
+          self_time = count * interval
+          entry[2] += self_time
+        else:
+          self_time = 0.0
+        if index:
+          caller = stack[index - 1]
+          cc, nc, tt, ct = entry[4].get(caller, (0, 0, 0.0, 0.0))
+          entry[4][caller] = (cc + count, nc + count, tt + self_time,
+                              ct + count * interval)
+    return dict((func, tuple(entry)) for func, entry in stats.iteritems())
+
+  def get_collapsed(self):
+    """Return the samples in collapsed stack format, heaviest first."""
+    lines = []
+    for stack, count in sorted(self.samples.items(), key=lambda x: -x[1]):
+      lines.append('%s %s' % (';'.join(
+        '%s (%s:%s)' % (name, filename, lineno)
+        for filename, lineno, name in stack), count))
+    return '\n'.join(lines) + '\n'
+
+  def dump_stats(self, filename):
+    # write and rename, so whoever is fetching the profile never sees half
+    # of it
+    _write_file(filename, marshal.dumps(self.get_stats()))
+    _write_file(filename + '.collapsed', self.get_collapsed())
+    logging.debug('sampling profile: %s samples, %s idle, %s stacks',
+                  self.sample_count, self.idle_count, len(self.samples))
+
+
+def _write_file(filename, data):
+  tmp_filename = '%s.tmp' % filename
+  f = open(tmp_filename, 'wb')
+  try:
+    f.write(data)
+  finally:
+    f.close()
+  os.rename(tmp_filename, filename)
+
+
+_runcall_code = SamplingProfiler.runcall.im_func.func_code
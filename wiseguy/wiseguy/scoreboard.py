@@ -0,0 +1,346 @@
+"""A shared memory scoreboard so the parent can see what each child is doing.
+
+The parent creates an anonymous shared mmap before forking. Each child owns
+one fixed-size slot and updates it with plain memory writes (no syscalls) as
+it moves between requests. The parent and the management server threads only
+ever read the slots, except to hand them out and reclaim them.
+
+After the slots there is one control byte per slot that goes the other way -
+only the parent writes it and the child polls it between requests. A single
+byte write is atomic, so it needs no sequence counter.
+
+Each slot is protected by a sequence counter - the writer makes it odd while
+the slot is being rewritten and even again when it's done, the reader retries
+if it sees an odd or changed counter. That's all the locking there is.
+"""
+
+import logging
+import mmap
+import struct
+import thread
+import threading
+import time
+
+# slot states
+STATE_FREE = '.'
+STATE_STARTING = 'S'
+STATE_IDLE = '_'
+STATE_BUSY = 'W'
+STATE_KEEPALIVE = 'K'
+STATE_EXITING = 'X'
+
+state_names = {
+  STATE_FREE: 'free',
+  STATE_STARTING: 'starting',
+  STATE_IDLE: 'idle',
+  STATE_BUSY: 'busy',
+  STATE_KEEPALIVE: 'keepalive',
+  STATE_EXITING: 'exiting',
+  }
+
+PATH_SIZE = 128
+# seq, pid, state, request_count, start_time, request_start_time,
+# request_end_time, path
+SLOT_FORMAT = '<IicIddd%ds' % PATH_SIZE
+SEQ_FORMAT = '<I'
+SEQ_MASK = 0xffffffff
+# round up to a cache line so children don't fight over the same line
+SLOT_SIZE = (struct.calcsize(SLOT_FORMAT) + 63) & ~63
+# how many times a reader retries a slot that is being written
+READ_RETRIES = 100
+
+# control byte values
+CONTROL_NONE = '\0'
+CONTROL_RECYCLE = 'R'
+
+
+class ScoreboardError(Exception):
+  pass
+
+
+class Scoreboard(object):
+  def __init__(self, slot_count):
+    self.slot_count = slot_count
+    self._control_offset = slot_count * SLOT_SIZE
+    self._mmap = mmap.mmap(-1, self._control_offset + slot_count,
+                           mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    # parent side bookkeeping, pid -> slot. children can be spawned from the
+    # management threads, so this needs a lock
+    self._pid_slots = {}
+    self._reserved_slots = set()
+    self._lock = threading.Lock()
+    # child side - the slot this process writes to and its local copy
+    self._slot = None
+    self._seq = 0
+    self._pid = 0
+    self._request_count = 0
+    self._start_time = 0.0
+    self._request_start_time = 0.0
+    self._request_end_time = 0.0
+    self._path = ''
+    self._state = STATE_FREE
+    # thread id -> state, for children running request threads
+    self._thread_states = {}
+    # thread id -> (request_start_time, path) of the threads that are busy
+    self._busy_threads = {}
+
+  def __len__(self):
+    return self.slot_count
+
+  @property
+  def slot(self):
+    """The slot owned by this child, None in the parent."""
+    return self._slot
+
+  # parent side
+
+  def allocate_slot(self):
+    """Reserve a free slot for a child that is about to be forked.
+
+    Returns None if the scoreboard is full - the child will just run
+    without one."""
+    self._lock.acquire()
+    try:
+      used = set(self._pid_slots.itervalues()) | self._reserved_slots
+      for slot in xrange(self.slot_count):
+        if slot not in used:
+          self._reserved_slots.add(slot)
+          return slot
+    finally:
+      self._lock.release()
+    logging.warning('scoreboard full, %s slots', self.slot_count)
+    return None
+
+  def assign_slot(self, slot, pid):
+    """Record that pid owns slot - call in the parent right after fork.
+
+    The slot itself is written by the child, the parent only touches it
+    again once the child has been reaped."""
+    if slot is None:
+      return
+    self._lock.acquire()
+    try:
+      self._reserved_slots.discard(slot)
+      self._pid_slots[pid] = slot
+    finally:
+      self._lock.release()
+
+  def cancel_slot(self, slot):
+    """Give back a reserved slot if the fork never happened."""
+    self._lock.acquire()
+    try:
+      self._reserved_slots.discard(slot)
+    finally:
+      self._lock.release()
+
+  def release_pid(self, pid):
+    """Clear the slot of a child that has been reaped, return the slot."""
+    self._lock.acquire()
+    try:
+      slot = self._pid_slots.pop(pid, None)
+    finally:
+      self._lock.release()
+    if slot is not None:
+      self._write_slot(slot, None, 0, STATE_FREE, 0, 0.0, 0.0, 0.0, '')
+      self._mmap[self._control_offset + slot] = CONTROL_NONE
+    return slot
+
+  def request_recycle(self, pid):
+    """Ask pid to exit once it finishes its current request.
+
+    Returns False if pid doesn't have a slot to receive the request."""
+    self._lock.acquire()
+    try:
+      slot = self._pid_slots.get(pid)
+    finally:
+      self._lock.release()
+    if slot is None:
+      return False
+    self._mmap[self._control_offset + slot] = CONTROL_RECYCLE
+    return True
+
+  def read_slot(self, slot):
+    """Return a consistent copy of slot as a dict."""
+    offset = slot * SLOT_SIZE
+    for i in xrange(READ_RETRIES):
+      (seq, pid, state, request_count, start_time, request_start_time,
+       request_end_time, path) = struct.unpack_from(
+        SLOT_FORMAT, self._mmap, offset)
+      if seq & 1:
+        continue
+      if struct.unpack_from(SEQ_FORMAT, self._mmap, offset)[0] != seq:
+        continue
+      return {
+        'slot': slot,
+        'pid': pid,
+        'state': state,
+        'request_count': request_count,
+        'start_time': start_time,
+        'request_start_time': request_start_time,
+        'request_end_time': request_end_time,
+        'path': path.rstrip('\0'),
+        }
+    raise ScoreboardError('unable to read slot %s' % slot)
+
+  def get_status(self, pid):
+    """Return the slot dict for pid, or None if pid doesn't have one."""
+    self._lock.acquire()
+    try:
+      slot = self._pid_slots.get(pid)
+    finally:
+      self._lock.release()
+    if slot is None:
+      return None
+    return self.read_slot(slot)
+
+  def get_idle_pids(self):
+    """Return the pids of idle children, longest idle first."""
+    self._lock.acquire()
+    try:
+      pid_slots = self._pid_slots.items()
+    finally:
+      self._lock.release()
+    idle = []
+    for pid, slot in pid_slots:
+      try:
+        status = self.read_slot(slot)
+      except ScoreboardError, e:
+        logging.warning('%s', e)
+        continue
+      if status['pid'] == pid and status['state'] == STATE_IDLE:
+        idle.append((status['request_end_time'], pid))
+    idle.sort()
+    return [pid for request_end_time, pid in idle]
+
+  def snapshot(self):
+    """Return a list of slot dicts for every slot that is in use."""
+    slots = []
+    for slot in xrange(self.slot_count):
+      try:
+        status = self.read_slot(slot)
+      except ScoreboardError, e:
+        logging.warning('%s', e)
+        continue
+      if status['pid']:
+        slots.append(status)
+    return slots
+
+  # child side
+
+  def child_init(self, slot, pid):
+    """Take ownership of slot in a freshly forked child."""
+    # forget the parent's view of the world, the lock might have been held
+    # by another thread at the time of the fork
+    self._pid_slots = {}
+    self._reserved_slots = set()
+    # from here on the lock protects the child's state from its threads
+    self._lock = threading.Lock()
+    self._thread_states = {}
+    self._busy_threads = {}
+    self._slot = slot
+    if slot is None:
+      return
+    self._seq = struct.unpack_from(
+      SEQ_FORMAT, self._mmap, slot * SLOT_SIZE)[0] & ~1
+    self._pid = pid
+    self._start_time = time.time()
+    self._set_state(STATE_STARTING)
+
+  def set_idle(self):
+    self._set_thread_state(STATE_IDLE)
+
+  def set_busy(self, path):
+    self._set_thread_state(STATE_BUSY, path)
+
+  def set_keepalive(self):
+    """Waiting on a persistent connection for the next request."""
+    self._set_thread_state(STATE_KEEPALIVE)
+
+  def recycle_requested(self):
+    """True if the parent wants this child to exit between requests."""
+    if self._slot is None:
+      return False
+    return self._mmap[self._control_offset + self._slot] == CONTROL_RECYCLE
+
+  def set_exiting(self):
+    self._set_state(STATE_EXITING)
+
+  def _set_thread_state(self, state, path=None):
+    """Record the state of the calling thread and publish the busiest one -
+    a child is busy while any of its request threads is. The request that
+    has been running the longest is the one that is published, so one
+    stuck thread can't hide behind the others."""
+    self._lock.acquire()
+    try:
+      ident = thread.get_ident()
+      if state == STATE_BUSY:
+        self._request_count += 1
+        self._busy_threads[ident] = (time.time(), path[:PATH_SIZE])
+      else:
+        self._request_end_time = time.time()
+        self._busy_threads.pop(ident, None)
+      if self._busy_threads:
+        self._request_start_time, self._path = min(
+          self._busy_threads.itervalues())
+      self._thread_states[ident] = state
+      states = self._thread_states.values()
+      for published_state in (STATE_BUSY, STATE_KEEPALIVE):
+        if published_state in states:
+          break
+      else:
+        published_state = STATE_IDLE
+      self._set_state(published_state)
+    finally:
+      self._lock.release()
+
+  def _set_state(self, state):
+    if self._slot is None:
+      return
+    self._state = state
+    self._seq = (self._seq + 2) & SEQ_MASK
+    self._write_slot(self._slot, self._seq, self._pid, state,
+                     self._request_count, self._start_time,
+                     self._request_start_time, self._request_end_time,
+                     self._path)
+
+  def _write_slot(self, slot, seq, pid, state, request_count, start_time,
+                  request_start_time, request_end_time, path):
+    offset = slot * SLOT_SIZE
+    if seq is None:
+      # the parent doesn't track the sequence, just bump whatever is there
+      seq = ((struct.unpack_from(SEQ_FORMAT, self._mmap, offset)[0] | 1) +
+             1) & SEQ_MASK
+    # mark the slot dirty, write the body, then publish the new sequence
+    dirty_seq = (seq - 1) & SEQ_MASK
+    struct.pack_into(SEQ_FORMAT, self._mmap, offset, dirty_seq)
+    struct.pack_into(SLOT_FORMAT, self._mmap, offset, dirty_seq, pid, state,
+                     request_count, start_time, request_start_time,
+                     request_end_time, path)
+    struct.pack_into(SEQ_FORMAT, self._mmap, offset, seq)
+
+
+def format_status(slots, now=None):
+  """Render a list of slot dicts as a human readable table."""
+  if now is None:
+    now = time.time()
+  counts = {}
+  for status in slots:
+    counts[status['state']] = counts.get(status['state'], 0) + 1
+  lines = ['%s: %s' % (state_names[state], counts.get(state, 0))
+           for state in (STATE_BUSY, STATE_KEEPALIVE, STATE_IDLE,
+                         STATE_STARTING, STATE_EXITING)]
+  lines.append('')
+  lines.append('%4s %7s %-8s %8s %9s %9s %s' % (
+    'slot', 'pid', 'state', 'requests', 'age', 'busy', 'path'))
+  for status in slots:
+    if status['state'] == STATE_BUSY:
+      busy = '%.3f' % (now - status['request_start_time'])
+      path = status['path']
+    else:
+      busy = '-'
+      path = ''
+    lines.append('%4s %7s %-8s %8s %9.1f %9s %s' % (
+      status['slot'], status['pid'],
+      state_names.get(status['state'], status['state']),
+      status['request_count'], now - status['start_time'], busy, path))
+  return '\n'.join(lines) + '\n'
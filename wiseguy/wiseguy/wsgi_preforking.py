@@ -10,9 +10,91 @@ class PreForkingFCGIWSGIServer(WSGIMixIn, PreForkingMixIn, FCGIServer):
     'wsgi.run_once': False
     }
 
+  # see WiseguyWSGIHandler.write_buffer_size, the same policy applies here
+  write_buffer_size = 16 * 1024
+
   def __init__(self, app, **kargs):
     FCGIServer.__init__(self, **kargs)
     self._app = app
+    if self._threads > 1:
+      self._environ = dict(self._environ)
+      self._environ['wsgi.multithread'] = True
+
+  def handle(self, req):
+    """WSGIMixIn.handle, but with fewer writes and flushes.
+
+    The status, the headers and the first block go out in one write, and a
+    body that is a list or tuple is written in write_buffer_size pieces
+    with a single flush at the end. Iterators and the write() callable
+    still get a flush per block so streaming works."""
+    environ = req.environ
+    environ['wsgi.input'] = req.stdin
+    environ['wsgi.errors'] = req.stderr
+    environ.update(self._environ)
+
+    if environ.get('HTTPS', 'off') in ('on', '1'):
+      environ['wsgi.url_scheme'] = 'https'
+    else:
+      environ['wsgi.url_scheme'] = 'http'
+
+    stdout = req.stdout
+    headers_set = []
+    headers_sent = []
+    # the pending output and its size
+    buffer = []
+    buffer_size = [0]
+
+    def flush_buffer():
+      if not buffer:
+        return
+      stdout.write(''.join(buffer))
+      del buffer[:]
+      buffer_size[0] = 0
+      stdout.flush()
+
+    def buffered_write(data, coalesce=False):
+      if not headers_set:
+        raise AssertionError('write() before start_response()')
+      elif not headers_sent:
+        # Before the first output, send the stored headers
+        status, response_headers = headers_sent[:] = headers_set
+        buffer.append('Status: %s\r\n' % status)
+        buffer.extend(['%s: %s\r\n' % header for header in response_headers])
+        buffer.append('\r\n')
+      buffer.append(data)
+      buffer_size[0] += len(data)
+      if not coalesce or buffer_size[0] >= self.write_buffer_size:
+        flush_buffer()
+
+    def write(data):
+      buffered_write(data)
+
+    def start_response(status, response_headers, exc_info=None):
+      if exc_info:
+        try:
+          if headers_sent:
+            # Re-raise original exception if headers sent
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+          exc_info = None     # avoid dangling circular ref
+      elif headers_set:
+        raise AssertionError('Headers already set!')
+
+      headers_set[:] = [status, response_headers]
+      return write
+
+    result = self._app(environ, start_response)
+    try:
+      coalesce = isinstance(result, (list, tuple))
+      for data in result:
+        if data:    # don't send headers until body appears
+          buffered_write(data, coalesce)
+      if not headers_sent:
+        buffered_write('')   # send headers now if body was empty
+      flush_buffer()
+    finally:
+      if hasattr(result, 'close'):
+        result.close()
 
   def get_app(self):
     return self._app